@@ -0,0 +1,126 @@
+"""
+Compares the vectorized `get_duplicated_docs_ids` with the previous group-by-group implementation on synthetic
+btctranscripts-like corpora, asserting identical output for several seeds and reporting the run time of both.
+Run from the repository root: `python benchmarks/benchmark_duplicate_detection.py [--size 100000]`
+"""
+import argparse
+import random
+import re
+import pandas as pd
+
+# makes the repository root importable
+from common import timed, quiet_logs
+
+from src.utils import get_duplicated_docs_ids  # noqa: E402
+
+BASE_URL = "https://btctranscripts.com/"
+CONFERENCES = ["bitcoin-core-dev-tech", "advancing-bitcoin", "lightning-conference", "london-bitcoin-devs",
+               "stephan-livera-podcast", "chaincode-labs"]
+
+
+def legacy_get_duplicated_docs_ids(df):
+    cols = ['index', 'title', 'transcript_by', 'created_at', 'domain', 'body_type']
+    df_grouped = df.groupby(cols)
+
+    ids_to_keep = []
+    for _, dfx in df_grouped:
+        if dfx.shape[0] == 1:
+            ids_to_keep.append(dfx['_id'].values[0])
+        else:
+            urls_ = list(set(dfx['url'].to_list()))
+            if len(urls_) == 1:
+                ids_to_keep.append(dfx['_id'].values[-1])
+            else:
+                last_route_urls = list(set([i.split("/")[-1] for i in urls_]))
+                if len(last_route_urls) == 1:
+                    base_url = "https://btctranscripts.com/bitcoin-core-dev-tech/"
+                    pattern = re.compile("^https://btctranscripts.com/bitcoin-core-dev-tech/[0-9]{4}-[0-9]{2}/.*")
+                    temp_urls = []
+                    for _, r in dfx.iterrows():
+                        if r['url'] not in temp_urls:
+                            if base_url in r['url']:
+                                if pattern.match(r['url']):
+                                    ids_to_keep.append(r['_id'])
+                            else:
+                                ids_to_keep.append(r['_id'])
+                            temp_urls.append(r['url'])
+                else:
+                    temp_urls = []
+                    for _, r in dfx.iterrows():
+                        if r['url'] not in temp_urls:
+                            ids_to_keep.append(r['_id'])
+                            temp_urls.append(r['url'])
+
+    total_ids = set(df['_id'])
+    ids_to_keep_set = set(ids_to_keep)
+    ids_to_drop = list(total_ids - ids_to_keep_set)
+
+    df_to_keep = df[df['_id'].isin(ids_to_keep_set)]
+    df_to_drop = df[df['_id'].isin(ids_to_drop)]
+
+    duplicates = df_to_keep[df_to_keep.duplicated('url', keep=False)]
+    df_to_drop = pd.concat([df_to_drop, duplicates])
+    df_to_keep.drop(duplicates.index, inplace=True)
+    return df_to_drop['_id'].to_list()
+
+
+def synthetic_corpus(size, seed):
+    """
+    Docs in groups of 1 to 6 sharing the duplicate key. Inside a group the urls are identical, differ only
+    before the last route (with and without a 'YYYY-MM' dev-tech route) or differ completely, and some urls
+    are reused by other groups.
+    """
+    rng = random.Random(seed)
+    rows, group_no = [], 0
+    all_urls = []
+    while len(rows) < size:
+        group_no += 1
+        key = {
+            "index": "btc-index",
+            "title": f"Talk {group_no % (size // 3 + 1)}",
+            "transcript_by": rng.choice(["Bryan Bishop", "Michael Folkson", "None", ""]),
+            "created_at": f"20{rng.randint(15, 23)}-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}",
+            "domain": BASE_URL,
+            "body_type": rng.choice(["markdown", "raw"]),
+        }
+        slug = f"talk-{group_no}"
+        kind = rng.random()
+        group_size = rng.choice([1, 1, 1, 2, 2, 3, 4, 6])
+        for member in range(group_size):
+            conference = rng.choice(CONFERENCES)
+            if kind < 0.3:
+                url = f"{BASE_URL}{conference}/{slug}"
+                kind = 0.0 if member else kind
+            elif kind < 0.7:
+                dated = rng.random() < 0.5
+                route = f"{rng.randint(2015, 2023)}-{rng.randint(10, 12)}/" if dated else ""
+                url = f"{BASE_URL}{conference}/{route}{slug}"
+            else:
+                url = f"{BASE_URL}{conference}/{slug}-{rng.randint(0, 3)}"
+            if all_urls and rng.random() < 0.02:
+                url = rng.choice(all_urls)
+            all_urls.append(url)
+            rows.append({**key, "_id": f"id-{len(rows)}", "url": url})
+    df = pd.DataFrame(rows[:size])
+    return df.sample(frac=1.0, random_state=seed).reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=100000)
+    parser.add_argument("--seeds", type=int, default=3)
+    args = parser.parse_args()
+
+    quiet_logs()
+
+    # small corpora exercise the edge cases, the last one is the benchmark
+    for seed in range(args.seeds):
+        df = synthetic_corpus(2000, seed)
+        assert get_duplicated_docs_ids(df.copy()) == legacy_get_duplicated_docs_ids(df.copy()), seed
+
+    df = synthetic_corpus(args.size, args.seeds)
+    legacy_ids, legacy_seconds = timed(legacy_get_duplicated_docs_ids, df.copy())
+    ids, seconds = timed(get_duplicated_docs_ids, df.copy())
+    assert ids == legacy_ids
+    print(f"{len(df)} docs, {len(ids)} to drop, identical output for {args.seeds + 1} corpora")
+    print(f"legacy: {legacy_seconds:.2f} s, vectorized: {seconds:.2f} s, speedup: {legacy_seconds / seconds:.1f}x")
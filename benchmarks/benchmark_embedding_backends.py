@@ -0,0 +1,61 @@
+"""
+Encodes the same elasticsearch docs with every embedding backend, asserts that the vectors of the ONNX backends
+have a cosine similarity above 0.99 with the PyTorch ones and reports the throughput of each backend in docs/sec.
+Run from the repository root: `python benchmarks/benchmark_embedding_backends.py [--size 256]`
+"""
+import argparse
+import itertools
+import time
+import numpy as np
+
+# makes the repository root importable
+from common import quiet_logs
+
+from src.config import ES_INDEX, EMBEDDING_BATCH_SIZE, get_embedding_model  # noqa: E402
+from src.elasticsearch_utils import ElasticSearchClient  # noqa: E402
+from src.embedding_utils import get_embedding_text, encode_texts  # noqa: E402
+
+BACKENDS = ["torch", "onnx", "onnx-int8"]
+MIN_COSINE_SIMILARITY = 0.99
+
+
+def fetch_texts(size):
+    docs = ElasticSearchClient().iter_data_from_es(es_index=ES_INDEX, source_includes=["title", "summary", "body"],
+                                                   page_size=size)
+    return [get_embedding_text(doc) for doc in itertools.islice(docs, size)]
+
+
+def encode(backend, texts):
+    model = get_embedding_model(backend)
+    # warm up, so the first batch doesn't pay for lazy initialization
+    encode_texts(model, texts[:EMBEDDING_BATCH_SIZE], batch_size=EMBEDDING_BATCH_SIZE)
+    start = time.perf_counter()
+    vectors = encode_texts(model, texts, batch_size=EMBEDDING_BATCH_SIZE)
+    return np.asarray(vectors, dtype=np.float32), time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--backends", nargs="+", default=BACKENDS)
+    args = parser.parse_args()
+
+    quiet_logs()
+
+    texts = fetch_texts(args.size)
+    reference, reference_seconds = encode("torch", texts)
+    print(f"torch: {len(texts) / reference_seconds:.1f} docs/sec")
+
+    failures = []
+    for backend in args.backends:
+        if backend == "torch":
+            continue
+        vectors, seconds = encode(backend, texts)
+        # all vectors are normalized, so the dot product is the cosine similarity
+        similarities = np.sum(vectors * reference, axis=1)
+        print(f"{backend}: {len(texts) / seconds:.1f} docs/sec, speedup: {reference_seconds / seconds:.1f}x, "
+              f"cosine similarity with torch: min {similarities.min():.4f}, mean {similarities.mean():.4f}")
+        if similarities.min() <= MIN_COSINE_SIMILARITY:
+            failures.append(backend)
+
+    assert not failures, f"vectors differ from torch (cosine similarity <= {MIN_COSINE_SIMILARITY}): {failures}"
@@ -0,0 +1,82 @@
+"""
+Fills an `EmbeddingCache` with random normalized vectors, asserts that hits match the stored vectors (exactly
+for float32, within float16 precision otherwise), that eviction and compaction keep the live vectors intact and
+that a reopened cache serves the same vectors, and reports the time of cached reads and writes.
+Run from the repository root: `python benchmarks/benchmark_embedding_cache.py [--size 50000]`
+"""
+import argparse
+import tempfile
+import time
+import numpy as np
+
+# makes the repository root importable
+from common import quiet_logs
+
+from src.embedding_cache import EmbeddingCache  # noqa: E402
+
+DIMS = 1024
+BATCH_SIZE = 64
+
+
+def random_vectors(rng, size):
+    vectors = rng.standard_normal((size, DIMS)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def assert_cached(cache, texts, vectors, cache_dtype):
+    for start in range(0, len(texts), BATCH_SIZE):
+        cached = cache.get_many(texts[start:start + BATCH_SIZE])
+        assert all(vector is not None for vector in cached)
+        cosine = np.sum(np.asarray(cached, dtype=np.float32) * vectors[start:start + BATCH_SIZE], axis=1)
+        assert cosine.min() > 0.9999, cosine.min()
+        if cache_dtype == "float32":
+            assert np.array_equal(np.asarray(cached), vectors[start:start + BATCH_SIZE])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=50000)
+    parser.add_argument("--dtype", default="float32")
+    args = parser.parse_args()
+
+    quiet_logs()
+
+    rng = np.random.default_rng(0)
+    texts = [f"Doc title {i} \n summary of doc {i}" for i in range(args.size)]
+    vectors = random_vectors(rng, args.size)
+
+    with tempfile.TemporaryDirectory() as dir_path:
+        cache = EmbeddingCache(dir_path, dims=DIMS, model_name="test", dtype=args.dtype, max_entries=args.size)
+
+        start = time.perf_counter()
+        for batch_start in range(0, args.size, BATCH_SIZE):
+            cache.set_many(texts[batch_start:batch_start + BATCH_SIZE], vectors[batch_start:batch_start + BATCH_SIZE])
+        write_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        assert_cached(cache, texts, vectors, args.dtype)
+        read_seconds = time.perf_counter() - start
+
+        # hits are read from the memory map, whitespace doesn't change the key
+        hit = cache.get_many([f"Doc title {args.size - 1}   \n summary of doc {args.size - 1}"])[0]
+        assert isinstance(hit.base, np.memmap) or isinstance(hit, np.memmap)
+        assert cache.get_many(["never cached"]) == [None]
+
+        # about half of the vectors are replaced by new ones, the least recently read are evicted and compacted away
+        new_texts = [f"New doc {i}" for i in range(args.size // 2 // BATCH_SIZE * BATCH_SIZE)]
+        new_vectors = random_vectors(rng, len(new_texts))
+        cache.set_many(new_texts, new_vectors)
+        assert len(cache) == args.size
+        assert cache.get_many(texts[:1])[0] is None
+        removed = cache.compact()
+        assert removed == len(new_texts), removed
+        assert_cached(cache, texts[len(new_texts):], vectors[len(new_texts):], args.dtype)
+        assert_cached(cache, new_texts, new_vectors, args.dtype)
+
+        reopened = EmbeddingCache(dir_path, dims=DIMS, model_name="test", dtype=args.dtype, max_entries=args.size)
+        assert_cached(reopened, new_texts, new_vectors, args.dtype)
+        size_mb = reopened.stats()["size_mb"]
+
+    print(f"{args.size} {args.dtype} vectors of {DIMS} dims, {size_mb:.1f} MB on disk, eviction and compaction ok")
+    print(f"write: {args.size / write_seconds:.0f} vectors/sec, read: {args.size / read_seconds:.0f} vectors/sec "
+          f"in batches of {BATCH_SIZE}")
@@ -0,0 +1,148 @@
+"""
+Compares `preprocess_email` with the previous line-by-line implementation on a mailing-list like corpus,
+asserting identical output and reporting the throughput of both and of the process pool batch API.
+Run from the repository root: `python benchmarks/benchmark_preprocess_email.py [--from-es URL]`
+"""
+import argparse
+import os
+import random
+import re
+import time
+from loguru import logger
+
+# makes the repository root importable
+import common  # noqa: F401
+
+from src.utils import is_date, normalize_text, preprocess_email, preprocess_emails, _is_fuzzy_date  # noqa: E402
+
+
+def legacy_preprocess_email(email_body):
+    email_body = email_body.split("-------------- next part --------------")[0]
+    email_lines = email_body.split('\n')
+    temp_ = []
+    for line in email_lines:
+        if line.startswith("On"):
+            line = line.replace("-", " ")
+            x = re.sub(r'\d', ' ', line)
+            if is_date(x, fuzzy=True):
+                continue
+            if line.endswith("> wrote:"):
+                continue
+        if line.endswith("> wrote:"):
+            continue
+        if line.startswith("Le "):
+            continue
+        if line.endswith("?crit :"):
+            continue
+        if re.match(r'\d{4}-\d{2}-\d{2}', line):
+            continue
+        if line.startswith("From:") or line.strip().startswith("To") or line.strip().startswith("permalink"):
+            continue
+        if line.startswith("Sent with Proton Mail"):
+            continue
+        if line and not line.startswith('>'):
+            if line.startswith('-- ') or line.startswith('[') or line.startswith('_____'):
+                continue
+            temp_.append(line)
+    email_string = "\n".join(temp_)
+    normalized_email_string = normalize_text(email_string)
+    if len(normalized_email_string) == 0:
+        return email_body
+    else:
+        return normalized_email_string
+
+
+WORDS = ("the a transaction fee relay package mempool channel htlc taproot covenant script wallet node peer "
+         "signature on only once onion offer To Today Topic permalink may march sun wed nan inf - -- > [ ] _____ "
+         "# .. . , : ? ! < > @ 2024-01-02 10:00 AM PM UTC").split()
+LINE_TEMPLATES = [
+    "On {weekday}, {month} {day}, {year} at {hour}:{minute} {ampm} {name} via bitcoin-dev <{email}> wrote:",
+    "On {year}-{mm}-{day} {hour}:{minute}, {name} wrote:",
+    "On {day}/{mm}/{year} {name} <{email}> wrote:",
+    "Le {weekday} {day} {month} {year} à {hour}:{minute}, {name} <{email}> a écrit :",
+    "> {text}",
+    ">> {text}",
+    "From: {name} <{email}>",
+    "To: bitcoin-dev@lists.linuxfoundation.org",
+    "{year}-{mm}-{day} {hour}:{minute} GMT+01:00 {name}:",
+    "-- ",
+    "[1] https://github.com/bitcoin/bips/pull/{day}",
+    "_______________________________________________",
+    "Sent with Proton Mail secure email.",
+    "permalink: https://gnusha.org/pi/bitcoindev/{email}",
+    "On {text}",
+    "Once {text}",
+]
+
+
+def random_line(rng):
+    if rng.random() < 0.55:
+        return " ".join(rng.choice(WORDS) for _ in range(rng.randint(0, 18)))
+    return rng.choice(LINE_TEMPLATES).format(
+        weekday=rng.choice(["Mon", "Tuesday", "Wed", "Thu", "Fri", "Sat", "Sunday", "Moonday"]),
+        month=rng.choice(["Jan", "February", "Mar", "Sept", "October", "Dec", "Foo"]),
+        day=rng.randint(1, 31), mm=f"{rng.randint(1, 12):02d}", year=rng.randint(2009, 2024),
+        hour=rng.randint(0, 23), minute=f"{rng.randint(0, 59):02d}", ampm=rng.choice(["AM", "PM"]),
+        name=rng.choice(["Alice Satoshi", "bob", "Carol-Ann", "Dave On"]), email="someone@example.com",
+        text=" ".join(rng.choice(WORDS) for _ in range(rng.randint(0, 12))),
+    )
+
+
+def synthetic_corpus(size, seed=0):
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(size):
+        lines = [random_line(rng) for _ in range(rng.randint(5, 80))]
+        if rng.random() < 0.2:
+            lines += ["-------------- next part --------------", "An HTML attachment was scrubbed..."]
+        corpus.append("\n".join(lines))
+    return corpus
+
+
+def es_corpus(url, size):
+    from src.config import ES_INDEX
+    from src.elasticsearch_utils import ElasticSearchClient
+    docs = ElasticSearchClient().iter_data_from_es(es_index=ES_INDEX, url=url, source_includes=["body"])
+    corpus = []
+    for doc in docs:
+        corpus.append(doc['_source'].get('body') or "")
+        if len(corpus) >= size:
+            break
+    return corpus
+
+
+def throughput(fn, corpus):
+    # every run starts with a cold attribution cache
+    _is_fuzzy_date.cache_clear()
+    start = time.perf_counter()
+    results = fn(corpus)
+    return results, len(corpus) / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=5000)
+    parser.add_argument("--from-es", dest="url", help="sample bodies of this domain from elasticsearch instead")
+    args = parser.parse_args()
+
+    corpus = es_corpus(args.url, args.size) if args.url else synthetic_corpus(args.size)
+    logger.info(f"corpus: {len(corpus)} bodies, {sum(len(body) for body in corpus) / 1e6:.1f} MB")
+
+    legacy_output, legacy_rate = throughput(lambda bodies: [legacy_preprocess_email(b) for b in bodies], corpus)
+    new_output, new_rate = throughput(lambda bodies: [preprocess_email(b) for b in bodies], corpus)
+    batch_output, batch_rate = throughput(preprocess_emails, corpus)
+    # the pool regardless of the size and CPU thresholds, to check they are set right for this machine
+    pool_output, pool_rate = throughput(lambda bodies: preprocess_emails(bodies, max_workers=os.cpu_count() or 1,
+                                                                         min_bodies_per_worker=1), corpus)
+
+    mismatches = [i for i, (a, b) in enumerate(zip(legacy_output, new_output)) if a != b]
+    assert not mismatches, f"{len(mismatches)} bodies differ, first at index {mismatches[0]}"
+    assert batch_output == new_output, "batch output differs from the single process output"
+    assert pool_output == new_output, "process pool output differs from the single process output"
+
+    logger.info(f"legacy preprocess_email: {legacy_rate:,.0f} bodies/sec")
+    logger.info(f"preprocess_email:        {new_rate:,.0f} bodies/sec ({new_rate / legacy_rate:.1f}x)")
+    logger.info(f"preprocess_emails:       {batch_rate:,.0f} bodies/sec ({batch_rate / legacy_rate:.1f}x)")
+    logger.info(f"forced process pool:     {pool_rate:,.0f} bodies/sec ({pool_rate / legacy_rate:.1f}x), "
+                f"{os.cpu_count()} CPUs")
+    logger.success("Output is identical for all bodies.")
@@ -0,0 +1,47 @@
+"""
+Measures the import time of the cron entry points and asserts that the jobs which don't embed
+never load torch. Run from the repository root: `python benchmarks/benchmark_startup.py`
+"""
+import os
+import subprocess
+import sys
+from loguru import logger
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+NON_EMBEDDING_ENTRY_POINTS = [
+    "generate_topic_modeling_csv",
+    "push_topic_modeling_to_es",
+    "drop_duplicates_from_es",
+    "topic_modeling_using_es",
+]
+EMBEDDING_ENTRY_POINTS = [
+    "update_vector_embedding_to_es",
+    "query_es_embedding_vectors",
+]
+
+PROBE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+print(f"{{time.perf_counter() - start:.3f}} {{'torch' in sys.modules}}")
+"""
+
+
+def measure_import(module):
+    result = subprocess.run([sys.executable, "-c", PROBE.format(module=module)], cwd=REPO_ROOT,
+                            capture_output=True, text=True, check=True)
+    seconds, torch_loaded = result.stdout.strip().splitlines()[-1].split()
+    return float(seconds), torch_loaded == "True"
+
+
+if __name__ == "__main__":
+    failures = []
+    for module in NON_EMBEDDING_ENTRY_POINTS + EMBEDDING_ENTRY_POINTS:
+        seconds, torch_loaded = measure_import(module)
+        logger.info(f"{module}: imported in {seconds:.3f} seconds, torch loaded: {torch_loaded}")
+        if torch_loaded and module in NON_EMBEDDING_ENTRY_POINTS:
+            failures.append(module)
+
+    assert not failures, f"torch is loaded at import time by: {failures}"
+    logger.success("None of the non-embedding entry points load torch at startup.")
@@ -0,0 +1,52 @@
+"""
+Compares looking up the stored topics of every doc with `TopicLookup` against the previous
+`stored_df.loc[source_id]` + `ast.literal_eval` path of `push_topic_modeling_to_es.py`, asserting identical topics.
+Run from the repository root: `python benchmarks/benchmark_topic_lookup.py [--csv PATH]`
+"""
+import argparse
+import ast
+import pandas as pd
+
+# makes the repository root importable
+from common import timed, quiet_logs
+
+from src.topic_lookup import TopicLookup  # noqa: E402
+
+
+def legacy_lookup(csv_path, source_ids):
+    stored_df = pd.read_csv(csv_path)
+    stored_df.set_index("source_id", inplace=True)
+    results = {}
+    for source_id in source_ids:
+        try:
+            this_row = stored_df.loc[source_id]
+            results[source_id] = (ast.literal_eval(this_row['primary_topics']),
+                                  ast.literal_eval(this_row['secondary_topics']))
+        except Exception:
+            # duplicated source_ids return several rows and can't be parsed
+            results[source_id] = None
+    return results
+
+
+def indexed_lookup(csv_path, source_ids):
+    topic_lookup = TopicLookup.from_csv(csv_path)
+    return {source_id: topic_lookup.get(source_id) for source_id in source_ids}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--csv", default="gpt_output/topic_modeling_bitcoin-dev.csv")
+    args = parser.parse_args()
+
+    quiet_logs()
+
+    source_ids = pd.read_csv(args.csv, usecols=['source_id'])['source_id'].dropna().unique().tolist()
+    legacy_results, legacy_seconds = timed(legacy_lookup, args.csv, source_ids)
+    results, seconds = timed(indexed_lookup, args.csv, source_ids)
+
+    mismatches = [source_id for source_id, topics in legacy_results.items()
+                  if topics is not None and topics != results[source_id]]
+    assert not mismatches, mismatches[:10]
+    print(f"{len(source_ids)} docs, identical topics, "
+          f"{sum(topics is None for topics in legacy_results.values())} duplicated source_ids the old path failed on")
+    print(f"legacy: {legacy_seconds:.2f} s, indexed: {seconds:.2f} s, speedup: {legacy_seconds / seconds:.1f}x")
@@ -0,0 +1,93 @@
+"""
+Converts the topic modeling csv files to the parquet topic dataset in a temporary directory, asserts that
+the topics read back are identical and compares size on disk and the time to load all topics and to
+filter a single month with both formats. Then splits the rows of a source over many files, as daily runs
+do, and asserts that compacting them keeps the same topics.
+Run from the repository root: `python benchmarks/benchmark_topic_storage.py [--output-dir gpt_output]`
+"""
+import argparse
+import ast
+import glob
+import os
+import tempfile
+import pandas as pd
+
+# makes the repository root importable
+from common import timed, quiet_logs
+
+from src.topic_storage import convert_csv_to_parquet, month_from_source_id, read_topics_df, write_topic_rows, \
+    compact_topic_files, list_topic_files, TOPIC_COLUMNS  # noqa: E402
+
+SPLIT_FILES = 50
+
+
+def load_csv(csv_paths, month=None):
+    """The csv way: read every file, parse the list columns and filter rows after loading them all."""
+    dfs = []
+    for csv_path in csv_paths:
+        df = pd.read_csv(csv_path).dropna(subset=['source_id'])
+        df.drop_duplicates(subset='source_id', keep='first', inplace=True)
+        df['source'] = os.path.basename(csv_path)[len("topic_modeling_"):-len(".csv")]
+        if month:
+            df = df[df['source_id'].map(month_from_source_id) == month]
+        for col in ['primary_topics', 'secondary_topics']:
+            df[col] = df[col].map(ast.literal_eval)
+        dfs.append(df)
+    return pd.concat(dfs, ignore_index=True)
+
+
+def size_on_disk(paths):
+    return sum(os.path.getsize(path) for path in paths)
+
+
+def as_dict(df):
+    # some source_ids are stored by several sources
+    return {(source, source_id): (list(primary_topics), list(secondary_topics))
+            for primary_topics, secondary_topics, source_id, source
+            in zip(df['primary_topics'], df['secondary_topics'], df['source_id'], df['source'])}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output-dir", default="gpt_output")
+    parser.add_argument("--month", default="2017-06")
+    args = parser.parse_args()
+
+    quiet_logs()
+
+    csv_paths = sorted(glob.glob(os.path.join(args.output_dir, "topic_modeling_*.csv")))
+    with tempfile.TemporaryDirectory() as dataset_dir:
+        for csv_path in csv_paths:
+            convert_csv_to_parquet(csv_path, dataset_dir, os.path.basename(csv_path)[len("topic_modeling_"):-len(".csv")])
+        parquet_paths = glob.glob(os.path.join(dataset_dir, "**", "*.parquet"), recursive=True)
+
+        csv_df, csv_seconds = timed(load_csv, csv_paths)
+        parquet_df, parquet_seconds = timed(read_topics_df, dataset_dir, drop_duplicates=False)
+        assert as_dict(csv_df) == as_dict(parquet_df)
+
+        csv_month_df, csv_month_seconds = timed(load_csv, csv_paths, month=args.month)
+        parquet_month_df, parquet_month_seconds = timed(read_topics_df, dataset_dir, months=[args.month],
+                                                        drop_duplicates=False)
+        assert as_dict(csv_month_df) == as_dict(parquet_month_df)
+
+        source = parquet_df['source'].value_counts().index[0]
+        rows = read_topics_df(dataset_dir, sources=[source], columns=TOPIC_COLUMNS + ['month']).to_dict("records")
+        with tempfile.TemporaryDirectory() as split_dir:
+            for part in range(SPLIT_FILES):
+                write_topic_rows(split_dir, source, rows[part::SPLIT_FILES])
+            split_df, split_seconds = timed(read_topics_df, split_dir)
+            removed = compact_topic_files(split_dir, source, max_files=SPLIT_FILES - 1)
+            compacted_df, compacted_seconds = timed(read_topics_df, split_dir)
+            assert removed == SPLIT_FILES and len(list_topic_files(split_dir)) == 1
+            assert as_dict(compacted_df) == as_dict(split_df) == as_dict(parquet_df[parquet_df['source'] == source])
+
+        print(f"{len(parquet_df)} docs in {len(csv_paths)} csv files, {len(parquet_paths)} parquet files, "
+              f"identical topics")
+        print(f"size: csv {size_on_disk(csv_paths) / 2 ** 20:.2f} MiB, "
+              f"parquet {size_on_disk(parquet_paths) / 2 ** 20:.2f} MiB")
+        print(f"load all: csv {csv_seconds:.2f} s, parquet {parquet_seconds:.2f} s, "
+              f"speedup: {csv_seconds / parquet_seconds:.1f}x")
+        print(f"load {args.month} ({len(parquet_month_df)} docs): csv {csv_month_seconds:.2f} s, "
+              f"parquet {parquet_month_seconds:.3f} s, speedup: {csv_month_seconds / parquet_month_seconds:.1f}x")
+        print(f"load {source} ({len(rows)} docs): {SPLIT_FILES} files {split_seconds:.3f} s, "
+              f"compacted {compacted_seconds:.3f} s, speedup: {split_seconds / compacted_seconds:.1f}x")
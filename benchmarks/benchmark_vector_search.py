@@ -0,0 +1,76 @@
+"""
+Compares recall and latency of the approximate vector searches (ES knn and the local HNSW index)
+against the exact `script_score` results. Run from the repository root:
+`python benchmarks/benchmark_vector_search.py`
+"""
+import os
+import numpy as np
+from loguru import logger
+
+# makes the repository root importable
+from common import timed
+
+from src.config import ES_INDEX, VECTOR_MIGRATION_FIELD, get_embedding_model  # noqa: E402
+from src.elasticsearch_utils import ElasticSearchClient  # noqa: E402
+from src.vector_index import LocalVectorIndex  # noqa: E402
+
+FIELD_NAME = "summary_vector_embeddings"
+# knn needs an indexed field, see migrate_vector_field.py
+KNN_FIELD_NAME = VECTOR_MIGRATION_FIELD or FIELD_NAME
+LOCAL_INDEX_DIR = "vector_index"
+TOP_K = 10
+QUESTIONS = [
+    "Bitcoin", "Taproot activation", "Lightning channel jamming", "covenants with OP_CHECKTEMPLATEVERIFY",
+    "fee bumping and package relay", "silent payments", "Schnorr signatures", "coinjoin privacy",
+    "mining pool centralization", "eltoo and ANYPREVOUT", "BIP 324 encrypted transport", "wallet descriptors",
+]
+
+
+def recall(exact, approximate):
+    exact_ids = {match["_id"] for match in exact["matches"]}
+    if not exact_ids:
+        return 1.0
+    return len(exact_ids & {match["_id"] for match in approximate["matches"]}) / len(exact_ids)
+
+
+if __name__ == "__main__":
+    model = get_embedding_model()
+    elastic_search = ElasticSearchClient()
+
+    if os.path.exists(LOCAL_INDEX_DIR):
+        vector_index = LocalVectorIndex.load(LOCAL_INDEX_DIR)
+    else:
+        vector_index, build_seconds = timed(LocalVectorIndex.build_from_es, elastic_search=elastic_search,
+                                            es_index=ES_INDEX, field_name=FIELD_NAME)
+        vector_index.save(LOCAL_INDEX_DIR)
+        logger.info(f"local index build: {build_seconds:.2f} seconds")
+
+    searches = {
+        "script_score": lambda question: elastic_search.compute_similar_docs_with_cosine_similarity(
+            es_index=ES_INDEX, model=model, field_name=FIELD_NAME, question=question, top_k=TOP_K),
+        "knn": lambda question: elastic_search.compute_similar_docs_with_knn(
+            es_index=ES_INDEX, model=model, field_name=KNN_FIELD_NAME, question=question, top_k=TOP_K),
+        "local": lambda question: vector_index.compute_similar_docs(
+            elastic_search=elastic_search, model=model, question=question, top_k=TOP_K),
+    }
+
+    latencies = {name: [] for name in searches}
+    recalls = {name: [] for name in searches}
+    for question in QUESTIONS:
+        exact, seconds = timed(searches["script_score"], question=question)
+        latencies["script_score"].append(seconds)
+        recalls["script_score"].append(1.0)
+        for name in ["knn", "local"]:
+            try:
+                results, seconds = timed(searches[name], question=question)
+            except Exception as ex:
+                logger.warning(f"{name} search failed: {ex}")
+                continue
+            latencies[name].append(seconds)
+            recalls[name].append(recall(exact, results))
+
+    for name in searches:
+        if latencies[name]:
+            logger.info(f"{name:>12}: recall@{TOP_K}: {np.mean(recalls[name]):.3f}, "
+                        f"latency p50: {np.median(latencies[name]) * 1000:.1f} ms, "
+                        f"max: {np.max(latencies[name]) * 1000:.1f} ms")
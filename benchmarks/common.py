@@ -0,0 +1,25 @@
+"""
+Setup shared by the benchmark scripts, importing it makes the repository root importable so the scripts can
+be run with `python benchmarks/<script>.py` from the repository root.
+"""
+import os
+import sys
+import time
+from loguru import logger
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.append(REPO_ROOT)
+
+
+def timed(fn, *args, **kwargs):
+    """(result of `fn`, seconds it took)"""
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def quiet_logs(level="WARNING"):
+    """Only log messages of `level` and above, so the output of the benchmark stands out."""
+    logger.remove()
+    logger.add(sys.stderr, level=level)
@@ -0,0 +1,78 @@
+"""
+Offline evaluation of the embedding topic pre-filter against the topics GPT already assigned in `gpt_output/`.
+For every labeled doc the candidate topics are selected from the full list and the recall of the stored
+`primary_topics` is reported per top-k, together with the prompt tokens the topic list takes.
+Run from the repository root: `python benchmarks/evaluate_topic_prefilter.py [--sample 2000]`
+"""
+import argparse
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+# makes the repository root importable
+import common  # noqa: F401
+
+from src.config import ES_INDEX, TOPIC_EMBEDDINGS_PATH, EMBEDDING_BATCH_SIZE, get_embedding_model, \
+    get_tokenizer  # noqa: E402
+from src.elasticsearch_utils import ElasticSearchClient  # noqa: E402
+from src.embedding_utils import encode_texts  # noqa: E402
+from src.topic_classifier import load_gpt_output_labels  # noqa: E402
+from src.topic_embeddings import TopicEmbeddings  # noqa: E402
+from src.utils import preprocess_email  # noqa: E402
+
+TOP_KS = [10, 20, 30, 40, 60, 80]
+
+
+def sample_texts(labels, sample_size):
+    """Texts of labeled docs, built the same way as in `generate_topic_modeling_csv.py`."""
+    texts = {}
+    docs = ElasticSearchClient().iter_data_from_es(es_index=ES_INDEX,
+                                                   source_includes=["id", "title", "summary", "body"])
+    for doc in docs:
+        source_id = doc['_source'].get('id')
+        if source_id not in labels:
+            continue
+        doc_body = doc['_source'].get('summary') or preprocess_email(email_body=doc['_source'].get('body', ''))
+        if doc_body:
+            texts[source_id] = doc['_source'].get('title', '') + "\n" + doc_body
+        if len(texts) >= sample_size:
+            break
+    docs.close()
+    return texts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sample", type=int, default=2000)
+    parser.add_argument("--output-dir", default="gpt_output")
+    args = parser.parse_args()
+
+    topic_list = pd.read_csv("btc_topics.csv")['Topics'].to_list()
+    model = get_embedding_model()
+    topic_embeddings = TopicEmbeddings.load_or_build(TOPIC_EMBEDDINGS_PATH, topic_list, model)
+
+    labels = load_gpt_output_labels(args.output_dir)
+    texts = sample_texts(labels, args.sample)
+    source_ids = list(texts)
+    logger.info(f"evaluating on {len(source_ids)} docs")
+
+    doc_vectors = encode_texts(model, [texts[source_id] for source_id in source_ids], batch_size=EMBEDDING_BATCH_SIZE)
+    ranked = topic_embeddings.top_k(doc_vectors, max(TOP_KS))
+
+    # stored topics outside the current topic list can never be recalled, they are left out
+    topic_set = set(topic_list)
+    doc_labels = [[topic for topic in labels[source_id] if topic in topic_set] for source_id in source_ids]
+    full_list_tokens = len(get_tokenizer().encode(str(topic_list)))
+
+    for k in TOP_KS:
+        hits, total, fully_covered, prompt_tokens = 0, 0, 0, []
+        for row, doc_topics in zip(ranked, doc_labels):
+            candidates = [topic_list[idx] for idx in row[:k]]
+            found = len(set(doc_topics) & set(candidates))
+            hits += found
+            total += len(doc_topics)
+            fully_covered += found == len(doc_topics)
+            prompt_tokens.append(len(get_tokenizer().encode(str(candidates))))
+        logger.info(f"top-{k:>3}: recall: {hits / max(total, 1):.3f}, "
+                    f"docs fully covered: {fully_covered / max(len(doc_labels), 1):.3f}, "
+                    f"topic list tokens: {np.mean(prompt_tokens):.0f} vs {full_list_tokens} for the full list")
@@ -0,0 +1,59 @@
+from loguru import logger
+import os
+from dotenv import load_dotenv
+import warnings
+import numpy as np
+import pandas as pd
+
+from src.config import ES_INDEX, TOPIC_EMBEDDINGS_PATH, TOPIC_CLASSIFIER_PATH, get_embedding_model
+from src.elasticsearch_utils import ElasticSearchClient
+from src.topic_classifier import LocalTopicClassifier, load_gpt_output_labels
+from src.topic_embeddings import TopicEmbeddings
+
+warnings.filterwarnings("ignore")
+load_dotenv()
+
+FIELD_NAME = "summary_vector_embeddings"
+
+if __name__ == "__main__":
+
+    # logs automatically rotate log file
+    os.makedirs("logs", exist_ok=True)
+    logger.add(f"logs/calibrate_topic_classifier.log", rotation="23:59")
+
+    btc_topics_list = pd.read_csv("btc_topics.csv")['Topics'].to_list()
+    topic_embeddings = TopicEmbeddings.load_or_build(TOPIC_EMBEDDINGS_PATH, btc_topics_list, get_embedding_model())
+
+    # the topics GPT generated before are the labels, the stored doc embeddings are the inputs
+    labels = load_gpt_output_labels("gpt_output")
+
+    elastic_search = ElasticSearchClient()
+    query = elastic_search.build_query(must=[{"exists": {"field": FIELD_NAME}}])
+    pages = elastic_search.paginate(es_index=ES_INDEX, query=query, source_includes=["id", FIELD_NAME])
+
+    # vectors are stacked into a float32 array per page instead of being kept as lists of python floats
+    vector_pages, doc_topics = [], []
+    for page in pages:
+        labeled_page = [doc for doc in page if doc['_source'].get('id') in labels]
+        if labeled_page:
+            vector_pages.append(np.asarray([doc['_source'][FIELD_NAME] for doc in labeled_page], dtype=np.float32))
+            doc_topics.extend(labels[doc['_source']['id']] for doc in labeled_page)
+    doc_vectors = np.concatenate(vector_pages) if vector_pages else \
+        np.empty((0, topic_embeddings.matrix.shape[1]), dtype=np.float32)
+    logger.info(f"Labeled docs with embeddings: {len(doc_topics)}")
+
+    # hold out a part of the docs to report how well the calibrated thresholds generalize
+    order = np.random.default_rng(42).permutation(len(doc_topics))
+    split = int(len(order) * 0.8)
+    train_order, test_order = order[:split], order[split:]
+
+    classifier = LocalTopicClassifier.calibrate(topic_embeddings,
+                                                doc_vectors=doc_vectors[train_order],
+                                                doc_topics=[doc_topics[i] for i in train_order])
+    if len(test_order):
+        metrics = classifier.evaluate(doc_vectors=doc_vectors[test_order],
+                                      doc_topics=[doc_topics[i] for i in test_order])
+        logger.info(f"Held out docs: {len(test_order)}, precision: {metrics['precision']:.3f}, "
+                    f"recall: {metrics['recall']:.3f}, f1: {metrics['f1']:.3f}")
+
+    classifier.save(TOPIC_CLASSIFIER_PATH)
@@ -0,0 +1,29 @@
+from loguru import logger
+import glob
+import os
+from dotenv import load_dotenv
+import warnings
+
+from src.topic_storage import convert_csv_to_parquet, has_topics, topic_dataset_dir
+
+warnings.filterwarnings("ignore")
+load_dotenv()
+
+
+if __name__ == "__main__":
+
+    # logs automatically rotate log file
+    os.makedirs("logs", exist_ok=True)
+    logger.add(f"logs/convert_topics_to_parquet.log", rotation="23:59")
+
+    OUTPUT_DIR = "gpt_output"
+    dataset_dir = topic_dataset_dir(OUTPUT_DIR)
+
+    # one-time conversion of the topic modeling csv files into the parquet dataset read and written by the
+    # crons when TOPIC_STORAGE_FORMAT is "parquet". The csv files are kept, sources already in parquet are skipped
+    for csv_file_path in sorted(glob.glob(os.path.join(OUTPUT_DIR, "topic_modeling_*.csv"))):
+        source = os.path.basename(csv_file_path)[len("topic_modeling_"):-len(".csv")]
+        if has_topics(dataset_dir, source):
+            logger.info(f"Source already converted: {source}")
+            continue
+        convert_csv_to_parquet(csv_file_path, dataset_dir, source)
@@ -1,8 +1,8 @@
 from loguru import logger
+import os
 from dotenv import load_dotenv
 import warnings
-import tqdm
-import traceback
+import time
 
 from src.config import ES_INDEX
 from src.utils import convert_to_dataframe, get_duplicated_docs_ids
@@ -11,6 +11,9 @@ from src.elasticsearch_utils import ElasticSearchClient
 warnings.filterwarnings("ignore")
 load_dotenv()
 
+# only the fields used by `convert_to_dataframe` are fetched from elasticsearch, bodies are never transferred
+SOURCE_FIELDS = ["title", "transcript_by", "created_at", "domain", "body_type", "url"]
+
 
 if __name__ == "__main__":
 
@@ -20,26 +23,37 @@ if __name__ == "__main__":
         "https://btctranscripts.com/"
     ]
 
+    # if DRY_RUN is set to True, the docs to drop are only written to a report, nothing is deleted
+    DRY_RUN = False
+    REPORT_DIR = "logs"
+
     for dev_url in dev_urls:
-        docs_list = elastic_search.docs_list = elastic_search.extract_data_from_es(
-            es_index=ES_INDEX, url=dev_url, start_date_str=None, current_date_str=None
+        docs_iter = elastic_search.iter_data_from_es(
+            es_index=ES_INDEX, url=dev_url, start_date_str=None, current_date_str=None,
+            source_includes=SOURCE_FIELDS
         )
-        logger.success(f"TOTAL THREADS RECEIVED FOR {dev_url}: {len(docs_list)}")
+        df = convert_to_dataframe(docs_iter)
+        logger.success(f"TOTAL THREADS RECEIVED FOR {dev_url}: {len(df)}")
 
-        if docs_list:
-            df = convert_to_dataframe(docs_list)
+        if not df.empty:
             ids_to_drop = get_duplicated_docs_ids(df)
 
             if ids_to_drop:
-                for idx, this_id in enumerate(tqdm.tqdm(ids_to_drop)):
-                    try:
-                        res = elastic_search.es_client.delete(
-                            index=ES_INDEX,
-                            id=this_id
-                        )
-                        logger.info(res)
-                    except Exception as ex:
-                        logger.error(f"Error deleting the doc: {traceback.format_exc()}")
+                df_to_drop = df[df['_id'].isin(set(ids_to_drop))]
+                os.makedirs(REPORT_DIR, exist_ok=True)
+                report_path = f"{REPORT_DIR}/drop_duplicates_{dev_url.split('/')[-2]}.csv"
+                df_to_drop.to_csv(report_path, index=False)
+                logger.info(f"{len(ids_to_drop)} docs to drop, report saved at path: {report_path}")
+
+                if DRY_RUN:
+                    logger.info("Dry run, nothing deleted.")
+                else:
+                    start_time = time.time()
+                    deleted, not_found, errors = elastic_search.bulk_delete_docs(
+                        zip(df_to_drop['index'], df_to_drop['_id'])
+                    )
+                    logger.success(f"Deleted: {deleted}, not found: {not_found}, failed: {len(errors)} "
+                                   f"in {time.time() - start_time:.2f} seconds")
         else:
             logger.info(f"NO THREADS RECEIVED FOR {dev_url}")
 
@@ -0,0 +1,106 @@
+from loguru import logger
+import os
+from dotenv import load_dotenv
+import warnings
+import tqdm
+
+from src.config import ES_INDEX, NEAR_DUPLICATE_INDEX_DIR, NEAR_DUPLICATE_THRESHOLD, NEAR_DUPLICATE_MIN_SHINGLES
+from src.elasticsearch_utils import ElasticSearchClient
+from src.near_duplicates import NearDuplicateIndex
+from src.utils import preprocess_emails
+from src.watermark_store import WatermarkStore
+
+warnings.filterwarnings("ignore")
+load_dotenv()
+
+# only these fields are fetched from elasticsearch
+SOURCE_FIELDS = ["id", "title", "domain", "url", "body", "created_at"]
+BATCH_SIZE = 1000
+
+
+def add_docs(near_duplicates, docs):
+    """
+    Index a batch of docs, their bodies are preprocessed in parallel first. The title is kept so the crons
+    only reuse the results of a representative with the same title.
+    """
+    bodies = preprocess_emails([doc['_source'].get('body') or "" for doc in docs])
+    for doc, body in zip(docs, bodies):
+        near_duplicates.add(doc['_source']['id'], body, _id=doc['_id'], _index=doc['_index'],
+                            domain=doc['_source'].get('domain'), url=doc['_source'].get('url'),
+                            title=doc['_source'].get('title'))
+
+
+def index_source(dev_url, elastic_search, near_duplicates, watermark=None, full_sweep=False):
+    """
+    Add the docs of a source to the index.
+    :return: lower bound of the watermark field the docs were fetched with, None for a full sweep
+    """
+    logger.info(f"dev_url: {dev_url}")
+    since = watermark.since(dev_url) if watermark and not full_sweep else None
+    docs_iter = elastic_search.iter_data_from_es(
+        es_index=ES_INDEX, url=dev_url, source_includes=SOURCE_FIELDS, keep_alive='10m', page_size=BATCH_SIZE,
+        since=since, since_field=watermark.field if watermark else "created_at"
+    )
+
+    docs_count = 0
+    indexed_before = len(near_duplicates)
+    batch = []
+    for doc in tqdm.tqdm(docs_iter, desc=dev_url):
+        if not doc['_source'].get('id') or doc['_source']['id'] in near_duplicates:
+            continue
+        docs_count += 1
+        batch.append(doc)
+        if len(batch) >= BATCH_SIZE:
+            add_docs(near_duplicates, batch)
+            batch = []
+    if batch:
+        add_docs(near_duplicates, batch)
+
+    # docs too short to be indexed are fetched again by every full sweep, they are cheap to skip
+    logger.success(f"New docs: {docs_count}, indexed: {len(near_duplicates) - indexed_before} | {dev_url}")
+    return since
+
+
+if __name__ == "__main__":
+
+    # logs automatically rotate log file
+    os.makedirs("logs", exist_ok=True)
+    logger.add(f"logs/find_near_duplicates.log", rotation="23:59")
+
+    elastic_search = ElasticSearchClient()
+
+    # sources are indexed in this order, so the docs of earlier sources become the representatives of
+    # their mirrors, e.g. gnusha.org/pi/bitcoindev mirrors the bitcoin-dev mailing list archive
+    dev_urls = [
+        "https://lists.linuxfoundation.org/pipermail/bitcoin-dev/",
+        "https://lists.linuxfoundation.org/pipermail/lightning-dev/",
+        "https://delvingbitcoin.org/",
+        "https://gnusha.org/pi/bitcoindev/",
+    ]
+
+    # the index is updated incrementally, only docs added since the previous run are fetched
+    near_duplicates = NearDuplicateIndex.load_if_exists(NEAR_DUPLICATE_INDEX_DIR) or \
+        NearDuplicateIndex(threshold=NEAR_DUPLICATE_THRESHOLD, min_shingles=NEAR_DUPLICATE_MIN_SHINGLES)
+    # a new index is built from all docs, whatever the watermark says
+    watermark = WatermarkStore("find_near_duplicates")
+    full_sweep = not len(near_duplicates)
+
+    # sources share the index, so they are processed one after the other
+    since_by_source = {}
+    for dev_url in dev_urls:
+        since_by_source[dev_url] = index_source(dev_url, elastic_search, near_duplicates, watermark=watermark,
+                                                full_sweep=full_sweep)
+    near_duplicates.save(NEAR_DUPLICATE_INDEX_DIR)
+
+    # watermarks only advance once the docs they cover are saved in the index
+    for dev_url, since in since_by_source.items():
+        watermark.commit(dev_url, full_sweep=since is None)
+
+    clusters_df = near_duplicates.clusters_df()
+    if not clusters_df.empty:
+        clusters_df.to_csv(os.path.join(NEAR_DUPLICATE_INDEX_DIR, "clusters.csv"), index=False)
+        cross_domain = clusters_df.groupby("cluster")["domain"].nunique().gt(1).sum()
+        logger.success(f"Docs: {len(near_duplicates)}, clusters: {clusters_df['cluster'].nunique()}, "
+                       f"docs in clusters: {len(clusters_df)}, clusters spanning several sources: {cross_domain}")
+    else:
+        logger.success(f"Docs: {len(near_duplicates)}, no near duplicates found")
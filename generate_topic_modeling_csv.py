@@ -1,4 +1,5 @@
 from datetime import datetime, timedelta
+from itertools import chain
 from loguru import logger
 import os
 from dotenv import load_dotenv
@@ -6,16 +7,230 @@ import warnings
 import tqdm
 import pandas as pd
 import traceback
-import time
 
-from src.config import ES_INDEX
+from src.config import ES_INDEX, TOPIC_PREFILTER_TOP_K, TOPIC_EMBEDDINGS_PATH, TOPIC_MODELING_BACKEND, \
+    TOPIC_CLASSIFIER_PATH, NEAR_DUPLICATE_INDEX_DIR, TOPIC_STORAGE_FORMAT, get_embedding_model, get_topic_cache
 from src.utils import preprocess_email
-from src.elasticsearch_utils import ElasticSearchClient
-from src.gpt_utils import apply_topic_modeling
+from src.elasticsearch_utils import ElasticSearchClient, DomainRouter
+from src.checkpoint_store import TopicCheckpointStore, ParquetTopicCheckpointStore
+from src.gpt_utils import apply_topic_modeling_concurrently
+from src.near_duplicates import NearDuplicateIndex
+from src.orchestration import run_sources_concurrently, group_sources
+from src.topic_classifier import LocalTopicClassifier
+from src.watermark_store import WatermarkStore
+from src.topic_embeddings import TopicEmbeddings, TopicPrefilter
+from src.topic_storage import topic_dataset_dir
 
 warnings.filterwarnings("ignore")
 load_dotenv()
 
+# only these fields are fetched from elasticsearch
+SOURCE_FIELDS = ["id", "title", "summary", "body", "primary_topics", "domain", "created_at"]
+
+
+def iter_docs_for_topic_modeling(routed_docs, topic_stores):
+    """
+    Yield ((domain, doc), text) for every doc that still needs topics, skipping docs already in the topic store
+    of their domain.
+    """
+    for domain, doc in routed_docs:
+        doc_source_id = doc['_source']['id']
+        if doc_source_id in topic_stores[domain]:
+            continue
+
+        doc_id = doc['_id']
+        logger.info(f"_id: {doc_id} | title: {doc['_source']['title']}")
+
+        doc_body = doc['_source'].get('summary', '')
+        if not doc_body:
+            doc_body = doc['_source'].get('body', '')
+            doc_body = preprocess_email(email_body=doc_body)
+
+        if not doc['_source'].get('primary_topics'):
+            doc_text = ""
+            if doc_body:
+                doc_title = doc['_source'].get('title')
+                doc_text = doc_title + "\n" + doc_body
+
+            if doc_text:
+                yield (domain, doc), doc_text
+            else:
+                logger.warning(f"Body Text not found! Doc ID: {doc_id}")
+
+
+def skip_near_duplicates(docs_to_model, near_duplicates, topic_stores, reused_results):
+    """
+    Docs whose near-duplicate representative has the same title and already has topics in one of the topic
+    stores are not yielded for topic modeling, the topics of the representative are added to `reused_results`.
+    """
+    for (domain, doc), doc_text in docs_to_model:
+        doc_source_id = doc['_source']['id']
+        representative = near_duplicates.reusable_representative(doc_source_id, doc['_source'].get('title'))
+        if representative:
+            for topic_store in topic_stores.values():
+                topics = topic_store.get(representative)
+                if topics:
+                    logger.info(f"Reusing the topics of near duplicate: {representative} | {doc_source_id}")
+                    reused_results.append(((domain, doc), topics[0], topics[1], None))
+                    break
+            else:
+                yield (domain, doc), doc_text
+        else:
+            yield (domain, doc), doc_text
+
+
+def get_dev_name(dev_url):
+    return "all_data" if dev_url == "all_data" else dev_url.split("/")[-2]
+
+
+def generate_topics_for_source(dev_url, elastic_search, topic_list, apply_date_range=False,
+                               update_es_simultaneously=False, save_csv=True, output_dir="gpt_output",
+                               topic_prefilter=None, topic_classifier=None, watermark=None, near_duplicates=None,
+                               storage_format="csv"):
+    """
+    Generate topics for the docs of a source that don't have them yet.
+    :param dev_url: str, or a list of urls that are fetched with a single query and routed back per domain.
+        "all_data" fetches all docs, those that don't belong to any of the other urls are stored under it
+    :param update_es_simultaneously: bool, update topics in the elasticsearch docs as we generate them
+    :param save_csv: bool, store generated topics data into the csv file of the source
+    :param topic_prefilter: TopicPrefilter, only the topics closest to a doc are sent in its prompt if given
+    :param topic_classifier: LocalTopicClassifier, topics are assigned locally instead of by GPT if given
+    :param watermark: WatermarkStore, only docs added since the previous successful run are fetched if given
+    :param near_duplicates: NearDuplicateIndex, docs reuse the topics of their near-duplicate representative
+    :param storage_format: str, "csv" or "parquet", see TOPIC_STORAGE_FORMAT
+    """
+    dev_urls = dev_url if isinstance(dev_url, list) else [dev_url]
+    domains = [url for url in dev_urls if url != "all_data"]
+    fallback = "all_data" if "all_data" in dev_urls else None
+    query_url = None if fallback else domains
+
+    logger.info(f"dev_url: {dev_url}")
+    logger.info(f"dev_name: {[get_dev_name(url) for url in dev_urls]}")
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    # if apply_date_range is set to False, elasticsearch will fetch all the docs in the index
+    if apply_date_range:
+        current_date_str = None
+        if not current_date_str:
+            current_date_str = datetime.now().strftime("%Y-%m-%d")
+        start_date = datetime.now() - timedelta(days=7)
+        start_date_str = start_date.strftime("%Y-%m-%d")
+        logger.info(f"start_date: {start_date_str}")
+        logger.info(f"current_date_str: {current_date_str}")
+    else:
+        start_date_str = None
+        current_date_str = None
+
+    # with a watermark, only the docs added since the previous run and the docs it failed on are fetched
+    since = watermark.since(dev_urls) if watermark and not apply_date_range else None
+    since_ids = watermark.failed_ids(dev_urls) if since else None
+
+    # topics are appended to a checkpoint per source as they are generated and merged into its csv,
+    # or written to its parquet partitions, once at the end
+    csv_file_paths = {url: f"{output_dir}/topic_modeling_{get_dev_name(url)}.csv" for url in dev_urls}
+    if storage_format == "parquet":
+        topic_stores = {url: ParquetTopicCheckpointStore(topic_dataset_dir(output_dir), get_dev_name(url),
+                                                         csv_path=csv_file_path)
+                        for url, csv_file_path in csv_file_paths.items()}
+    else:
+        topic_stores = {url: TopicCheckpointStore(csv_file_path) for url, csv_file_path in csv_file_paths.items()}
+
+    # docs are streamed page by page, so topic modeling starts as soon as the first page arrives.
+    # GPT calls are slow, so pages are kept small and the point in time is kept alive long enough
+    # to process a whole page before the next one is requested
+    # the local classifier reuses the stored doc embeddings, only docs without one are encoded
+    source_includes = SOURCE_FIELDS + ["summary_vector_embeddings"] if topic_classifier else SOURCE_FIELDS
+    docs_iter = elastic_search.iter_data_for_empty_field(
+        es_index=ES_INDEX, url=query_url, field_name="primary_topics",
+        start_date_str=start_date_str, current_date_str=current_date_str,
+        source_includes=source_includes, keep_alive='60m', page_size=500,
+        since=since, since_field=watermark.field if watermark else "created_at", since_ids=since_ids
+    )
+
+    bulk_writer = elastic_search.bulk_writer()
+    router = DomainRouter(domains, fallback=fallback)
+    progress = tqdm.tqdm(router.route(docs_iter), desc=str([get_dev_name(url) for url in dev_urls]))
+    docs_to_model = iter_docs_for_topic_modeling(progress, topic_stores)
+    reused_results = []
+    if near_duplicates:
+        docs_to_model = skip_near_duplicates(docs_to_model, near_duplicates, topic_stores, reused_results)
+    if topic_classifier:
+        # topics are assigned in batches from the similarity with the topic embeddings, no GPT calls are made
+        topic_modeling_results = topic_classifier.classify(
+            ((key, text, key[1]['_source'].get('summary_vector_embeddings')) for key, text in docs_to_model),
+            model=get_embedding_model()
+        )
+    else:
+        if topic_prefilter:
+            docs_to_model = topic_prefilter.iter_with_candidate_topics(docs_to_model)
+
+        # documents and their chunks are sent to GPT concurrently, results arrive in completion order
+        topic_modeling_results = apply_topic_modeling_concurrently(items=docs_to_model, topic_list=topic_list)
+
+    # reused topics are stored once all the other docs are done, the list is complete by then
+    for (domain, doc), primary_kw, secondary_kw, error in chain(topic_modeling_results, reused_results):
+        topic_store = topic_stores[domain]
+        doc_source_id = doc['_source']['id']
+        doc_id = doc['_id']
+        doc_index = doc['_index']
+
+        try:
+            if error:
+                raise error
+
+            if save_csv and not update_es_simultaneously:
+                topic_store.append(primary_kw, secondary_kw, doc_source_id, doc['_source'].get('created_at'))
+
+            elif update_es_simultaneously and not save_csv:
+                # update primary and secondary keywords with a single buffered bulk action
+                bulk_writer.update(doc_index, doc_id, {
+                    "primary_topics": primary_kw if primary_kw else [],
+                    "secondary_topics": secondary_kw if secondary_kw else []
+                })
+
+            elif save_csv and update_es_simultaneously:
+                # update primary and secondary keywords with a single buffered bulk action
+                bulk_writer.update(doc_index, doc_id, {
+                    "primary_topics": primary_kw if primary_kw else [],
+                    "secondary_topics": secondary_kw if secondary_kw else []
+                })
+
+                # store in csv file
+                topic_store.append(primary_kw, secondary_kw, doc_source_id, doc['_source'].get('created_at'))
+
+            else:  # not save_csv and not update_es_simultaneously
+                pass
+
+        except Exception as ex:
+            logger.error(f"Error: apply_topic_modeling: {str(ex)}\n{traceback.format_exc()}")
+            if watermark:
+                watermark.fail(domain, [doc_id])
+
+    docs_count = progress.n
+    bulk_writer.close()
+    router.log_counts("Threads received with an empty field - 'primary_topics'")
+    if watermark:
+        # flushes don't raise, every doc of a rejected item or of a request that failed is in failed_ids. Its
+        # domain isn't known, it is fetched again with all the sources of the query
+        watermark.fail(dev_urls, bulk_writer.failed_ids)
+        watermark.commit(dev_urls, full_sweep=since is None)
+    logger.success(f"TOTAL THREADS RECEIVED WITH AN EMPTY FIELD - 'primary_topics': {docs_count} | {dev_url}")
+
+    for url, topic_store in topic_stores.items():
+        topic_store.compact()
+        topic_store.close()
+        if storage_format == "parquet":
+            logger.success(f"FINAL TOPICS SAVED AT PATH: {topic_dataset_dir(output_dir)}/source={get_dev_name(url)}")
+        else:
+            logger.success(f"FINAL CSV FILE SAVED AT PATH: {csv_file_paths[url]}")
+
+    topic_cache = get_topic_cache()
+    if topic_cache is not None:
+        topic_cache.log_stats()
+    logger.info(f"Process completed for dev_url: {dev_url}")
+    return docs_count
+
 
 if __name__ == "__main__":
 
@@ -23,7 +238,6 @@ if __name__ == "__main__":
     os.makedirs("logs", exist_ok=True)
     logger.add(f"logs/generate_topics_modeling.log", rotation="23:59")
 
-    delay = 3
     btc_topics_list = pd.read_csv("btc_topics.csv")
     btc_topics_list = btc_topics_list['Topics'].to_list()
 
@@ -37,180 +251,44 @@ if __name__ == "__main__":
         # "all_data", # uncomment this line if you want to generate topic modeling on all docs
     ]
 
-    for dev_url in dev_urls:
-
-        if dev_url == "all_data":
-            dev_name = "all_data"
-            dev_url = None
-        else:
-            dev_name = dev_url.split("/")[-2]
-
-        logger.info(f"dev_url: {dev_url}")
-        logger.info(f"dev_name: {dev_name}")
-
-        # if APPLY_DATE_RANGE is set to False, elasticsearch will fetch all the docs in the index
-        APPLY_DATE_RANGE = False
-
-        # if UPDATE_ES_SIMULTANEOUSLY set to True, it will update topics in the elasticsearch docs as we generate them
-        UPDATE_ES_SIMULTANEOUSLY = False
+    # if APPLY_DATE_RANGE is set to False, elasticsearch will fetch all the docs in the index
+    APPLY_DATE_RANGE = False
 
-        # if SAVE_CSV is set to True, it will store generated topics data into csv file
-        SAVE_CSV = True
-        SAVE_AT_MULTIPLE_OF = 50
+    # if UPDATE_ES_SIMULTANEOUSLY set to True, it will update topics in the elasticsearch docs as we generate them
+    UPDATE_ES_SIMULTANEOUSLY = False
 
-        OUTPUT_DIR = "gpt_output"
-        os.makedirs(OUTPUT_DIR, exist_ok=True)
+    # if SAVE_CSV is set to True, it will store generated topics data into csv file
+    SAVE_CSV = True
 
-        CSV_FILE_PATH = f"{OUTPUT_DIR}/topic_modeling_{dev_name}.csv"
+    OUTPUT_DIR = "gpt_output"
 
-        if APPLY_DATE_RANGE:
-            current_date_str = None
-            if not current_date_str:
-                current_date_str = datetime.now().strftime("%Y-%m-%d")
-            start_date = datetime.now() - timedelta(days=7)
-            start_date_str = start_date.strftime("%Y-%m-%d")
-            logger.info(f"start_date: {start_date_str}")
-            logger.info(f"current_date_str: {current_date_str}")
+    # if TOPIC_MODELING_BACKEND is "local", topics are assigned by the classifier calibrated with
+    # calibrate_topic_classifier.py. Otherwise, if TOPIC_PREFILTER_TOP_K is set, only the closest topics
+    # by embedding are sent to GPT for each doc
+    topic_prefilter = None
+    topic_classifier = None
+    if TOPIC_MODELING_BACKEND == "local" or TOPIC_PREFILTER_TOP_K:
+        topic_embeddings = TopicEmbeddings.load_or_build(TOPIC_EMBEDDINGS_PATH, btc_topics_list, get_embedding_model())
+        if TOPIC_MODELING_BACKEND == "local":
+            topic_classifier = LocalTopicClassifier.load(TOPIC_CLASSIFIER_PATH, topic_embeddings)
         else:
-            start_date_str = None
-            current_date_str = None
-
-        docs_list = elastic_search.fetch_data_for_empty_field(
-            es_index=ES_INDEX, url=dev_url, field_name="primary_topics",
-            start_date_str=start_date_str, current_date_str=current_date_str
-        )
-        logger.success(f"TOTAL THREADS RECEIVED WITH AN EMPTY FIELD - 'primary_topics': {len(docs_list)}")
-
-        if docs_list:
-            if os.path.exists(CSV_FILE_PATH):
-                stored_df = pd.read_csv(CSV_FILE_PATH)
-                logger.info(f"Shape of stored df: {stored_df.shape}")
-
-                stored_source_ids = stored_df['source_id'].to_list()
-                logger.info(f"Docs in stored df: {len(stored_source_ids)}")
-            else:
-                logger.info(f"CSV file path does not exist! Creating new one: {CSV_FILE_PATH}")
-                stored_df = pd.DataFrame(columns=['primary_topics', 'secondary_topics', 'source_id'])
-                stored_source_ids = stored_df['source_id'].to_list()
-
-            for idx, doc in enumerate(tqdm.tqdm(docs_list)):
-                doc_source_id = doc['_source']['id']
-
-                if CSV_FILE_PATH:
-                    if doc_source_id in stored_source_ids:
-                        continue
-
-                doc_id = doc['_id']
-                doc_index = doc['_index']
-                logger.info(f"_id: {doc_id} | title: {doc['_source']['title']}")
-
-                doc_body = doc['_source'].get('summary', '')
-                if not doc_body:
-                    doc_body = doc['_source'].get('body', '')
-                    doc_body = preprocess_email(email_body=doc_body)
-
-                if not doc['_source'].get('primary_topics'):
-                    doc_text = ""
-                    if doc_body:
-                        doc_title = doc['_source'].get('title')
-                        doc_text = doc_title + "\n" + doc_body
-
-                    if doc_text:
-                        primary_kw, secondary_kw = [], []
-                        try:
-                            primary_kw, secondary_kw = apply_topic_modeling(text=doc_text, topic_list=btc_topics_list)
-
-                            if SAVE_CSV and not UPDATE_ES_SIMULTANEOUSLY:
-                                row_data = {
-                                    'primary_topics': primary_kw if primary_kw else [],
-                                    'secondary_topics': secondary_kw if secondary_kw else [],
-                                    'source_id': doc_source_id if doc_source_id else None
-                                }
-                                row_data = pd.Series(row_data).to_frame().T
-                                stored_df = pd.concat([stored_df, row_data], ignore_index=True)
-
-                                if idx % SAVE_AT_MULTIPLE_OF == 0:
-                                    stored_df.drop_duplicates(subset='source_id', keep='first', inplace=True)
-                                    stored_df.to_csv(CSV_FILE_PATH, index=False)
-                                    time.sleep(delay)
-                                    logger.info(f"csv file saved at IDX: {idx}, PATH: {CSV_FILE_PATH}")
-
-                            elif UPDATE_ES_SIMULTANEOUSLY and not SAVE_CSV:
-                                # update primary keyword
-                                elastic_search.es_client.update(
-                                    index=doc_index,
-                                    id=doc_id,
-                                    body={
-                                        'doc': {
-                                            "primary_topics": primary_kw if primary_kw else []
-                                        }
-                                    }
-                                )
-                                # update secondary keyword
-                                elastic_search.es_client.update(
-                                    index=doc_index,
-                                    id=doc_id,
-                                    body={
-                                        'doc': {
-                                            "secondary_topics": secondary_kw if secondary_kw else []
-                                        }
-                                    }
-                                )
-
-                            elif SAVE_CSV and UPDATE_ES_SIMULTANEOUSLY:
-                                # update primary keyword
-                                elastic_search.es_client.update(
-                                    index=doc_index,
-                                    id=doc_id,
-                                    body={
-                                        'doc': {
-                                            "primary_topics": primary_kw if primary_kw else []
-                                        }
-                                    }
-                                )
-                                # update secondary keyword
-                                elastic_search.es_client.update(
-                                    index=doc_index,
-                                    id=doc_id,
-                                    body={
-                                        'doc': {
-                                            "secondary_topics": secondary_kw if secondary_kw else []
-                                        }
-                                    }
-                                )
-
-                                # store in csv file
-                                row_data = {
-                                    'primary_topics': primary_kw if primary_kw else [],
-                                    'secondary_topics': secondary_kw if secondary_kw else [],
-                                    'source_id': doc_source_id if doc_source_id else None
-                                }
-                                row_data = pd.Series(row_data).to_frame().T
-                                stored_df = pd.concat([stored_df, row_data], ignore_index=True)
-
-                                if idx % SAVE_AT_MULTIPLE_OF == 0:
-                                    stored_df.drop_duplicates(subset='source_id', keep='first', inplace=True)
-                                    stored_df.to_csv(CSV_FILE_PATH, index=False)
-                                    time.sleep(delay)
-                                    logger.info(f"csv file saved at IDX: {idx}, PATH: {CSV_FILE_PATH}")
-
-                            else:  # not SAVE_CSV and not UPDATE_ES_SIMULTANEOUSLY
-                                pass
-
-                        except Exception as ex:
-                            logger.error(f"Error: apply_topic_modeling: {str(ex)}\n{traceback.format_exc()}")
-
-                            stored_df.drop_duplicates(subset='source_id', keep='first', inplace=True)
-                            stored_df.to_csv(CSV_FILE_PATH, index=False)
-                            time.sleep(delay)
-                            logger.info(f"csv file saved at IDX: {idx}, PATH: {CSV_FILE_PATH}")
-
-                    else:
-                        logger.warning(f"Body Text not found! Doc ID: {doc_id}")
-
-            stored_df.drop_duplicates(subset='source_id', keep='first', inplace=True)
-            stored_df.to_csv(CSV_FILE_PATH, index=False)
-            time.sleep(delay)
-            logger.success(f"FINAL CSV FILE SAVED AT PATH: {CSV_FILE_PATH}")
-
-        logger.info(f"Process completed for dev_url: {dev_url}")
+            topic_prefilter = TopicPrefilter(topic_embeddings, get_embedding_model(), top_k=TOPIC_PREFILTER_TOP_K)
+
+    # if USE_WATERMARK is set to True, only docs added since the previous successful run are fetched,
+    # with a full sweep every FULL_SWEEP_INTERVAL_DAYS. It is ignored if APPLY_DATE_RANGE is set
+    USE_WATERMARK = True
+    watermark = WatermarkStore("generate_topic_modeling_csv") if USE_WATERMARK else None
+
+    # if REUSE_NEAR_DUPLICATES is set to True, docs reuse the topics of their near-duplicate representative,
+    # see find_near_duplicates.py
+    REUSE_NEAR_DUPLICATES = True
+    near_duplicates = NearDuplicateIndex.load_if_exists(NEAR_DUPLICATE_INDEX_DIR) if REUSE_NEAR_DUPLICATES else None
+
+    # sources in a group are fetched with a single query and routed back per domain, see SOURCES_PER_QUERY.
+    # Groups are processed concurrently and share the rate limiters, a failing group doesn't stop the others
+    run_sources_concurrently(group_sources(dev_urls), generate_topics_for_source,
+                             elastic_search=elastic_search, topic_list=btc_topics_list,
+                             apply_date_range=APPLY_DATE_RANGE, update_es_simultaneously=UPDATE_ES_SIMULTANEOUSLY,
+                             save_csv=SAVE_CSV, output_dir=OUTPUT_DIR, topic_prefilter=topic_prefilter,
+                             topic_classifier=topic_classifier, watermark=watermark,
+                             near_duplicates=near_duplicates, storage_format=TOPIC_STORAGE_FORMAT)
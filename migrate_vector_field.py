@@ -0,0 +1,79 @@
+from loguru import logger
+import os
+import sys
+import time
+from dotenv import load_dotenv
+import warnings
+
+from src.config import ES_INDEX, VECTOR_DIMS, VECTOR_SIMILARITY, VECTOR_INDEX_TYPE, VECTOR_MIGRATION_FIELD
+from src.elasticsearch_utils import ElasticSearchClient
+
+warnings.filterwarnings("ignore")
+load_dotenv()
+
+SOURCE_FIELD = "summary_vector_embeddings"
+
+
+def count_remaining(elastic_search, source_field, target_field):
+    return elastic_search.count_docs(ES_INDEX, elastic_search.build_query(
+        must=[{"exists": {"field": source_field}}], missing_field=target_field
+    ))
+
+
+def wait_for_task(elastic_search, task_id, poll_seconds):
+    """Log the progress of the copy task until it is done, return its final response."""
+    while True:
+        task = elastic_search.get_task(task_id)
+        status = task.get("task", {}).get("status", {})
+        logger.info(f"Progress: {status.get('updated', 0)}/{status.get('total', 0)} docs copied, "
+                    f"conflicts: {status.get('version_conflicts', 0)}, "
+                    f"throttled: {status.get('requests_per_second', -1)} docs/s")
+        if task.get("completed"):
+            return task.get("response", {})
+        time.sleep(poll_seconds)
+
+
+if __name__ == "__main__":
+
+    # logs automatically rotate log file
+    os.makedirs("logs", exist_ok=True)
+    logger.add(f"logs/migrate_vector_field.log", rotation="23:59")
+
+    # the mapping of an existing dense_vector can't be made indexed, so the vectors are copied into a new
+    # indexed field while the old one keeps serving reads. Set VECTOR_MIGRATION_FIELD to the same name for the
+    # crons, so vectors of new docs are written to both fields meanwhile and knn searches switch to it
+    TARGET_FIELD = VECTOR_MIGRATION_FIELD or f"{SOURCE_FIELD}_{VECTOR_INDEX_TYPE}"
+
+    # docs updated per second, keeps the cluster responsive while the vectors are copied and indexed
+    REQUESTS_PER_SECOND = 50
+    POLL_SECONDS = 60
+
+    # if TASK_ID is set, the progress of an already running copy task is followed instead of starting a new one
+    TASK_ID = None
+
+    elastic_search = ElasticSearchClient()
+
+    expected_mapping = elastic_search.vector_field_mapping(dims=VECTOR_DIMS, similarity=VECTOR_SIMILARITY,
+                                                           index_type=VECTOR_INDEX_TYPE)
+    mapping = elastic_search.get_field_mapping(ES_INDEX, TARGET_FIELD)
+    if mapping is None:
+        elastic_search.add_vector_field(ES_INDEX, TARGET_FIELD, dims=VECTOR_DIMS, similarity=VECTOR_SIMILARITY,
+                                        index_type=VECTOR_INDEX_TYPE)
+    elif any(mapping.get(key) != value for key, value in expected_mapping.items() if key != "index_options") or \
+            mapping.get("index_options", {}).get("type") != VECTOR_INDEX_TYPE:
+        logger.error(f"'{TARGET_FIELD}' is already mapped differently: {mapping}, expected: {expected_mapping}")
+        sys.exit(1)
+
+    logger.info(f"Docs left to copy: {count_remaining(elastic_search, SOURCE_FIELD, TARGET_FIELD)}")
+    task_id = TASK_ID or elastic_search.copy_field(ES_INDEX, SOURCE_FIELD, TARGET_FIELD,
+                                                   requests_per_second=REQUESTS_PER_SECOND)
+    response = wait_for_task(elastic_search, task_id, POLL_SECONDS)
+
+    for failure in response.get("failures", []):
+        logger.error(f"Copy failed: {failure}")
+    remaining = count_remaining(elastic_search, SOURCE_FIELD, TARGET_FIELD)
+    if remaining:
+        logger.warning(f"Docs left to copy: {remaining}, run the migration again to copy them")
+    else:
+        logger.success(f"All vectors of '{SOURCE_FIELD}' copied to '{TARGET_FIELD}' "
+                       f"({VECTOR_SIMILARITY}, {VECTOR_INDEX_TYPE})")
@@ -4,16 +4,124 @@ import os
 from dotenv import load_dotenv
 import warnings
 import tqdm
-import pandas as pd
 import traceback
-import ast
 
-from src.config import ES_INDEX
-from src.elasticsearch_utils import ElasticSearchClient
+from src.config import ES_INDEX, TOPIC_STORAGE_FORMAT
+from src.elasticsearch_utils import ElasticSearchClient, DomainRouter
+from src.orchestration import run_sources_concurrently, group_sources
+from src.topic_lookup import TopicLookup
+from src.topic_storage import has_topics, topic_dataset_dir
+from src.watermark_store import WatermarkStore
 
 warnings.filterwarnings("ignore")
 load_dotenv()
 
+# only these fields are fetched from elasticsearch
+SOURCE_FIELDS = ["id", "title", "primary_topics", "domain"]
+
+
+def load_stored_topics(dev_url, output_dir="gpt_output", storage_format=TOPIC_STORAGE_FORMAT):
+    dev_name = dev_url.split("/")[-2]
+    csv_file_path = f"{output_dir}/topic_modeling_{dev_name}.csv"
+
+    if storage_format == "parquet" and has_topics(topic_dataset_dir(output_dir), dev_name):
+        return TopicLookup.from_parquet(topic_dataset_dir(output_dir), dev_name)
+    if os.path.exists(csv_file_path):
+        # topics are parsed once here, so every doc below is a single dict lookup
+        return TopicLookup.from_csv(csv_file_path)
+    logger.info(f"No data found in parquet or CSV! Path: {csv_file_path}")
+    return None
+
+
+def push_topics_for_source(dev_url, elastic_search, apply_date_range=False, watermark=None):
+    """
+    :param dev_url: str, or a list of urls that are fetched with a single query and routed back per domain
+    :param watermark: WatermarkStore, only docs added since the previous successful run are fetched if given
+    """
+    logger.info(f"dev_url: {dev_url}")
+    dev_urls = dev_url if isinstance(dev_url, list) else [dev_url]
+
+    stored_topics_by_source = {}
+    for url in dev_urls:
+        stored_topics = load_stored_topics(url)
+        if stored_topics is not None:
+            stored_topics_by_source[url] = stored_topics
+    if not stored_topics_by_source:
+        return
+
+    # if apply_date_range is set to False, elasticsearch will fetch all the docs in the index
+    if apply_date_range:
+        current_date_str = None
+        if not current_date_str:
+            current_date_str = datetime.now().strftime("%Y-%m-%d")
+        start_date = datetime.now() - timedelta(days=7)
+        start_date_str = start_date.strftime("%Y-%m-%d")
+        logger.info(f"start_date: {start_date_str}")
+        logger.info(f"current_date_str: {current_date_str}")
+    else:
+        start_date_str = None
+        current_date_str = None
+
+    # with a watermark, only the docs added since the previous run and the docs it failed on are fetched
+    since = watermark.since(list(stored_topics_by_source)) if watermark and not apply_date_range else None
+    since_ids = watermark.failed_ids(list(stored_topics_by_source)) if since else None
+
+    # only the sources that have a csv are fetched
+    router = DomainRouter(list(stored_topics_by_source))
+    docs_iter = elastic_search.iter_data_for_empty_field(
+        es_index=ES_INDEX, url=list(stored_topics_by_source), field_name=["primary_topics", "secondary_topics"],
+        start_date_str=start_date_str, current_date_str=current_date_str,
+        source_includes=SOURCE_FIELDS, since=since, since_field=watermark.field if watermark else "created_at",
+        since_ids=since_ids
+    )
+
+    docs_count = 0
+    bulk_writer = elastic_search.bulk_writer()
+    for domain, doc in tqdm.tqdm(router.route(docs_iter), desc=str(dev_url)):
+        docs_count += 1
+        stored_topics = stored_topics_by_source[domain]
+        doc_source_id = doc['_source']['id']
+        doc_id = doc['_id']
+        doc_index = doc['_index']
+        logger.info(f"working on document with '_id': {doc_id} | 'title': {doc['_source']['title']}")
+
+        if not doc['_source'].get('primary_topics'):
+            try:
+                stored = stored_topics.get(doc_source_id)
+
+                if stored is not None:
+                    primary_kw, secondary_kw = stored
+
+                    # update primary and secondary topics with a single buffered bulk action
+                    bulk_writer.update(doc_index, doc_id, {
+                        "primary_topics": primary_kw if primary_kw else [],
+                        "secondary_topics": secondary_kw if secondary_kw else []
+                    })
+                else:
+                    logger.error(f"Error Occurred: doc_source_id does not exist in stored topics! "
+                                 f"doc_source_id: {doc_source_id}")
+                    # fetched again next run, its topics may have been generated by then
+                    if watermark:
+                        watermark.fail(domain, [doc_id])
+
+            except Exception as ex:
+                logger.error(f"Error updating ES index:{str(ex)}\n{traceback.format_exc()}")
+                if watermark:
+                    watermark.fail(domain, [doc_id])
+        else:
+            logger.info(f"Exist: {doc['_source'].get('primary_topics')}")
+
+    bulk_writer.close()
+
+    router.log_counts("Threads received with an empty ['primary_topics', 'secondary_topics']")
+    if watermark:
+        # flushes don't raise, every doc of a rejected item or of a request that failed is in failed_ids. Its
+        # domain isn't known, it is fetched again with all the sources of the query
+        watermark.fail(list(stored_topics_by_source), bulk_writer.failed_ids)
+        watermark.commit(list(stored_topics_by_source), full_sweep=since is None)
+    logger.success(f"TOTAL THREADS RECEIVED WITH AN EMPTY ['primary_topics', 'secondary_topics']: {docs_count}")
+    logger.success(f"Process complete for dev_url: {dev_url}")
+
 
 if __name__ == "__main__":
 
@@ -21,7 +129,6 @@ if __name__ == "__main__":
     os.makedirs("logs", exist_ok=True)
     logger.add(f"logs/push_topic_modeling_to_es.log", rotation="23:59")
 
-    delay = 3
     elastic_search = ElasticSearchClient()
 
     dev_urls = [
@@ -31,87 +138,16 @@ if __name__ == "__main__":
         "https://gnusha.org/pi/bitcoindev/",
     ]
 
-    for dev_url in dev_urls:
-        logger.info(f"dev_url: {dev_url}")
-        dev_name = dev_url.split("/")[-2]
+    # if APPLY_DATE_RANGE is set to False, elasticsearch will fetch all the docs in the index
+    APPLY_DATE_RANGE = False
 
-        # if APPLY_DATE_RANGE is set to False, elasticsearch will fetch all the docs in the index
-        APPLY_DATE_RANGE = False
+    # if USE_WATERMARK is set to True, only docs added since the previous successful run are fetched,
+    # with a full sweep every FULL_SWEEP_INTERVAL_DAYS. It is ignored if APPLY_DATE_RANGE is set
+    USE_WATERMARK = True
+    watermark = WatermarkStore("push_topic_modeling_to_es") if USE_WATERMARK else None
 
-        OUTPUT_DIR = "gpt_output"
-        CSV_FILE_PATH = f"{OUTPUT_DIR}/topic_modeling_{dev_name}.csv"
-
-        if os.path.exists(CSV_FILE_PATH):
-            stored_df = pd.read_csv(CSV_FILE_PATH)
-            logger.info(f"Shape of stored df: {stored_df.shape}")
-            stored_df.set_index("source_id", inplace=True)
-        else:
-            logger.info(f"No data found in CSV! Path: {CSV_FILE_PATH}")
-            continue
-
-        if APPLY_DATE_RANGE:
-            current_date_str = None
-            if not current_date_str:
-                current_date_str = datetime.now().strftime("%Y-%m-%d")
-            start_date = datetime.now() - timedelta(days=7)
-            start_date_str = start_date.strftime("%Y-%m-%d")
-            logger.info(f"start_date: {start_date_str}")
-            logger.info(f"current_date_str: {current_date_str}")
-        else:
-            start_date_str = None
-            current_date_str = None
-
-        docs_list = elastic_search.fetch_data_for_empty_field(
-            es_index=ES_INDEX, url=dev_url, field_name=["primary_topics", "secondary_topics"],
-            start_date_str=start_date_str, current_date_str=current_date_str
-        )
-        logger.success(f"TOTAL THREADS RECEIVED WITH AN EMPTY ['primary_topics', 'secondary_topics']: {len(docs_list)}")
-
-        if docs_list:
-            for idx, doc in enumerate(tqdm.tqdm(docs_list)):
-                doc_source_id = doc['_source']['id']
-                doc_id = doc['_id']
-                doc_index = doc['_index']
-                logger.info(f"working on document with '_id': {doc_id} | 'title': {doc['_source']['title']}")
-
-                if not doc['_source'].get('primary_topics'):
-                    try:
-                        this_row = stored_df.loc[doc_source_id]
-
-                        if not this_row.empty:
-                            primary_kw = ast.literal_eval(this_row['primary_topics'])
-                            secondary_kw = ast.literal_eval(this_row['secondary_topics'])
-
-                            # update a primary topic
-                            elastic_search.es_client.update(
-                                index=doc_index,
-                                id=doc_id,
-                                body={
-                                    'doc': {
-                                        "primary_topics": primary_kw if primary_kw else []
-                                    }
-                                }
-                            )
-
-                            # update a secondary topic
-                            elastic_search.es_client.update(
-                                index=doc_index,
-                                id=doc_id,
-                                body={
-                                    'doc': {
-                                        "secondary_topics": secondary_kw if secondary_kw else []
-                                    }
-                                }
-                            )
-                        else:
-                            logger.info(f"No data found for this doc in csv! Doc Id: {doc_id}, Source Id: {doc_source_id}")
-
-                    except KeyError:
-                        logger.error(f"Error Occurred: doc_source_id does not exist in stored_df! doc_source_id: {doc_source_id}")
-
-                    except Exception as ex:
-                        logger.error(f"Error updating ES index:{str(ex)}\n{traceback.format_exc()}")
-                else:
-                    logger.info(f"Exist: {doc['_source'].get('primary_topics')}")
 
-        logger.success(f"Process complete for dev_url: {dev_url}")
+    # sources in a group are fetched with a single query and routed back per domain, see SOURCES_PER_QUERY.
+    # Groups are processed concurrently and share the rate limiters, a failing group doesn't stop the others
+    run_sources_concurrently(group_sources(dev_urls), push_topics_for_source,
+                             elastic_search=elastic_search, apply_date_range=APPLY_DATE_RANGE, watermark=watermark)
@@ -3,8 +3,9 @@ from dotenv import load_dotenv
 import warnings
 import traceback
 from loguru import logger
-from src.config import ES_INDEX, EMBEDDING_MODEL
+from src.config import ES_INDEX, VECTOR_MIGRATION_FIELD, get_embedding_model
 from src.elasticsearch_utils import ElasticSearchClient
+from src.vector_index import LocalVectorIndex
 
 warnings.filterwarnings("ignore")
 load_dotenv()
@@ -15,18 +16,44 @@ if __name__ == "__main__":
     os.makedirs("logs", exist_ok=True)
     logger.add(f"logs/query_es_embedding_vectors.py.log", rotation="23:59")
 
+    # 'script_score': exact brute-force cosine similarity over every doc in the index
+    # 'knn': approximate search with ES native knn, requires an indexed dense_vector field, see migrate_vector_field.py
+    # 'local': approximate search with an HNSW index built from the exported vectors and persisted to disk
+    SEARCH_MODE = "script_score"
+    LOCAL_INDEX_DIR = "vector_index"
+
     elastic_search = ElasticSearchClient()
 
     try:
         question = 'Bitcoin'
 
-        results = elastic_search.compute_similar_docs_with_cosine_similarity(
-            es_index=ES_INDEX,
-            model=EMBEDDING_MODEL,
-            field_name='summary_vector_embeddings',
-            question=question,
-            top_k=3
-        )
+        if SEARCH_MODE == "knn":
+            results = elastic_search.compute_similar_docs_with_knn(
+                es_index=ES_INDEX,
+                model=get_embedding_model(),
+                field_name=VECTOR_MIGRATION_FIELD or 'summary_vector_embeddings',
+                question=question,
+                top_k=3
+            )
+        elif SEARCH_MODE == "local":
+            if os.path.exists(LOCAL_INDEX_DIR):
+                vector_index = LocalVectorIndex.load(LOCAL_INDEX_DIR)
+            else:
+                vector_index = LocalVectorIndex.build_from_es(
+                    elastic_search=elastic_search, es_index=ES_INDEX, field_name='summary_vector_embeddings'
+                )
+                vector_index.save(LOCAL_INDEX_DIR)
+
+            results = vector_index.compute_similar_docs(elastic_search=elastic_search, model=get_embedding_model(),
+                                                        question=question, top_k=3)
+        else:
+            results = elastic_search.compute_similar_docs_with_cosine_similarity(
+                es_index=ES_INDEX,
+                model=get_embedding_model(),
+                field_name='summary_vector_embeddings',
+                question=question,
+                top_k=3
+            )
 
         for res in results['matches']:
             score = res.get('score')
@@ -0,0 +1,164 @@
+import ast
+import json
+import os
+import pandas as pd
+from loguru import logger
+
+from src.config import TOPIC_MAX_FILES_PER_SOURCE
+from src.topic_storage import has_topics, month_of, read_topic_table, write_topic_rows, \
+    convert_csv_to_parquet, column_to_pylist, compact_topic_files, TOPIC_COLUMNS
+
+
+class TopicCheckpointStore:
+    """
+    Append-only store for generated topics of a single source.
+    Every row is appended to a JSONL checkpoint file as soon as it is produced and the stored `source_id`s
+    are kept in a dict with their topics, so writes, lookups and `get` are O(1). `compact` merges the checkpoint into the csv
+    file once at the end of a run. Rows of a checkpoint left behind by an interrupted run are picked up
+    on the next start.
+    """
+    COLUMNS = ['primary_topics', 'secondary_topics', 'source_id']
+
+    def __init__(self, csv_path, checkpoint_path=None):
+        self._csv_path = csv_path
+        self._checkpoint_path = checkpoint_path or f"{os.path.splitext(csv_path)[0]}.checkpoint.jsonl"
+        # source_id -> (primary_topics, secondary_topics), topics read from the csv are parsed on first access
+        self._topics = {}
+        self._load_stored()
+
+        pending_rows = 0
+        for row in self._read_checkpoint():
+            self._topics[row['source_id']] = (row['primary_topics'], row['secondary_topics'])
+            pending_rows += 1
+        if pending_rows:
+            logger.info(f"Resuming with {pending_rows} rows from checkpoint: {self._checkpoint_path}")
+
+        self._checkpoint_file = open(self._checkpoint_path, "a", encoding="utf-8")
+
+    def _load_stored(self):
+        if os.path.exists(self._csv_path):
+            stored_df = pd.read_csv(self._csv_path).dropna(subset=['source_id'])
+            self._topics.update(zip(stored_df['source_id'],
+                                    zip(stored_df['primary_topics'], stored_df['secondary_topics'])))
+            logger.info(f"Docs in stored csv: {len(self._topics)}")
+        else:
+            logger.info(f"CSV file path does not exist! Creating new one: {self._csv_path}")
+
+    def __contains__(self, source_id):
+        return source_id in self._topics
+
+    def __len__(self):
+        return len(self._topics)
+
+    def get(self, source_id):
+        """(primary_topics, secondary_topics) stored for `source_id`, None if there are none."""
+        topics = self._topics.get(source_id)
+        if topics is None:
+            return None
+        return tuple(ast.literal_eval(kw) if isinstance(kw, str) else (kw if isinstance(kw, list) else [])
+                     for kw in topics)
+
+    def _read_checkpoint(self):
+        if not os.path.exists(self._checkpoint_path):
+            return
+        with open(self._checkpoint_path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line may be cut short if the previous run was killed while writing it
+                    logger.warning(f"Skipping malformed checkpoint line: {line[:100]}")
+
+    def append(self, primary_topics, secondary_topics, source_id, created_at=None):
+        """:param created_at: str, date of the doc, the parquet store keeps its month"""
+        row = {
+            'primary_topics': primary_topics if primary_topics else [],
+            'secondary_topics': secondary_topics if secondary_topics else [],
+            'source_id': source_id if source_id else None,
+            'month': month_of(created_at)
+        }
+        self._checkpoint_file.write(json.dumps(row) + "\n")
+        self._checkpoint_file.flush()
+        self._topics[row['source_id']] = (row['primary_topics'], row['secondary_topics'])
+
+    def compact(self):
+        """Merge the checkpoint rows into the stored topics with a single write and remove the checkpoint."""
+        self._checkpoint_file.close()
+        new_rows = list(self._read_checkpoint())
+        if new_rows:
+            self._write(new_rows)
+
+        if os.path.exists(self._checkpoint_path):
+            os.remove(self._checkpoint_path)
+        self._checkpoint_file = open(self._checkpoint_path, "a", encoding="utf-8")
+
+    def _write(self, new_rows):
+        new_df = pd.DataFrame(new_rows, columns=self.COLUMNS)
+        if os.path.exists(self._csv_path):
+            stored_df = pd.concat([pd.read_csv(self._csv_path), new_df], ignore_index=True)
+        else:
+            stored_df = new_df
+        stored_df.drop_duplicates(subset='source_id', keep='first', inplace=True)
+        stored_df.to_csv(self._csv_path, index=False)
+        logger.success(f"{len(new_rows)} new rows compacted into csv file: {self._csv_path}")
+
+    def close(self):
+        self._checkpoint_file.close()
+        # don't leave an empty checkpoint behind
+        if os.path.exists(self._checkpoint_path) and os.path.getsize(self._checkpoint_path) == 0:
+            os.remove(self._checkpoint_path)
+
+
+class ParquetTopicCheckpointStore(TopicCheckpointStore):
+    """
+    TopicCheckpointStore of a source in the parquet topic dataset, see `src.topic_storage`. `compact` writes the
+    checkpoint rows as a new file of the source instead of rewriting the stored topics, and merges the files of
+    the source into one once there are more than `max_files`.
+    If the source has no parquet data yet, its csv is converted once first.
+    """
+
+    def __init__(self, dataset_dir, source, csv_path=None, checkpoint_path=None,
+                 max_files=TOPIC_MAX_FILES_PER_SOURCE):
+        self._dataset_dir = dataset_dir
+        self._source = source
+        self._max_files = max_files
+        checkpoint_path = checkpoint_path or os.path.join(dataset_dir, f"source={source}.checkpoint.jsonl")
+        os.makedirs(dataset_dir, exist_ok=True)
+        super().__init__(csv_path or "", checkpoint_path=checkpoint_path)
+
+    def _load_stored(self):
+        if not has_topics(self._dataset_dir, self._source) and self._csv_path and os.path.exists(self._csv_path):
+            convert_csv_to_parquet(self._csv_path, self._dataset_dir, self._source)
+
+        table = read_topic_table(self._dataset_dir, sources=[self._source], columns=TOPIC_COLUMNS)
+        if table is None:
+            logger.info(f"No parquet data found! Creating new partition: {self._dataset_dir}/source={self._source}")
+            return
+        for primary_topics, secondary_topics, source_id in zip(*(column_to_pylist(table, name)
+                                                                for name in TOPIC_COLUMNS)):
+            if source_id and source_id not in self._topics:
+                self._topics[source_id] = (primary_topics, secondary_topics)
+        logger.info(f"Docs in stored parquet: {len(self._topics)}")
+
+    def _write(self, new_rows):
+        # rows of docs already stored are left out, the same as drop_duplicates does for the csv
+        stored_ids = set()
+        table = read_topic_table(self._dataset_dir, sources=[self._source], columns=['source_id'])
+        if table is not None:
+            stored_ids.update(column_to_pylist(table, 'source_id'))
+        rows, seen = [], set()
+        for row in new_rows:
+            if row['source_id'] in stored_ids or row['source_id'] in seen:
+                continue
+            seen.add(row['source_id'])
+            rows.append(row)
+        if rows:
+            path = write_topic_rows(self._dataset_dir, self._source, rows)
+            logger.success(f"{len(rows)} new rows written to parquet file: {path}")
+
+    def compact(self):
+        super().compact()
+        compact_topic_files(self._dataset_dir, self._source, max_files=self._max_files)
@@ -1,22 +1,143 @@
-import tiktoken
 import os
+from functools import lru_cache
 import openai
 from dotenv import load_dotenv
-from sentence_transformers import SentenceTransformer
 load_dotenv()
 
-TOKENIZER = tiktoken.get_encoding("cl100k_base")
-EMBEDDING_MODEL = SentenceTransformer('intfloat/e5-large-v2')  # intfloat/e5-large-v2, intfloat/e5-base-v2
+# intfloat/e5-large-v2, intfloat/e5-base-v2
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", 'intfloat/e5-large-v2')
+TOKENIZER_ENCODING = "cl100k_base"
 CHAT_COMPLETION_MODEL = "gpt-3.5-turbo"
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 64))  # No. of docs encoded and written back together
+# "torch" runs the embedding model in PyTorch, "onnx" in ONNX Runtime and "onnx-int8" in ONNX Runtime with weights
+# dynamically quantized to int8. The ONNX exports are made once in EMBEDDING_ONNX_DIR, check them against torch with
+# benchmarks/benchmark_embedding_backends.py before switching
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+EMBEDDING_ONNX_DIR = os.getenv("EMBEDDING_ONNX_DIR", "cache/onnx")
+EMBEDDING_QUANTIZATION = os.getenv("EMBEDDING_QUANTIZATION", "avx2")  # CPU instruction set: avx512_vnni, avx2, arm64
+# vectors of encoded texts are cached by a hash of the model and the text, set EMBEDDING_CACHE_DIR to an empty string
+# to disable it. float32 keeps the vectors exact, so a cache hit writes the same vector to elasticsearch as encoding
+# the text again. float16 halves the size of the cache but hits are rounded, only use it if that doesn't matter
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", "cache/embeddings")
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", 200000))
+EMBEDDING_CACHE_DTYPE = os.getenv("EMBEDDING_CACHE_DTYPE", "float32")
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 OPENAI_ORG_KEY = os.getenv("OPENAI_ORG_KEY")
+OPENAI_API_BASE = os.getenv("OPENAI_API_BASE")  # point to a local fake completion server for testing
+
+OPENAI_REQUESTS_PER_MINUTE = int(os.getenv("OPENAI_REQUESTS_PER_MINUTE", 3500))
+OPENAI_TOKENS_PER_MINUTE = int(os.getenv("OPENAI_TOKENS_PER_MINUTE", 90000))
+OPENAI_MAX_WORKERS = int(os.getenv("OPENAI_MAX_WORKERS", 8))  # No. of docs/chunks sent to GPT concurrently
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", 6))  # retries with exponential backoff on rate limits
+
+# short docs are packed into one topic request of up to this many prompt tokens (e.g. 3500), 0 sends every doc on its own
+TOPIC_PACKING_TOKEN_BUDGET = int(os.getenv("TOPIC_PACKING_TOKEN_BUDGET", 0))
+TOPIC_PACKING_MAX_DOCS = int(os.getenv("TOPIC_PACKING_MAX_DOCS", 8))  # max. no. of docs in one packed request
+
+# only the TOPIC_PREFILTER_TOP_K topics closest to a doc by embedding are sent in its prompt, 0 sends the whole list
+TOPIC_PREFILTER_TOP_K = int(os.getenv("TOPIC_PREFILTER_TOP_K", 0))
+TOPIC_EMBEDDINGS_PATH = os.getenv("TOPIC_EMBEDDINGS_PATH", "cache/topic_embeddings.npz")
+
+# "gpt" sends docs to the chat completion model, "local" assigns topics with the calibrated embedding classifier
+TOPIC_MODELING_BACKEND = os.getenv("TOPIC_MODELING_BACKEND", "gpt")
+TOPIC_CLASSIFIER_PATH = os.getenv("TOPIC_CLASSIFIER_PATH", "cache/topic_classifier.json")
+
+# generated topics are stored in "parquet" (partitioned dataset in gpt_output/topic_modeling/) or "csv" files,
+# sources without parquet data yet are read from their csv. Run convert_topics_to_parquet.py once to convert them
+TOPIC_STORAGE_FORMAT = os.getenv("TOPIC_STORAGE_FORMAT", "parquet")
+# every run adds a parquet file per source, they are rewritten as one once a source has more than this
+TOPIC_MAX_FILES_PER_SOURCE = int(os.getenv("TOPIC_MAX_FILES_PER_SOURCE", 30))
+
+# cache of GPT topic responses, set TOPIC_CACHE_PATH to an empty string to disable it
+TOPIC_CACHE_PATH = os.getenv("TOPIC_CACHE_PATH", "cache/topic_cache.sqlite")
+TOPIC_CACHE_MAX_ENTRIES = int(os.getenv("TOPIC_CACHE_MAX_ENTRIES", 200000))
 
 openai.organization = OPENAI_ORG_KEY
 openai.api_key = OPENAI_API_KEY
+if OPENAI_API_BASE:
+    openai.api_base = OPENAI_API_BASE
 
 ES_CLOUD_ID = os.getenv("ES_CLOUD_ID")
 ES_USERNAME = os.getenv("ES_USERNAME")
 ES_PASSWORD = os.getenv("ES_PASSWORD")
 ES_INDEX = os.getenv("ES_INDEX")
 ES_DATA_FETCH_SIZE = 10000  # No. of data to fetch and save from elastic-search
+ES_REQUESTS_PER_MINUTE = int(os.getenv("ES_REQUESTS_PER_MINUTE", 0))  # shared by all sources, 0 disables the limit
+
+# dense_vector mapping of indexed embedding fields. Vectors are normalized, so "dot_product" ranks the same as cosine
+# and is the cheapest similarity. "int8_hnsw" keeps one byte per dim in the kNN graph instead of four, "hnsw" float32
+VECTOR_DIMS = int(os.getenv("VECTOR_DIMS", 1024))  # 1024 for e5-large-v2, 768 for e5-base-v2
+VECTOR_SIMILARITY = os.getenv("VECTOR_SIMILARITY", "dot_product")
+VECTOR_INDEX_TYPE = os.getenv("VECTOR_INDEX_TYPE", "int8_hnsw")
+# indexed field summary_vector_embeddings is copied to by migrate_vector_field.py, new vectors are written to both
+# fields and knn searches use it once set. Leave it empty if there is no indexed field
+VECTOR_MIGRATION_FIELD = os.getenv("VECTOR_MIGRATION_FIELD", "")
+
+SOURCE_MAX_WORKERS = int(os.getenv("SOURCE_MAX_WORKERS", 4))  # No. of source groups processed concurrently by cron jobs
+# No. of sources a cron job fetches with a single query, groups run concurrently on SOURCE_MAX_WORKERS threads.
+# The default of 1 runs every source concurrently, 0 fetches all of them with one query and runs nothing concurrently
+SOURCES_PER_QUERY = int(os.getenv("SOURCES_PER_QUERY", 1))
+
+# cron jobs only fetch docs whose WATERMARK_FIELD is newer than the previous successful run
+WATERMARK_PATH = os.getenv("WATERMARK_PATH", "cache/watermarks.json")
+WATERMARK_FIELD = os.getenv("WATERMARK_FIELD", "created_at")
+WATERMARK_LOOKBACK_HOURS = int(os.getenv("WATERMARK_LOOKBACK_HOURS", 48))  # overlap with the previous run
+FULL_SWEEP_INTERVAL_DAYS = int(os.getenv("FULL_SWEEP_INTERVAL_DAYS", 7))  # 0 never runs a full sweep again
+
+# MinHash/LSH index of doc bodies built by find_near_duplicates.py, crons reuse results of near-duplicates
+NEAR_DUPLICATE_INDEX_DIR = os.getenv("NEAR_DUPLICATE_INDEX_DIR", "cache/near_duplicates")
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("NEAR_DUPLICATE_THRESHOLD", 0.8))  # min. estimated Jaccard similarity
+# docs with fewer distinct 5-word shingles aren't indexed, one-line replies of different threads look the same
+NEAR_DUPLICATE_MIN_SHINGLES = int(os.getenv("NEAR_DUPLICATE_MIN_SHINGLES", 20))
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer():
+    import tiktoken
+    return tiktoken.get_encoding(TOKENIZER_ENCODING)
+
+
+@lru_cache(maxsize=None)
+def get_topic_cache():
+    """Shared `TopicCache` of GPT topic responses, None if it is disabled. The database is opened on first use."""
+    if not TOPIC_CACHE_PATH:
+        return None
+    from src.topic_cache import TopicCache
+    return TopicCache(TOPIC_CACHE_PATH, max_entries=TOPIC_CACHE_MAX_ENTRIES)
+
+
+@lru_cache(maxsize=None)
+def get_embedding_model(backend=None):
+    """Embedding model of EMBEDDING_BACKEND, or of `backend`. All of them share the `encode` of SentenceTransformer."""
+    backend = backend or EMBEDDING_BACKEND
+    if backend in ("onnx", "onnx-int8"):
+        from src.embedding_utils import load_onnx_model
+        return load_onnx_model(EMBEDDING_MODEL_NAME, EMBEDDING_ONNX_DIR,
+                               quantization=EMBEDDING_QUANTIZATION if backend == "onnx-int8" else None)
+    if backend != "torch":
+        raise ValueError(f"Unknown EMBEDDING_BACKEND: {backend}, expected 'torch', 'onnx' or 'onnx-int8'")
+    # sentence_transformers pulls in torch, only load it in the jobs that actually embed
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(EMBEDDING_MODEL_NAME)
+
+
+@lru_cache(maxsize=None)
+def get_embedding_cache():
+    """Shared `EmbeddingCache` of the embedding model and backend in use, None if it is disabled."""
+    if not EMBEDDING_CACHE_DIR:
+        return None
+    from src.embedding_cache import EmbeddingCache
+    # quantized exports produce slightly different vectors, every backend gets its own keys
+    return EmbeddingCache(EMBEDDING_CACHE_DIR, dims=VECTOR_DIMS,
+                          model_name=f"{EMBEDDING_MODEL_NAME}:{EMBEDDING_BACKEND}",
+                          dtype=EMBEDDING_CACHE_DTYPE, max_entries=EMBEDDING_CACHE_MAX_ENTRIES)
+
+
+def __getattr__(name):
+    # keep `from src.config import TOKENIZER, EMBEDDING_MODEL` working, they are built on first access only
+    if name == "TOKENIZER":
+        return get_tokenizer()
+    if name == "EMBEDDING_MODEL":
+        return get_embedding_model()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
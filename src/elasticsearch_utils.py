@@ -1,7 +1,194 @@
+import json
 import time
-from elasticsearch import Elasticsearch
+from collections import Counter
+from elasticsearch import Elasticsearch, helpers
 from loguru import logger
-from src.config import ES_CLOUD_ID, ES_USERNAME, ES_PASSWORD, ES_DATA_FETCH_SIZE
+from src.config import ES_CLOUD_ID, ES_USERNAME, ES_PASSWORD, ES_DATA_FETCH_SIZE, ES_REQUESTS_PER_MINUTE, VECTOR_DIMS
+from src.rate_limiter import RateLimiter
+
+# shared by every thread so concurrent sources don't overload the cluster
+ES_RATE_LIMITER = RateLimiter(requests_per_minute=ES_REQUESTS_PER_MINUTE)
+
+
+class BulkUpdateWriter:
+    """
+    Buffers partial-doc updates and deletes and sends them through the `_bulk` API.
+    Updates to the same document are merged into a single action, the buffer is flushed once it holds
+    `max_actions` documents or `max_bytes` of payload, and items rejected with a retriable status, or whose request
+    didn't get through, are retried with exponential backoff. Items that still fail end up in `failed`, a flush
+    never raises. Use it as a context manager so the remaining buffer is flushed on exit.
+    """
+    RETRIABLE_STATUSES = {429, 502, 503, 504}
+
+    def __init__(self, es_client, max_actions=500, max_bytes=5 * 1024 * 1024, max_retries=3, retry_delay=2):
+        self._es_client = es_client
+        self._max_actions = max_actions
+        self._max_bytes = max_bytes
+        self._max_retries = max_retries
+        self._retry_delay = retry_delay
+        self._buffer = {}
+        self._buffer_bytes = 0
+        self.success_count = 0
+        self.request_count = 0
+        self.not_found_count = 0
+        self.failed = []
+
+    @property
+    def failed_ids(self):
+        """`_id`s of the docs whose update or delete failed."""
+        return [(result.get("update") or result.get("delete") or {}).get("_id") for result in self.failed]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def update(self, es_index, doc_id, doc, doc_as_upsert=False):
+        key = (es_index, doc_id)
+        if key in self._buffer and self._buffer[key].get("op") == "delete":
+            logger.warning(f"Ignoring update of a doc that is being deleted: {doc_id}")
+            return
+        if key in self._buffer:
+            self._buffer[key]["doc"].update(doc)
+            self._buffer[key]["doc_as_upsert"] = self._buffer[key]["doc_as_upsert"] or doc_as_upsert
+        else:
+            self._buffer[key] = {"doc": dict(doc), "doc_as_upsert": doc_as_upsert}
+        self._buffer_bytes += len(json.dumps(doc, default=str))
+
+        if len(self._buffer) >= self._max_actions or self._buffer_bytes >= self._max_bytes:
+            self.flush()
+
+    def delete(self, es_index, doc_id):
+        """Delete a doc, pending updates of it are dropped."""
+        self._buffer[(es_index, doc_id)] = {"op": "delete"}
+        self._buffer_bytes += len(doc_id) + 64
+
+        if len(self._buffer) >= self._max_actions or self._buffer_bytes >= self._max_bytes:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        actions = [
+            {"_op_type": "delete", "_index": es_index, "_id": doc_id}
+            if item.get("op") == "delete" else
+            {
+                "_op_type": "update",
+                "_index": es_index,
+                "_id": doc_id,
+                "doc": item["doc"],
+                "doc_as_upsert": item["doc_as_upsert"]
+            } for (es_index, doc_id), item in self._buffer.items()
+        ]
+        self._buffer = {}
+        self._buffer_bytes = 0
+
+        for attempt in range(self._max_retries + 1):
+            retry_actions = []
+            for chunk in self._chunks(actions):
+                retry_actions.extend(self._send(chunk, can_retry=attempt < self._max_retries))
+
+            if not retry_actions:
+                break
+            actions = retry_actions
+            wait = self._retry_delay * 2 ** attempt
+            logger.warning(f"Retrying {len(actions)} rejected bulk updates in {wait} seconds...")
+            time.sleep(wait)
+
+        logger.info(f"Bulk writer: {self.success_count} docs written with {self.request_count} requests, "
+                    f"not found: {self.not_found_count}, failed: {len(self.failed)}")
+
+    def _chunks(self, actions):
+        """Split `actions` into the `_bulk` requests they are sent with, each of at most `max_bytes` of docs."""
+        chunk, chunk_bytes = [], 0
+        for action in actions:
+            action_bytes = len(json.dumps(action, default=str))
+            if chunk and chunk_bytes + action_bytes > self._max_bytes:
+                yield chunk
+                chunk, chunk_bytes = [], 0
+            chunk.append(action)
+            chunk_bytes += action_bytes
+        if chunk:
+            yield chunk
+
+    def _send(self, chunk, can_retry):
+        """Send one `_bulk` request, return the actions to retry. Every other action ends up counted or failed."""
+        ES_RATE_LIMITER.acquire()
+        self.request_count += 1
+        retry_actions = []
+        done = 0
+        try:
+            # a chunk is never split again, the request fails as a whole with the status of an ApiError
+            results = helpers.streaming_bulk(self._es_client, chunk, chunk_size=len(chunk),
+                                             max_chunk_bytes=self._max_bytes * 2, raise_on_error=False,
+                                             raise_on_exception=False)
+            # bulk items come back in request order. They are matched by position, the response names the
+            # concrete index where the action may name an alias
+            for action, (ok, result) in zip(chunk, results):
+                done += 1
+                if ok:
+                    self.success_count += 1
+                    continue
+                item = result.get("update") or result.get("delete") or {}
+                if "delete" in result and item.get("status") == 404:
+                    # already gone, nothing left to do
+                    self.not_found_count += 1
+                elif item.get("status") in self.RETRIABLE_STATUSES and can_retry:
+                    retry_actions.append(action)
+                else:
+                    logger.error(f"Bulk update failed: {result}")
+                    self.failed.append(result)
+        except Exception as ex:
+            # the request didn't reach the cluster, e.g. a connection error, the actions without a result are
+            # retried like rejected ones
+            logger.warning(f"Bulk request failed: {ex}")
+            for action in chunk[done:]:
+                if can_retry:
+                    retry_actions.append(action)
+                else:
+                    result = {action["_op_type"]: {"_index": action["_index"], "_id": action["_id"], "status": None,
+                                                   "error": str(ex)}}
+                    logger.error(f"Bulk update failed: {result}")
+                    self.failed.append(result)
+        return retry_actions
+
+    def close(self):
+        self.flush()
+
+
+class DomainRouter:
+    """
+    Routes the hits of a single query over several domains to per-domain consumers on the client side,
+    counting what each domain contributed. Hits need the 'domain' field in their `_source`.
+    """
+
+    def __init__(self, domains, fallback=None):
+        """
+        :param domains: list, domains hits are routed to
+        :param fallback: hits of any other domain are routed here, they are skipped if None
+        """
+        self._domains = list(domains)
+        self._domain_set = set(domains)
+        self._fallback = fallback
+        self.counts = Counter()
+
+    def route(self, hits):
+        """Yield (domain, hit) for every hit of `hits`."""
+        for hit in hits:
+            domain = hit['_source'].get('domain')
+            if domain not in self._domain_set:
+                domain = self._fallback
+            if domain is None:
+                self.counts["unrouted"] += 1
+                continue
+            self.counts[domain] += 1
+            yield domain, hit
+
+    def log_counts(self, message="docs received"):
+        for domain in self._domains + ([self._fallback] if self._fallback else []) + ["unrouted"]:
+            if domain in self.counts or domain in self._domains:
+                logger.info(f"{message} | {domain}: {self.counts[domain]}")
 
 
 class ElasticSearchClient:
@@ -15,10 +202,17 @@ class ElasticSearchClient:
         self._es_username = es_username
         self._es_password = es_password
         self._es_data_fetch_size = es_data_fetch_size
-        self._es_client = Elasticsearch(
-            cloud_id=self._es_cloud_id,
-            http_auth=(self._es_username, self._es_password),
-        )
+        self._client = None
+
+    @property
+    def _es_client(self):
+        # the connection is created on first use so importing or constructing the client is free
+        if self._client is None:
+            self._client = Elasticsearch(
+                cloud_id=self._es_cloud_id,
+                http_auth=(self._es_username, self._es_password),
+            )
+        return self._client
 
     @property
     def es_client(self):
@@ -42,6 +236,103 @@ class ElasticSearchClient:
             }
         return field_not_exists_query
 
+    def build_query(self, url=None, start_date_str=None, current_date_str=None, missing_field=None, must=None,
+                    since=None, since_field="created_at", since_ids=None):
+        """
+        Build the bool query shared by the fetch methods.
+        :param url: str or list, domain(s) the docs belong to
+        :param start_date_str: str, 'YYYY-MM-DD' lower bound of 'created_at', applied together with `current_date_str`
+        :param current_date_str: str, 'YYYY-MM-DD' upper bound of 'created_at'
+        :param missing_field: str or list, field(s) that must not exist in the docs
+        :param must: list, additional clauses all docs must match
+        :param since: str, ISO timestamp lower bound of `since_field`, e.g. from a `WatermarkStore`
+        :param since_ids: list, `_id`s of docs that are matched whatever their `since_field`, e.g. docs that
+            failed in the previous run
+        """
+        logger.info(f"Url: {url}, Start Date: {start_date_str}, Current Date: {current_date_str}")
+        must_clauses = []
+        if start_date_str and current_date_str:
+            must_clauses.append({
+                "range": {
+                    "created_at": {
+                        "gte": f"{start_date_str}T00:00:00.000Z",
+                        "lte": f"{current_date_str}T23:59:59.999Z"
+                    }
+                }
+            })
+        if since and since_ids:
+            must_clauses.append({"bool": {"should": [{"range": {since_field: {"gte": since}}},
+                                                     {"ids": {"values": list(since_ids)}}],
+                                          "minimum_should_match": 1}})
+        elif since:
+            must_clauses.append({"range": {since_field: {"gte": since}}})
+        if url:
+            must_clauses.append(self.get_domain_query(url))
+        if must:
+            must_clauses.extend(must)
+
+        bool_query = {}
+        if must_clauses:
+            bool_query["must"] = must_clauses
+        if missing_field:
+            bool_query["must_not"] = self.handle_multiple_field_names(missing_field)
+        return {"query": {"bool": bool_query}}
+
+    def paginate(self, es_index, query, source_includes=None, keep_alive='5m', page_size=None):
+        """
+        Yield the hits of `query` page by page using a point in time and `search_after`.
+        The point in time is closed once the generator is exhausted or closed early.
+        :param es_index: str, index to search
+        :param query: dict, request body, e.g. from `build_query`
+        :param source_includes: list, only these `_source` fields are returned, all of them if None
+        :param keep_alive: str, keepalive of the point in time, must cover the time the consumer spends on one page
+        :param page_size: int, hits per page, defaults to `es_data_fetch_size`
+        """
+        pit_id = self._es_client.open_point_in_time(index=es_index, keep_alive=keep_alive)['id']
+        try:
+            search_after = None
+            while True:
+                body = dict(query)
+                body["pit"] = {"id": pit_id, "keep_alive": keep_alive}
+                # '_shard_doc' is the cheapest tiebreaker sort available with a point in time
+                body["sort"] = [{"_shard_doc": "asc"}]
+                body["size"] = page_size or self._es_data_fetch_size
+                body["track_total_hits"] = False
+                if source_includes is not None:
+                    body["_source"] = {"includes": list(source_includes)}
+                if search_after:
+                    body["search_after"] = search_after
+
+                ES_RATE_LIMITER.acquire()
+                response = self._es_client.search(body=body)
+                pit_id = response.get("pit_id", pit_id)
+                results = response['hits']['hits']
+                if not results:
+                    break
+
+                yield results
+                search_after = results[-1]["sort"]
+        finally:
+            try:
+                self._es_client.close_point_in_time(id=pit_id)
+            except Exception as ex:
+                logger.warning(f"Could not close point in time: {ex}")
+
+    def iter_hits(self, es_index, query, source_includes=None, keep_alive='5m', page_size=None):
+        """Yield the hits of `query` one by one, see `paginate`."""
+        start_time = time.time()
+        doc_count = 0
+        source_bytes = 0
+        logger.info(f"streaming '{es_index}' data, _source fields: {source_includes or 'all'}...")
+        for results in self.paginate(es_index=es_index, query=query, source_includes=source_includes,
+                                     keep_alive=keep_alive, page_size=page_size):
+            doc_count += len(results)
+            # size of the serialized _source, to keep an eye on what the field projection saves
+            source_bytes += sum(len(json.dumps(hit.get('_source', {}), default=str)) for hit in results)
+            yield from results
+        logger.info(f"streaming {doc_count} docs of '{es_index}' completed in {time.time() - start_time:.2f} seconds, "
+                    f"_source size: {source_bytes / (1024 * 1024):.2f} MB.")
+
     def compute_similar_docs_with_cosine_similarity(self, es_index, model, field_name, question: str, top_k: int = 3):
         if self._es_client.ping():
             logger.info("connected to the ElasticSearch")
@@ -73,6 +364,7 @@ class ElasticSearchClient:
                 "question": question,
                 "matches": [
                     {
+                        "_id": hit.get('_id'),
                         "title": hit['_source'].get('title'),
                         "summary": hit['_source'].get('summary') if hit['_source'].get('summary') else hit[
                             '_source'].get('body'),
@@ -87,282 +379,261 @@ class ElasticSearchClient:
                 "matches": []
             }
 
-    def fetch_data_for_empty_field(self, es_index, field_name, url=None, start_date_str=None, current_date_str=None):
-        logger.info(f"fetching the data based on empty '{field_name}' ... ")
-        output_list = []
-        start_time = time.time()
-
+    def compute_similar_docs_with_knn(self, es_index, model, field_name, question: str, top_k: int = 3,
+                                      num_candidates: int = 100):
+        """
+        Approximate nearest neighbour search with the native `knn` option of ES.
+        Requires `field_name` to be an indexed dense_vector, see `add_vector_field`. Scores follow the
+        similarity of the mapping, for 'cosine' that is (1 + cosine) / 2.
+        :param num_candidates: int, candidates considered per shard, higher improves recall at the cost of latency
+        """
         if self._es_client.ping():
             logger.info("connected to the ElasticSearch")
+            logger.info(f"Querying ES index with knn: {question}")
+            question_embedding = model.encode(question, normalize_embeddings=True)
+            response = self._es_client.search(
+                index=es_index,
+                knn={
+                    "field": field_name,
+                    "query_vector": question_embedding.tolist(),
+                    "k": top_k,
+                    "num_candidates": max(num_candidates, top_k)
+                },
+                size=top_k,
+                source={"includes": ["title", "summary", "body"]}
+            )
+            return {
+                "question": question,
+                "matches": [
+                    {
+                        "_id": hit.get('_id'),
+                        "title": hit['_source'].get('title'),
+                        "summary": hit['_source'].get('summary') if hit['_source'].get('summary') else hit[
+                            '_source'].get('body'),
+                        "score": hit.get('_score')
+                    } for hit in response['hits']['hits']
+                ]
+            }
+        else:
+            logger.info('Could not connect to Elasticsearch')
+            return {
+                "question": question,
+                "matches": []
+            }
 
-            domain_query = self.get_domain_query(url)
-            not_exists_query = self.handle_multiple_field_names(field_name)
-
-            if url and start_date_str and current_date_str:
-                logger.info(f"Url: {url}, Start Date: {start_date_str}, Current Date: {current_date_str}")
-                query = {
-                    "query": {
-                        "bool": {
-                            "must": [
-                                {
-                                    "range": {
-                                        "created_at": {
-                                            "gte": f"{start_date_str}T00:00:00.000Z",
-                                            "lte": f"{current_date_str}T23:59:59.999Z"
-                                        }
-                                    }
-                                },
-                                domain_query
-                            ],
-                            "must_not": not_exists_query
-                        }
-                    }
-                }
-            elif url and not start_date_str and not current_date_str:
-                logger.info(f"Url: {url}, Start Date: {start_date_str}, Current Date: {current_date_str}")
-                query = {
-                    "query": {
-                        "bool": {
-                            "must": [
-                                domain_query
-                            ],
-                            "must_not": not_exists_query
-                        }
-                    }
-                }
-            elif not url and start_date_str and current_date_str:
-                logger.info(f"Url: {url}, Start Date: {start_date_str}, Current Date: {current_date_str}")
-                query = {
-                    "query": {
-                        "bool": {
-                            "must": [
-                                {
-                                    "range": {
-                                        "created_at": {
-                                            "gte": f"{start_date_str}T00:00:00.000Z",
-                                            "lte": f"{current_date_str}T23:59:59.999Z"
-                                        }
-                                    }
-                                }
-                            ],
-                            "must_not": not_exists_query
-                        }
-                    }
-                }
-            else:
-                logger.info(f"Url: {url}, Start Date: {start_date_str}, Current Date: {current_date_str}")
-                query = {
-                    "query": {
-                        "bool": {
-                            "must_not": not_exists_query
-                        }
-                    }
-                }
+    def fetch_data_for_empty_field(self, es_index, field_name, url=None, start_date_str=None, current_date_str=None,
+                                   source_includes=None):
+        return list(self.iter_data_for_empty_field(es_index=es_index, field_name=field_name, url=url,
+                                                   start_date_str=start_date_str, current_date_str=current_date_str,
+                                                   source_includes=source_includes))
+
+    def iter_data_for_empty_field(self, es_index, field_name, url=None, start_date_str=None, current_date_str=None,
+                                  source_includes=None, keep_alive='5m', page_size=None, since=None,
+                                  since_field="created_at", since_ids=None):
+        """
+        Yield docs with an empty `field_name` one page at a time instead of collecting them all.
+        Only docs whose `since_field` is at least `since`, or whose `_id` is in `since_ids`, are fetched if given.
+        """
+        logger.info(f"fetching the data based on empty '{field_name}' ... ")
 
-            # Initialize the scroll
-            scroll_response = self._es_client.search(index=es_index, body=query, size=self._es_data_fetch_size,
-                                                     scroll='5m')
-            scroll_id = scroll_response['_scroll_id']
-            results = scroll_response['hits']['hits']
+        if self._es_client.ping():
+            logger.info("connected to the ElasticSearch")
+            query = self.build_query(url=url, start_date_str=start_date_str, current_date_str=current_date_str,
+                                     missing_field=field_name, since=since, since_field=since_field,
+                                     since_ids=since_ids)
+            yield from self.iter_hits(es_index=es_index, query=query, source_includes=source_includes,
+                                      keep_alive=keep_alive, page_size=page_size)
+        else:
+            logger.info('Could not connect to Elasticsearch')
 
-            # Dump the documents into the json file
-            logger.info(f"dumping '{es_index}' data in json...")
-            while len(results) > 0:
-                for result in results:
-                    output_list.append(result)
+    def extract_data_from_es(self, es_index, url=None, start_date_str=None, current_date_str=None,
+                             source_includes=None):
+        return list(self.iter_data_from_es(es_index=es_index, url=url, start_date_str=start_date_str,
+                                           current_date_str=current_date_str, source_includes=source_includes))
 
-                # Fetch the next batch of results
-                scroll_response = self._es_client.scroll(scroll_id=scroll_id, scroll='5m')
-                scroll_id = scroll_response['_scroll_id']
-                results = scroll_response['hits']['hits']
+    def iter_data_from_es(self, es_index, url=None, start_date_str=None, current_date_str=None,
+                          source_includes=None, keep_alive='5m', page_size=None, since=None, since_field="created_at",
+                          since_ids=None):
+        """Yield all docs matching the domain/date filters one page at a time."""
+        if self._es_client.ping():
+            logger.info("connected to the ElasticSearch")
+            query = self.build_query(url=url, start_date_str=start_date_str, current_date_str=current_date_str,
+                                     since=since, since_field=since_field, since_ids=since_ids)
+            yield from self.iter_hits(es_index=es_index, query=query, source_includes=source_includes,
+                                      keep_alive=keep_alive, page_size=page_size)
+        else:
+            logger.warning('Could not connect to Elasticsearch')
 
-            logger.info(
-                f"dumping '{es_index}' data completed in {time.time() - start_time:.2f} seconds.")
+    def fetch_docs_by_ids(self, es_index, doc_ids, source_includes=None):
+        """dict of `_id` -> `_source` of the docs found among `doc_ids`, fetched with a single mget request."""
+        if not doc_ids:
+            return {}
+        ES_RATE_LIMITER.acquire()
+        response = self._es_client.mget(index=es_index, ids=list(doc_ids), source_includes=source_includes)
+        return {doc['_id']: doc.get('_source', {}) for doc in response['docs'] if doc.get('found')}
 
-            return output_list
-        else:
+    def fetch_docs_with_keywords(self, es_index, url, keyword, source_includes=None):
+        if not self._es_client.ping():
             logger.info('Could not connect to Elasticsearch')
-            return output_list
-
-    def extract_data_from_es(self, es_index, url=None, start_date_str=None, current_date_str=None):
-        output_list = []
-        start_time = time.time()
+            return None
+        return list(self.iter_docs_with_keywords(es_index=es_index, url=url, keyword=keyword,
+                                                 source_includes=source_includes))
 
+    def iter_docs_with_keywords(self, es_index, url, keyword, source_includes=None, keep_alive='5m', page_size=None):
+        """Yield docs whose summary and body match `keyword` one page at a time."""
         if self._es_client.ping():
             logger.info("connected to the ElasticSearch")
-
-            domain_query = self.get_domain_query(url)
-
-            if url and start_date_str and current_date_str:
-                logger.info(f"Url: {url}, Start Date: {start_date_str}, Current Date: {current_date_str}")
-                query = {
-                    "query": {
-                        "bool": {
-                            "must": [
-                                {
-                                    "range": {
-                                        "created_at": {
-                                            "gte": f"{start_date_str}T00:00:00.000Z",
-                                            "lte": f"{current_date_str}T23:59:59.999Z"
-                                        }
-                                    }
-                                },
-                                domain_query
-                            ]
-                        }
+            keyword_query = [
+                {
+                    "match_phrase": {
+                        "summary": str(keyword)
                     }
-                }
-            elif url and not start_date_str and not current_date_str:
-                logger.info(f"Url: {url}, Start Date: {start_date_str}, Current Date: {current_date_str}")
-                query = {
-                    "query": {
-                        "bool": {
-                            "must": [
-                                domain_query
-                            ]
-                        }
+                },
+                {
+                    "match_phrase": {
+                        "body": str(keyword)
                     }
-                }
-            elif not url and start_date_str and current_date_str:
-                logger.info(f"Url: {url}, Start Date: {start_date_str}, Current Date: {current_date_str}")
-                query = {
-                    "query": {
-                        "bool": {
-                            "must": [
-                                {
-                                    "range": {
-                                        "created_at": {
-                                            "gte": f"{start_date_str}T00:00:00.000Z",
-                                            "lte": f"{current_date_str}T23:59:59.999Z"
-                                        }
-                                    }
-                                }
-                            ]
+                },
+                {
+                    "match": {
+                        "summary": {
+                            "query": str(keyword),
+                            "minimum_should_match": "95%",
+                            # "operator": "and"
                         }
                     }
-                }
-            else:
-                logger.info(f"Url: {url}, Start Date: {start_date_str}, Current Date: {current_date_str}")
-                query = {
-                    "query": {
-                        "bool": {
+                },
+                {
+                    "match": {
+                        "body": {
+                            "query": str(keyword),
+                            "minimum_should_match": "95%",
+                            # "operator": "and"
                         }
                     }
                 }
-
-            # Initialize the scroll
-            scroll_response = self._es_client.search(index=es_index, body=query, size=self._es_data_fetch_size,
-                                                     scroll='5m')
-            scroll_id = scroll_response['_scroll_id']
-            results = scroll_response['hits']['hits']
-
-            # Dump the documents into the json file
-            logger.info(f"started dumping of {es_index} data in json...")
-            while len(results) > 0:
-                # Save the current batch of results
-                for result in results:
-                    output_list.append(result)
-
-                # Fetch the next batch of results
-                scroll_response = self._es_client.scroll(scroll_id=scroll_id, scroll='5m')
-                scroll_id = scroll_response['_scroll_id']
-                results = scroll_response['hits']['hits']
-
-            logger.info(
-                f"Dumping of {es_index} data in json has completed and has taken {time.time() - start_time:.2f} seconds.")
-
-            return output_list
-        else:
-            logger.warning('Could not connect to Elasticsearch')
-            return output_list
-
-    def fetch_docs_with_keywords(self, es_index, url, keyword):
-        output_list = []
-        start_time = time.time()
-
-        if self._es_client.ping():
-            logger.info("connected to the ElasticSearch")
-
-            domain_query = self.get_domain_query(url)
-
-            query = {
-                "min_score": 1,
-                "query": {
-                    "bool": {
-                        "must": [
-                            domain_query,
-                            {
-                                "match_phrase": {
-                                    "summary": str(keyword)
-                                }
-                            },
-                            {
-                                "match_phrase": {
-                                    "body": str(keyword)
-                                }
-                            },
-                            {
-                                "match": {
-                                    "summary": {
-                                        "query": str(keyword),
-                                        "minimum_should_match": "95%",
-                                        # "operator": "and"
-                                    }
-                                }
-                            },
-                            {
-                                "match": {
-                                    "body": {
-                                        "query": str(keyword),
-                                        "minimum_should_match": "95%",
-                                        # "operator": "and"
-                                    }
-                                }
-                            }
-                        ]
-                    }
-                }
-            }
-
-            # Initialize the scroll
-            scroll_response = self._es_client.search(
-                index=es_index,
-                body=query,
-                size=self._es_data_fetch_size,
-                scroll='5m'
-            )
-            scroll_id = scroll_response['_scroll_id']
-            results = scroll_response['hits']['hits']
-
-            # Dump the documents into the json file
-            logger.info(f"Starting dumping of {es_index} data in json...")
-            while len(results) > 0:
-                for result in results:
-                    output_list.append(result)
-
-                # Fetch the next batch of results
-                scroll_response = self._es_client.scroll(scroll_id=scroll_id, scroll='5m')
-                scroll_id = scroll_response['_scroll_id']
-                results = scroll_response['hits']['hits']
-
-            logger.info(
-                f"Dumping of {es_index} data in json has completed and has taken {time.time() - start_time:.2f} seconds.")
-
-            return output_list
+            ]
+            query = self.build_query(url=url, must=keyword_query)
+            query["min_score"] = 1
+            # hits are sorted for pagination, scores have to be tracked explicitly for 'min_score' to apply
+            query["track_scores"] = True
+            yield from self.iter_hits(es_index=es_index, query=query, source_includes=source_includes,
+                                      keep_alive=keep_alive, page_size=page_size)
         else:
             logger.info('Could not connect to Elasticsearch')
-            return None
 
-    def add_vector_field(self, es_index, field_name):
+    @staticmethod
+    def vector_field_mapping(dims=VECTOR_DIMS, similarity=None, index_type=None, m=None, ef_construction=None):
+        """
+        Mapping of a dense_vector field. Without `similarity` the vectors are only stored, for `script_score`.
+        :param similarity: str, 'cosine', 'dot_product' (unit length vectors only) or 'l2_norm', indexes the
+            field in an HNSW graph so `knn` searches are sub-linear
+        :param index_type: str, 'hnsw', or 'int8_hnsw' to keep the vectors of the graph quantized to a byte per dim
+        :param m: int, no. of neighbours of every node in the graph, ES defaults to 16
+        :param ef_construction: int, candidates considered while building the graph, ES defaults to 100
+        """
+        mapping = {"type": "dense_vector", "dims": dims}
+        if similarity:
+            mapping["index"] = True
+            mapping["similarity"] = similarity
+            index_options = {key: value for key, value in
+                             {"type": index_type, "m": m, "ef_construction": ef_construction}.items() if value}
+            if index_options:
+                index_options.setdefault("type", "hnsw")
+                mapping["index_options"] = index_options
+        return mapping
+
+    def get_field_mapping(self, es_index, field_name):
+        """Mapping of `field_name` in `es_index`, None if the field isn't mapped."""
+        response = self._es_client.indices.get_field_mapping(index=es_index, fields=field_name)
+        for index_mapping in response.body.values():
+            field = index_mapping.get("mappings", {}).get(field_name)
+            if field:
+                return field["mapping"][field_name.split(".")[-1]]
+        return None
+
+    def add_vector_field(self, es_index, field_name, dims=VECTOR_DIMS, similarity=None, index_type=None, m=None,
+                         ef_construction=None):
+        """Add a dense_vector field to the mapping, see `vector_field_mapping` for the options."""
         res = self._es_client.indices.put_mapping(
             index=es_index,
             body={
                 "properties": {
-                    f"{field_name}": {
-                        "type": "dense_vector",
-                        "dims": 1024
-                    }
+                    f"{field_name}": self.vector_field_mapping(dims=dims, similarity=similarity, index_type=index_type,
+                                                               m=m, ef_construction=ef_construction)
                 }
             }
         )
         logger.info(f"Field updated: {res}")
+
+    def copy_field(self, es_index, source_field, target_field, requests_per_second=100, slices="auto",
+                   scroll_size=500):
+        """
+        Copy `source_field` into `target_field` for every doc that has the first and not the second with a
+        throttled update by query that runs as a background task in the cluster. Docs stay searchable while it
+        runs and docs updated meanwhile are skipped, so running it again picks up whatever is left.
+        :param requests_per_second: float, docs updated per second across all slices, -1 disables the throttle
+        :return: str, id of the task, see `get_task` and `rethrottle_task`
+        """
+        ES_RATE_LIMITER.acquire()
+        response = self._es_client.update_by_query(
+            index=es_index,
+            query={
+                "bool": {
+                    "must": [{"exists": {"field": source_field}}],
+                    "must_not": [{"exists": {"field": target_field}}]
+                }
+            },
+            script={
+                "source": "ctx._source[params.target] = ctx._source[params.source]",
+                "lang": "painless",
+                "params": {"source": source_field, "target": target_field}
+            },
+            conflicts="proceed",
+            requests_per_second=requests_per_second,
+            slices=slices,
+            scroll_size=scroll_size,
+            wait_for_completion=False
+        )
+        logger.info(f"Copying '{source_field}' to '{target_field}' in task: {response['task']}")
+        return response['task']
+
+    def get_task(self, task_id):
+        """Status of a background task: 'completed', 'task.status' progress counters and 'response' once done."""
+        return self._es_client.tasks.get(task_id=task_id).body
+
+    def rethrottle_task(self, task_id, requests_per_second):
+        """Change the throttle of a running update by query, e.g. to speed it up outside peak hours."""
+        return self._es_client.update_by_query_rethrottle(task_id=task_id, requests_per_second=requests_per_second)
+
+    def count_docs(self, es_index, query):
+        """No. of docs matching `query`, a request body as returned by `build_query`."""
+        ES_RATE_LIMITER.acquire()
+        return self._es_client.count(index=es_index, query=query["query"])["count"]
+
+    def bulk_writer(self, **kwargs):
+        """Return a `BulkUpdateWriter` bound to this client, see `BulkUpdateWriter` for the options."""
+        return BulkUpdateWriter(self._es_client, **kwargs)
+
+    def bulk_update_docs(self, updates, doc_as_upsert=False):
+        """
+        Apply partial-doc updates with a single `_bulk` request.
+        :param updates: list of (index, id, doc) tuples
+        :param doc_as_upsert: bool, insert the document if it does not already exist
+        :return: (no. of successful updates, list of per-item errors)
+        """
+        with self.bulk_writer(max_actions=max(len(updates), 1)) as writer:
+            for doc_index, doc_id, doc in updates:
+                writer.update(doc_index, doc_id, doc, doc_as_upsert=doc_as_upsert)
+        return writer.success_count, writer.failed
+
+    def bulk_delete_docs(self, deletes, batch_size=1000):
+        """
+        Delete docs with batched `_bulk` requests.
+        :param deletes: iterable of (index, id) tuples
+        :return: (no. of deleted docs, no. of docs not found, list of per-item errors)
+        """
+        with self.bulk_writer(max_actions=batch_size) as writer:
+            for doc_index, doc_id in deletes:
+                writer.delete(doc_index, doc_id)
+        return writer.success_count, writer.not_found_count, writer.failed
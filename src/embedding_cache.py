@@ -0,0 +1,192 @@
+import glob
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+from loguru import logger
+
+from src.topic_cache import TopicCache
+
+
+class EmbeddingCache:
+    """
+    Persistent cache of text embeddings keyed by a hash of the model name and the normalized text.
+    Vectors are appended to a flat `float32`/`float16` file that is read through a memory map, so only the rows
+    that are hit are read from disk. A SQLite index maps every key to its row in the file.
+    The cache holds at most `max_entries` vectors, the least recently used ones are evicted first. Evicted rows
+    stay in the file until `compact` rewrites it with the live rows only.
+    It is safe to share between threads.
+    """
+
+    def __init__(self, dir_path, dims, model_name, dtype="float32", max_entries=200000):
+        os.makedirs(dir_path, exist_ok=True)
+        self._dir_path = dir_path
+        self._dims = dims
+        self._model_name = model_name
+        self._dtype = np.dtype(dtype)
+        self._row_bytes = self._dims * self._dtype.itemsize
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(dir_path, "index.sqlite"), check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS embedding_cache (
+                key TEXT PRIMARY KEY,
+                row INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON embedding_cache (last_access)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.commit()
+
+        meta = dict(self._conn.execute("SELECT name, value FROM meta").fetchall())
+        if meta and (int(meta["dims"]) != dims or meta["dtype"] != self._dtype.name):
+            logger.warning(f"Embedding cache at {dir_path} holds {meta['dims']} {meta['dtype']} vectors, "
+                           f"starting a new one for {dims} {self._dtype.name} vectors")
+            self._conn.execute("DELETE FROM embedding_cache")
+            meta = {}
+        if not meta:
+            meta = {"dims": str(dims), "dtype": self._dtype.name, "vectors_file": "vectors.0.bin"}
+            self._conn.executemany("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", meta.items())
+            self._conn.commit()
+        self._vectors_file = meta["vectors_file"]
+        self._remove_stale_files()
+
+        # a row cut short by a killed run was never added to the index, it is dropped
+        vectors_path = self._vectors_path()
+        if not os.path.exists(vectors_path):
+            open(vectors_path, "wb").close()
+        self._rows = os.path.getsize(vectors_path) // self._row_bytes
+        os.truncate(vectors_path, self._rows * self._row_bytes)
+        self._vectors = None
+        self._mapped_rows = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0]
+
+    def _vectors_path(self, vectors_file=None):
+        return os.path.join(self._dir_path, vectors_file or self._vectors_file)
+
+    def _remove_stale_files(self):
+        # left behind by a compaction that was interrupted, or that finished while the old file was still mapped
+        for path in glob.glob(os.path.join(self._dir_path, "vectors.*.bin")):
+            if os.path.basename(path) != self._vectors_file:
+                os.remove(path)
+
+    def make_key(self, text):
+        # whitespace doesn't change the tokens the model sees
+        return TopicCache.make_key(self._model_name, " ".join(str(text).split()))
+
+    def _row_view(self, row):
+        if row >= self._mapped_rows:
+            # the file has grown since it was mapped
+            self._vectors = np.memmap(self._vectors_path(), dtype=self._dtype, mode="r",
+                                      shape=(self._rows, self._dims))
+            self._mapped_rows = self._rows
+        return self._vectors[row]
+
+    def get_many(self, texts):
+        """Cached vectors of `texts` in the same order, None for texts that aren't cached. Vectors are read-only."""
+        keys = [self.make_key(text) for text in texts]
+        with self._lock:
+            rows = {}
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows.update(self._conn.execute(
+                    f"SELECT key, row FROM embedding_cache WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall())
+            if rows:
+                now = time.time()
+                self._conn.executemany("UPDATE embedding_cache SET last_access = ? WHERE key = ?",
+                                       [(now, key) for key in rows])
+                self._conn.commit()
+            vectors = [self._row_view(rows[key]) if key in rows else None for key in keys]
+            self.hits += len([vector for vector in vectors if vector is not None])
+            self.misses += len([vector for vector in vectors if vector is None])
+            return vectors
+
+    def set_many(self, texts, vectors):
+        """Append the vectors of `texts`, texts that are already cached keep their vector."""
+        keys = [self.make_key(text) for text in texts]
+        vectors = np.asarray(vectors, dtype=self._dtype).reshape(len(keys), self._dims)
+        with self._lock:
+            cached = set()
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                cached.update(key for key, in self._conn.execute(
+                    f"SELECT key FROM embedding_cache WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall())
+            new = {}
+            for key, vector in zip(keys, vectors):
+                if key not in cached and key not in new:
+                    new[key] = vector
+            if not new:
+                return
+
+            # vectors are on disk before the index points to them
+            with open(self._vectors_path(), "ab") as f:
+                f.write(np.stack(list(new.values())).tobytes())
+            now = time.time()
+            self._conn.executemany("INSERT INTO embedding_cache (key, row, last_access) VALUES (?, ?, ?)",
+                                   [(key, self._rows + idx, now) for idx, key in enumerate(new)])
+            self._rows += len(new)
+
+            count = self._conn.execute("SELECT COUNT(*) FROM embedding_cache").fetchone()[0]
+            if count > self._max_entries:
+                self._conn.execute(
+                    "DELETE FROM embedding_cache WHERE key IN "
+                    "(SELECT key FROM embedding_cache ORDER BY last_access ASC LIMIT ?)",
+                    (count - self._max_entries,)
+                )
+            self._conn.commit()
+
+    def compact(self, min_garbage_ratio=0.25):
+        """
+        Rewrite the vectors file with the live rows only, if at least `min_garbage_ratio` of its rows were evicted.
+        Vectors returned by `get_many` before are still valid, they map the old file.
+        :return: no. of rows removed
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT key, row FROM embedding_cache ORDER BY row").fetchall()
+            garbage = self._rows - len(rows)
+            if not self._rows or garbage / self._rows < min_garbage_ratio:
+                return 0
+
+            generation = int(self._vectors_file.split(".")[1]) + 1
+            vectors_file = f"vectors.{generation}.bin"
+            old = np.memmap(self._vectors_path(), dtype=self._dtype, mode="r", shape=(self._rows, self._dims))
+            with open(self._vectors_path(vectors_file), "wb") as f:
+                for start in range(0, len(rows), 10000):
+                    f.write(np.ascontiguousarray(old[[row for _, row in rows[start:start + 10000]]]).tobytes())
+            del old
+
+            # the index switches to the new file in a single transaction, an interrupted compaction leaves
+            # the old file in use
+            self._conn.executemany("UPDATE embedding_cache SET row = ? WHERE key = ?",
+                                   [(new_row, key) for new_row, (key, _) in enumerate(rows)])
+            self._conn.execute("UPDATE meta SET value = ? WHERE name = 'vectors_file'", (vectors_file,))
+            self._conn.commit()
+
+            os.remove(self._vectors_path())
+            self._vectors_file = vectors_file
+            self._rows = len(rows)
+            self._vectors = None
+            self._mapped_rows = 0
+            logger.info(f"Embedding cache compacted: {garbage} evicted rows removed, {self._rows} rows left")
+            return garbage
+
+    def stats(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total else 0.0
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": hit_rate,
+                "size_mb": self._rows * self._row_bytes / 2 ** 20}
+
+    def log_stats(self):
+        stats = self.stats()
+        logger.info(f"Embedding cache ({self._dir_path}): hits: {stats['hits']}, misses: {stats['misses']}, "
+                    f"hit rate: {stats['hit_rate']:.2%}, size: {stats['size_mb']:.1f} MB")
@@ -0,0 +1,70 @@
+import os
+import threading
+from loguru import logger
+
+# encoding is CPU bound, sources processed concurrently take turns instead of oversubscribing the cores
+ENCODE_LOCK = threading.Lock()
+
+
+def get_embedding_text(doc):
+    """Text that is embedded for a doc: its title followed by the summary, or the body if no summary exists."""
+    doc_text = doc['_source'].get('title')
+    doc_summary = doc['_source'].get('summary')
+    if not doc_summary:
+        doc_text += f" \n{doc['_source'].get('body')}"
+    else:
+        doc_text += f" \n{doc_summary}"
+    return doc_text
+
+
+def encode_texts(model, texts, batch_size, cache=None):
+    """
+    Encode a list of texts in one call to the model.
+    Texts are sorted by length before encoding so each batch holds similar sized inputs and little
+    compute is wasted on padding; the vectors are returned in the original order.
+    :param cache: EmbeddingCache, only the texts it doesn't hold are encoded and their vectors are added to it
+    """
+    vectors = [None] * len(texts)
+    if cache is not None:
+        for i, vector in enumerate(cache.get_many(texts)):
+            if vector is not None:
+                # the same python floats as the vector of an encoded text, if the cache is float32
+                vectors[i] = vector.tolist()
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    if not missing:
+        logger.info(f"all {len(texts)} texts found in the embedding cache")
+        return vectors
+
+    order = sorted(missing, key=lambda i: len(texts[i]))
+    with ENCODE_LOCK:
+        sorted_vectors = model.encode([texts[i] for i in order], batch_size=batch_size, normalize_embeddings=True)
+    if cache is not None:
+        cache.set_many([texts[i] for i in order], sorted_vectors)
+
+    for position, i in enumerate(order):
+        vectors[i] = sorted_vectors[position].tolist()
+    logger.info(f"encoded {len(missing)} texts, {len(texts) - len(missing)} found in the embedding cache")
+    return vectors
+
+
+def load_onnx_model(model_name, export_dir, quantization=None):
+    """
+    SentenceTransformer of `model_name` running in ONNX Runtime, with the same `encode` as the PyTorch one.
+    The model is exported to `export_dir` on first use and loaded from there afterwards.
+    :param quantization: str, instruction set ('avx512_vnni', 'avx2' or 'arm64') of a dynamically int8 quantized
+        export, the float32 export is used if None
+    """
+    from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+
+    model_dir = os.path.join(export_dir, model_name.replace("/", "__"))
+    if not os.path.exists(os.path.join(model_dir, "modules.json")):
+        logger.info(f"Exporting {model_name} to ONNX: {model_dir}")
+        SentenceTransformer(model_name, backend="onnx").save_pretrained(model_dir)
+
+    file_name = os.path.join("onnx", f"model_qint8_{quantization}.onnx" if quantization else "model.onnx")
+    if quantization and not os.path.exists(os.path.join(model_dir, file_name)):
+        logger.info(f"Quantizing the ONNX export of {model_name} to int8 for {quantization}")
+        export_dynamic_quantized_onnx_model(SentenceTransformer(model_dir, backend="onnx"),
+                                            quantization_config=quantization, model_name_or_path=model_dir)
+    logger.info(f"Loading {model_name} in ONNX Runtime: {file_name}")
+    return SentenceTransformer(model_dir, backend="onnx", model_kwargs={"file_name": file_name})
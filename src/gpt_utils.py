@@ -1,62 +1,119 @@
-import sys
+import json
+import random
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import openai
 from openai.error import APIError, PermissionError, AuthenticationError, InvalidAPIType, ServiceUnavailableError
 import time
 from ast import literal_eval
 import re
 from loguru import logger
-import tiktoken
 
-from src.config import OPENAI_API_KEY, OPENAI_ORG_KEY, TOKENIZER, CHAT_COMPLETION_MODEL
+from src.config import OPENAI_API_KEY, OPENAI_ORG_KEY, CHAT_COMPLETION_MODEL, get_tokenizer, \
+    OPENAI_REQUESTS_PER_MINUTE, OPENAI_TOKENS_PER_MINUTE, OPENAI_MAX_WORKERS, OPENAI_MAX_RETRIES, \
+    TOPIC_PACKING_TOKEN_BUDGET, TOPIC_PACKING_MAX_DOCS, get_topic_cache
+from src.rate_limiter import RateLimiter
+from src.topic_cache import TopicCache
 from src.utils import clean_text
 
 openai.organization = OPENAI_ORG_KEY
 openai.api_key = OPENAI_API_KEY
 
+# shared by every thread sending requests to OpenAI so the org quota is respected as a whole
+OPENAI_RATE_LIMITER = RateLimiter(requests_per_minute=OPENAI_REQUESTS_PER_MINUTE,
+                                  tokens_per_minute=OPENAI_TOKENS_PER_MINUTE)
+# chunks of a document are sent on their own pool so document workers waiting on them can never deadlock
+CHUNK_EXECUTOR = ThreadPoolExecutor(max_workers=OPENAI_MAX_WORKERS, thread_name_prefix="gpt-chunk")
+MAX_RESPONSE_TOKENS = 300
+PACKED_RESPONSE_TOKENS_PER_DOC = 60
+
+TOPIC_MODELING_SYSTEM_PROMPT = "You are an AI assistant tasked with classifying content into specific " \
+                               "topics. Your function is to extract relevant keywords from a given text, " \
+                               "based on a predefined list of topics. Remember, the keywords you identify " \
+                               "should only be ones that appear in the provided topic list."
+
+TOPIC_MODELING_PROMPT_TEMPLATE = """Analyze the following content and extract the relevant keywords from the provided TOPIC_LIST.
+    The keywords should only be selected from the given TOPIC_LIST and match the content of the text.
+    TOPIC_LIST = {topic_list} \n\nCONTENT: {text}
+    \nBased on these guidelines:
+    1. Only keywords from the TOPIC_LIST should be used.
+    2. Output should be a Python list of relevant keywords from the TOPIC_LIST that describe the CONTENT.
+    3. If the provided CONTENT does not contain any relevant keywords from the given TOPIC_LIST output an empty Python List ie., [].
+    \nPlease provide the list of relevant topics.
+    The relevant topics extracted from the provided content are: """
+
+PACKED_TOPIC_MODELING_PROMPT_TEMPLATE = """Analyze each of the following documents and extract the relevant keywords from the provided TOPIC_LIST.
+    The keywords should only be selected from the given TOPIC_LIST and match the content of the document.
+    TOPIC_LIST = {topic_list} \n\nDOCUMENTS:\n{documents}
+    \nBased on these guidelines:
+    1. Only keywords from the TOPIC_LIST should be used.
+    2. Output should be a JSON object that maps the number of every document to a list of relevant keywords from the TOPIC_LIST that describe it, e.g. {{"1": ["Taproot"], "2": []}}.
+    3. If a document does not contain any relevant keywords from the given TOPIC_LIST map its number to an empty list ie., [].
+    \nPlease provide the JSON object of relevant topics.
+    The relevant topics extracted from the provided documents are: """
+
 
 def tiktoken_len(text):
-    tokenizer = tiktoken.get_encoding("cl100k_base")
-    tokens = tokenizer.encode(text, disallowed_special=())
+    tokens = get_tokenizer().encode(text, disallowed_special=())
     return len(tokens)
 
 
 def split_prompt_into_chunks(prompt, chunk_size=2100):
-    tokens = TOKENIZER.encode(prompt)
+    tokenizer = get_tokenizer()
+    tokens = tokenizer.encode(prompt)
     chunks = []
     while len(tokens) > 0:
-        current_chunk = TOKENIZER.decode(tokens[:chunk_size]).strip()
+        current_chunk = tokenizer.decode(tokens[:chunk_size]).strip()
         if current_chunk:
             chunks.append(current_chunk)
         tokens = tokens[chunk_size:]
     return chunks
 
 
-def generate_topics_for_text(text, topic_list):
-    logger.info(f"generating keywords ... ")
-    topic_modeling_prompt = f"""Analyze the following content and extract the relevant keywords from the provided TOPIC_LIST.
-    The keywords should only be selected from the given TOPIC_LIST and match the content of the text.
-    TOPIC_LIST = {topic_list} \n\nCONTENT: {text}
-    \nBased on these guidelines:
-    1. Only keywords from the TOPIC_LIST should be used.
-    2. Output should be a Python list of relevant keywords from the TOPIC_LIST that describe the CONTENT.
-    3. If the provided CONTENT does not contain any relevant keywords from the given TOPIC_LIST output an empty Python List ie., [].
-    \nPlease provide the list of relevant topics.
-    The relevant topics extracted from the provided content are: """
+def create_chat_completion(prompt_tokens, **kwargs):
+    """
+    Send a chat completion request once the shared rate limiter has budget for it.
+    Rate limit and service unavailable errors are retried with exponential backoff and jitter,
+    the error is raised again once `OPENAI_MAX_RETRIES` is exhausted.
+    """
+    for attempt in range(OPENAI_MAX_RETRIES + 1):
+        OPENAI_RATE_LIMITER.acquire(tokens=prompt_tokens + kwargs.get("max_tokens", 0))
+        try:
+            return openai.ChatCompletion.create(**kwargs)
+        except (openai.error.RateLimitError, ServiceUnavailableError) as ex:
+            if attempt == OPENAI_MAX_RETRIES:
+                raise
+            delay = min(60, 2 ** attempt) + random.uniform(0, 1)
+            logger.warning(f"{type(ex).__name__}, retrying in {delay:.1f} seconds (attempt {attempt + 1})")
+            time.sleep(delay)
 
-    time.sleep(2)
-    logger.info(f"token length: {tiktoken_len(topic_modeling_prompt)}")
 
-    response = openai.ChatCompletion.create(
+def generate_topics_for_text(text, topic_list):
+    logger.info(f"generating keywords ... ")
+    topic_modeling_prompt = TOPIC_MODELING_PROMPT_TEMPLATE.format(topic_list=topic_list, text=text)
+
+    # identical content with the same model, prompt and topics gets the same answer, so it's served from the cache
+    cache_key = None
+    topic_cache = get_topic_cache()
+    if topic_cache is not None:
+        cache_key = TopicCache.make_key(CHAT_COMPLETION_MODEL, TOPIC_MODELING_SYSTEM_PROMPT,
+                                        TOPIC_MODELING_PROMPT_TEMPLATE, topic_list, text)
+        cached_response = topic_cache.get(cache_key)
+        if cached_response is not None:
+            logger.info(f"cached Keywords for this chunk: {cached_response}")
+            return cached_response
+
+    prompt_tokens = tiktoken_len(topic_modeling_prompt)
+    logger.info(f"token length: {prompt_tokens}")
+
+    response = create_chat_completion(
+        prompt_tokens=prompt_tokens,
         model=CHAT_COMPLETION_MODEL,
         messages=[
-            {"role": "system", "content": "You are an AI assistant tasked with classifying content into specific "
-                                          "topics. Your function is to extract relevant keywords from a given text, "
-                                          "based on a predefined list of topics. Remember, the keywords you identify "
-                                          "should only be ones that appear in the provided topic list."},
+            {"role": "system", "content": TOPIC_MODELING_SYSTEM_PROMPT},
             {"role": "user", "content": f"{topic_modeling_prompt}"},
         ],
         temperature=0.0,
-        max_tokens=300,
+        max_tokens=MAX_RESPONSE_TOKENS,
         top_p=1.0,
         frequency_penalty=0.0,
         presence_penalty=1.0
@@ -65,66 +122,163 @@ def generate_topics_for_text(text, topic_list):
     response_str = response_str.replace("The relevant topics for the given content are: ", "").strip()
     response_str = response_str.replace("The relevant topics extracted from the provided content are: ", "").strip()
     logger.info(f"generated Keywords for this chunk: {response_str}")
+
+    if topic_cache is not None:
+        topic_cache.set(cache_key, response_str)
     return response_str
 
 
-def get_keywords_for_text(text_chunks, topic_list):
-    logger.info(f"Number of chunks: {len(text_chunks)}")
-    keywords_list = []
-    for prompt in text_chunks:
+def format_packed_documents(texts):
+    return "\n\n".join(f"### DOCUMENT {doc_number}\n{text}" for doc_number, text in enumerate(texts, start=1))
+
+
+def parse_packed_keywords(response_str, num_docs):
+    """Parse a packed response into a dict of document number -> list of keywords, unusable entries are left out."""
+    start, end = response_str.find("{"), response_str.rfind("}")
+    if start == -1 or end < start:
+        logger.warning(f"Packed response is not a JSON object: {response_str}")
+        return {}
+    try:
+        parsed = json.loads(response_str[start:end + 1])
+    except json.JSONDecodeError:
+        logger.warning(f"Malformed packed response: {response_str}")
+        return {}
+
+    packed_keywords = {}
+    for doc_number, keywords in parsed.items():
         try:
-            keywords = generate_topics_for_text(prompt, topic_list)
+            doc_number = int(str(doc_number).upper().replace("DOCUMENT", "").strip())
+        except ValueError:
+            continue
+        if 1 <= doc_number <= num_docs and isinstance(keywords, list):
+            packed_keywords[doc_number] = [str(keyword) for keyword in keywords]
+    return packed_keywords
+
+
+def generate_topics_for_packed_texts(texts, topic_list):
+    """
+    Get the keywords of several short texts with a single request.
+    :return: list with the keywords of every text, None for the texts the response didn't cover
+    """
+    results = [None] * len(texts)
+    cache_keys = [None] * len(texts)
+    topic_cache = get_topic_cache()
+    if topic_cache is not None:
+        for idx, text in enumerate(texts):
+            cache_keys[idx] = TopicCache.make_key(CHAT_COMPLETION_MODEL, TOPIC_MODELING_SYSTEM_PROMPT,
+                                                  PACKED_TOPIC_MODELING_PROMPT_TEMPLATE, topic_list, text)
+            cached_response = topic_cache.get(cache_keys[idx])
+            if cached_response is not None:
+                results[idx] = json.loads(cached_response)
+
+    pending = [idx for idx, keywords in enumerate(results) if keywords is None]
+    if not pending:
+        return results
+
+    packed_prompt = PACKED_TOPIC_MODELING_PROMPT_TEMPLATE.format(
+        topic_list=topic_list, documents=format_packed_documents([texts[idx] for idx in pending])
+    )
+    prompt_tokens = tiktoken_len(packed_prompt)
+    logger.info(f"generating keywords for {len(pending)} packed docs ... token length: {prompt_tokens}")
 
-            if keywords == "[]" or keywords == "['']":
-                continue
+    response = create_chat_completion(
+        prompt_tokens=prompt_tokens,
+        model=CHAT_COMPLETION_MODEL,
+        messages=[
+            {"role": "system", "content": TOPIC_MODELING_SYSTEM_PROMPT},
+            {"role": "user", "content": f"{packed_prompt}"},
+        ],
+        temperature=0.0,
+        max_tokens=PACKED_RESPONSE_TOKENS_PER_DOC * len(pending),
+        top_p=1.0,
+        frequency_penalty=0.0,
+        # the document numbers repeat in the answer, so repeated tokens must not be penalized
+        presence_penalty=0.0
+    )
+    response_str = response['choices'][0]['message']['content'].strip()
+    packed_keywords = parse_packed_keywords(response_str, num_docs=len(pending))
+    logger.info(f"generated Keywords for {len(packed_keywords)}/{len(pending)} packed docs: {packed_keywords}")
 
-            # keywords = re.sub(r"(\w)'s", r'\1\'s', keywords)
-            # keywords = re.sub(r"(\w)'t", r'\1\'t', keywords)
-            keywords = re.sub(r"(\w)'(\w)", r'\1\'\2', keywords)
+    for doc_number, idx in enumerate(pending, start=1):
+        if doc_number in packed_keywords:
+            results[idx] = packed_keywords[doc_number]
+            if topic_cache is not None:
+                topic_cache.set(cache_keys[idx], json.dumps(results[idx]))
+    return results
 
-            if keywords.startswith("['") and not (keywords.endswith("']") or keywords.endswith('"]')):
-                logger.warning(f"Model hallucination: {keywords}")
 
-                if keywords.endswith("',"):
-                    keywords = keywords[:-1] + "]"
+def parse_keywords(keywords):
+    """Parse the model response into a list of keywords, fixing common malformed Python lists."""
+    if keywords == "[]" or keywords == "['']":
+        return []
 
-                elif keywords.endswith("', '"):
-                    keywords = keywords[:-3] + "]"
+    # keywords = re.sub(r"(\w)'s", r'\1\'s', keywords)
+    # keywords = re.sub(r"(\w)'t", r'\1\'t', keywords)
+    keywords = re.sub(r"(\w)'(\w)", r'\1\'\2', keywords)
 
-                elif keywords.endswith("'"):
-                    keywords = keywords + "]"
+    if keywords.startswith("['") and not (keywords.endswith("']") or keywords.endswith('"]')):
+        logger.warning(f"Model hallucination: {keywords}")
 
-                elif keywords.endswith("',..."):
-                    keywords = keywords[:-4] + "]"
+        if keywords.endswith("',"):
+            keywords = keywords[:-1] + "]"
 
-                elif keywords.endswith("', ...]"):
-                    keywords = keywords[:-6] + "]"
+        elif keywords.endswith("', '"):
+            keywords = keywords[:-3] + "]"
 
-                else:
-                    keywords = keywords + "']"
+        elif keywords.endswith("'"):
+            keywords = keywords + "]"
 
-                logger.warning(f"Keywords after fix: {keywords}")
+        elif keywords.endswith("',..."):
+            keywords = keywords[:-4] + "]"
 
-            elif not keywords.startswith("['") and not keywords.endswith("']"):
-                logger.warning(f"Elif: {keywords}")
-                continue
+        elif keywords.endswith("', ...]"):
+            keywords = keywords[:-6] + "]"
 
-            if isinstance(keywords, str):
-                keywords = literal_eval(keywords)
-            else:
-                logger.warning(f"Keywords Type: {keywords}")
+        else:
+            keywords = keywords + "']"
 
-            keywords_list.extend(keywords)
+        logger.warning(f"Keywords after fix: {keywords}")
 
-        except openai.error.RateLimitError as rate_limit:
-            logger.error(f'Rate limit error occurred: {rate_limit}')
-            sys.exit(f"{rate_limit}")
+    elif not keywords.startswith("['") and not keywords.endswith("']"):
+        logger.warning(f"Elif: {keywords}")
+        return []
 
-        except openai.error.InvalidRequestError as invalid_req:
-            logger.error(f'Invalid request error occurred: {invalid_req}')
+    if isinstance(keywords, str):
+        keywords = literal_eval(keywords)
+    else:
+        logger.warning(f"Keywords Type: {keywords}")
 
-        except (APIError, PermissionError, AuthenticationError, InvalidAPIType, ServiceUnavailableError) as ex:
-            logger.error(f'Other error occurred: {str(ex)}')
+    return keywords
+
+
+def get_keywords_for_chunk(prompt, topic_list):
+    try:
+        keywords = generate_topics_for_text(prompt, topic_list)
+        return parse_keywords(keywords)
+
+    except openai.error.RateLimitError as rate_limit:
+        # retries are exhausted, let the caller skip this document instead of storing incomplete topics
+        logger.error(f'Rate limit error occurred: {rate_limit}')
+        raise
+
+    except openai.error.InvalidRequestError as invalid_req:
+        logger.error(f'Invalid request error occurred: {invalid_req}')
+
+    except (APIError, PermissionError, AuthenticationError, InvalidAPIType, ServiceUnavailableError) as ex:
+        logger.error(f'Other error occurred: {str(ex)}')
+
+    return []
+
+
+def get_keywords_for_text(text_chunks, topic_list):
+    logger.info(f"Number of chunks: {len(text_chunks)}")
+    keywords_list = []
+    if len(text_chunks) == 1:
+        keywords_list.extend(get_keywords_for_chunk(text_chunks[0], topic_list))
+    else:
+        futures = [CHUNK_EXECUTOR.submit(get_keywords_for_chunk, prompt, topic_list) for prompt in text_chunks]
+        for future in futures:
+            keywords_list.extend(future.result())
 
     logger.success(f"Generated keywords: {keywords_list}")
     return list(set(keywords_list))
@@ -139,9 +293,129 @@ def get_primary_and_secondary_keywords(keywords_list, topic_list):
     return primary_keywords, secondary_keywords
 
 
-def apply_topic_modeling(text, topic_list):
+def apply_topic_modeling(text, topic_list, candidate_topics=None):
+    """
+    :param candidate_topics: list, only these topics are sent in the prompt if given, keywords are still
+        split into primary and secondary ones against the full `topic_list`
+    """
     text_chunks = split_prompt_into_chunks(text)
-    keywords_list = get_keywords_for_text(text_chunks=text_chunks, topic_list=topic_list)
+    keywords_list = get_keywords_for_text(text_chunks=text_chunks, topic_list=candidate_topics or topic_list)
     primary_keywords, secondary_keywords = get_primary_and_secondary_keywords(keywords_list=keywords_list,
                                                                               topic_list=topic_list)
     return primary_keywords, secondary_keywords
+
+
+def apply_topic_modeling_packed(texts, topic_list, candidate_topics=None):
+    """
+    Same as `apply_topic_modeling` for several short texts sent with a single request.
+    Texts the packed response didn't cover are sent again on their own.
+    :param candidate_topics: list with the candidate topics of every text or None, the packed prompt
+        holds the union of them
+    :return: list of (primary_keywords, secondary_keywords) for every text
+    """
+    candidate_topics = candidate_topics or [None] * len(texts)
+    prompt_topics = topic_list
+    if all(candidate_topics):
+        prompt_topics = list(dict.fromkeys(topic for candidates in candidate_topics for topic in candidates))
+    try:
+        packed_keywords = generate_topics_for_packed_texts(texts, prompt_topics)
+
+    except openai.error.RateLimitError as rate_limit:
+        logger.error(f'Rate limit error occurred: {rate_limit}')
+        raise
+
+    except (openai.error.InvalidRequestError, APIError, PermissionError, AuthenticationError, InvalidAPIType,
+            ServiceUnavailableError) as ex:
+        logger.error(f'Packed request failed, sending docs on their own: {str(ex)}')
+        packed_keywords = [None] * len(texts)
+
+    results = []
+    for text, candidates, keywords in zip(texts, candidate_topics, packed_keywords):
+        if keywords is None:
+            results.append(apply_topic_modeling(text, topic_list, candidate_topics=candidates))
+        else:
+            results.append(get_primary_and_secondary_keywords(keywords_list=list(set(keywords)),
+                                                              topic_list=topic_list))
+    return results
+
+
+def pack_topic_modeling_items(items, topic_list, token_budget, max_docs):
+    """
+    Group items into packs of short texts whose packed prompt stays within `token_budget` tokens.
+    Texts too long to share a prompt come out as packs of their own.
+    :return: generator of lists of items
+    """
+    overhead_tokens = tiktoken_len(PACKED_TOPIC_MODELING_PROMPT_TEMPLATE.format(topic_list=topic_list, documents=""))
+    content_budget = token_budget - overhead_tokens
+    if content_budget <= 0:
+        logger.warning(f"Topic list alone takes {overhead_tokens} tokens, packing is disabled")
+
+    pack, pack_tokens = [], 0
+    for item in items:
+        # the document header adds a few tokens on top of the text
+        text_tokens = tiktoken_len(item[1]) + 8
+        if text_tokens > content_budget // 2:
+            yield [item]
+            continue
+        if pack and (pack_tokens + text_tokens > content_budget or len(pack) >= max_docs):
+            yield pack
+            pack, pack_tokens = [], 0
+        pack.append(item)
+        pack_tokens += text_tokens
+    if pack:
+        yield pack
+
+
+def apply_topic_modeling_concurrently(items, topic_list, max_workers=OPENAI_MAX_WORKERS,
+                                      pack_token_budget=TOPIC_PACKING_TOKEN_BUDGET, pack_max_docs=TOPIC_PACKING_MAX_DOCS):
+    """
+    Run `apply_topic_modeling` on many documents at once while the shared rate limiter keeps
+    requests within the OpenAI quota. Only a bounded number of documents is in flight, so `items`
+    can be a lazy stream.
+    :param items: iterable of (key, text) or (key, text, candidate_topics) tuples, candidate topics narrow
+        down the topics sent in the prompt of that document
+    :param topic_list: list of topics
+    :param max_workers: int, no. of requests processed concurrently
+    :param pack_token_budget: int, short documents are packed into requests of up to this many prompt tokens,
+        every document is sent on its own if 0
+    :param pack_max_docs: int, max. no. of documents in one packed request
+    :return: generator of (key, primary_keywords, secondary_keywords, error) in completion order
+    """
+    if pack_token_budget:
+        packs = pack_topic_modeling_items(items, topic_list, token_budget=pack_token_budget, max_docs=pack_max_docs)
+    else:
+        packs = ([item] for item in items)
+
+    def run_pack(pack):
+        texts = [item[1] for item in pack]
+        candidate_topics = [item[2] if len(item) > 2 else None for item in pack]
+        if len(pack) == 1:
+            return [apply_topic_modeling(texts[0], topic_list, candidate_topics=candidate_topics[0])]
+        return apply_topic_modeling_packed(texts, topic_list, candidate_topics=candidate_topics)
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="gpt-doc") as executor:
+        in_flight = {}
+
+        def submit_next():
+            try:
+                pack = next(packs)
+            except StopIteration:
+                return False
+            in_flight[executor.submit(run_pack, pack)] = [item[0] for item in pack]
+            return True
+
+        for _ in range(max_workers * 2):
+            if not submit_next():
+                break
+
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                keys = in_flight.pop(future)
+                try:
+                    for key, (primary_keywords, secondary_keywords) in zip(keys, future.result()):
+                        yield key, primary_keywords, secondary_keywords, None
+                except Exception as ex:
+                    for key in keys:
+                        yield key, [], [], ex
+                submit_next()
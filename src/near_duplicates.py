@@ -0,0 +1,199 @@
+import json
+import os
+import re
+import zlib
+from collections import defaultdict
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+# hashes are reduced modulo a prime below 2^31, so `a * x + b` never overflows 64 bits
+MINHASH_PRIME = (1 << 31) - 1
+regex_word = re.compile(r"\w+")
+# reply prefixes and list tags, e.g. "Re: [bitcoin-dev] ", that mirrors of a post don't always agree on
+regex_title_noise = re.compile(r"^(?:\s*(?:(?:re|fwd?|aw)\s*:|\[[^\]]*\]))+", re.IGNORECASE)
+
+
+def normalize_title(title):
+    """Title with reply prefixes, list tags, case and whitespace removed, to compare the titles of mirrors."""
+    return " ".join(regex_title_noise.sub("", title or "").lower().split())
+
+
+class NearDuplicateIndex:
+    """
+    MinHash/LSH index of preprocessed doc bodies that finds near-duplicates, e.g. the same mailing list post
+    archived under different urls. Adding a doc costs one signature and `bands` bucket lookups, so building
+    the index is linear in the no. of docs.
+    Every doc gets a representative: the earliest added doc whose estimated Jaccard similarity with it
+    reaches `threshold`, or itself. Docs sharing a representative form a cluster, and the crons can
+    reuse the results of the representative instead of recomputing them, see `reusable_representative`.
+    Docs with fewer than `min_shingles` distinct shingles aren't indexed: one-line replies of unrelated
+    threads, e.g. "+1" or "Thanks!", would get identical signatures.
+    """
+    SIGNATURES_FILE = "signatures.npy"
+    METADATA_FILE = "metadata.json"
+
+    def __init__(self, num_perm=128, bands=16, threshold=0.8, shingle_size=5, seed=1, min_shingles=20):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands})")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.seed = seed
+        self.min_shingles = min_shingles
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, MINHASH_PRIME, size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, MINHASH_PRIME, size=num_perm, dtype=np.uint64)
+
+        self._keys = []
+        self._positions = {}
+        self._docs = []
+        self._representatives = []
+        self._signatures = []
+        self._buckets = [defaultdict(list) for _ in range(bands)]
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._positions
+
+    def signature(self, text):
+        """MinHash signature of the word shingles of `text`, None if it has fewer than `min_shingles` of them."""
+        words = regex_word.findall(text.lower())
+        if not words:
+            return None
+        size = min(self.shingle_size, len(words))
+        shingles = {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+        if len(shingles) < self.min_shingles:
+            return None
+        hashes = np.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in shingles), dtype=np.uint64,
+                             count=len(shingles)) % MINHASH_PRIME
+        return ((self._a[:, None] * hashes[None, :] + self._b[:, None]) % MINHASH_PRIME).min(axis=1).astype(np.uint32)
+
+    def _band_keys(self, signature):
+        return [band.tobytes() for band in np.split(signature, self.bands)]
+
+    def query(self, text=None, signature=None):
+        """Keys of the indexed docs whose estimated Jaccard similarity with `text` reaches `threshold`."""
+        signature = self.signature(text) if signature is None else signature
+        if signature is None:
+            return []
+        return [self._keys[position] for position, _ in self._matches(signature)]
+
+    def _matches(self, signature):
+        candidates = set()
+        for bucket, band_key in zip(self._buckets, self._band_keys(signature)):
+            candidates.update(bucket.get(band_key, ()))
+        matches = []
+        for position in candidates:
+            similarity = float(np.mean(self._signatures[position] == signature))
+            if similarity >= self.threshold:
+                matches.append((position, similarity))
+        return sorted(matches, key=lambda match: -match[1])
+
+    def add(self, key, text, **metadata):
+        """
+        Index a doc, `metadata` is kept with it, e.g. its elasticsearch `_id`.
+        :return: key of the representative of the doc, None if it is too short to be indexed
+        """
+        if key in self._positions:
+            return self.representative(key)
+        signature = self.signature(text)
+        if signature is None:
+            return None
+
+        matches = self._matches(signature)
+        position = len(self._keys)
+        representative = self._representatives[matches[0][0]] if matches else position
+
+        self._keys.append(key)
+        self._positions[key] = position
+        self._docs.append(metadata)
+        self._representatives.append(representative)
+        self._signatures.append(signature)
+        for bucket, band_key in zip(self._buckets, self._band_keys(signature)):
+            bucket[band_key].append(position)
+        return self._keys[representative]
+
+    def representative(self, key):
+        """Key of the representative of an indexed doc, None if it isn't indexed."""
+        position = self._positions.get(key)
+        return None if position is None else self._keys[self._representatives[position]]
+
+    def reusable_representative(self, key, title):
+        """
+        Key of the representative of an indexed doc if it is another doc with the same title, see
+        `normalize_title`, None otherwise. Replies of different threads can quote the same text, their
+        results are only reused if their titles match too. Needs the 'title' metadata.
+        """
+        representative = self.representative(key)
+        if representative is None or representative == key:
+            return None
+        title = normalize_title(title)
+        if not title or title != normalize_title(self.metadata(representative).get("title")):
+            return None
+        return representative
+
+    def metadata(self, key):
+        position = self._positions.get(key)
+        return None if position is None else self._docs[position]
+
+    def clusters(self):
+        """dict of representative key -> keys of all docs in its cluster, for clusters of 2 or more docs."""
+        clusters = defaultdict(list)
+        for position, representative in enumerate(self._representatives):
+            clusters[representative].append(self._keys[position])
+        return {self._keys[representative]: keys for representative, keys in clusters.items() if len(keys) > 1}
+
+    def clusters_df(self):
+        rows = []
+        for cluster_no, (representative, keys) in enumerate(self.clusters().items()):
+            for key in keys:
+                rows.append({"cluster": cluster_no, "representative": representative, "key": key,
+                             **self.metadata(key)})
+        return pd.DataFrame(rows)
+
+    def save(self, dir_path):
+        os.makedirs(dir_path, exist_ok=True)
+        signatures = np.asarray(self._signatures, dtype=np.uint32).reshape(-1, self.num_perm)
+        np.save(os.path.join(dir_path, self.SIGNATURES_FILE), signatures)
+        with open(os.path.join(dir_path, self.METADATA_FILE), "w", encoding="utf-8") as f:
+            json.dump({
+                "params": {"num_perm": self.num_perm, "bands": self.bands, "threshold": self.threshold,
+                           "shingle_size": self.shingle_size, "seed": self.seed,
+                           "min_shingles": self.min_shingles},
+                "keys": self._keys,
+                "docs": self._docs,
+                "representatives": self._representatives
+            }, f)
+        logger.success(f"Near duplicate index of {len(self)} docs saved at path: {dir_path}")
+
+    @classmethod
+    def load(cls, dir_path):
+        with open(os.path.join(dir_path, cls.METADATA_FILE), encoding="utf-8") as f:
+            data = json.load(f)
+        # indexes saved before short docs were skipped hold docs of any length
+        index = cls(**{"min_shingles": 0, **data["params"]})
+        index._keys = data["keys"]
+        index._positions = {key: position for position, key in enumerate(index._keys)}
+        index._docs = data["docs"]
+        index._representatives = data["representatives"]
+        index._signatures = list(np.load(os.path.join(dir_path, cls.SIGNATURES_FILE)))
+        for position, signature in enumerate(index._signatures):
+            for bucket, band_key in zip(index._buckets, index._band_keys(signature)):
+                bucket[band_key].append(position)
+        return index
+
+    @classmethod
+    def load_if_exists(cls, dir_path):
+        if os.path.exists(os.path.join(dir_path, cls.METADATA_FILE)):
+            index = cls.load(dir_path)
+            if index.min_shingles:
+                return index
+            logger.warning(f"Near duplicate index at path: {dir_path} holds docs of any length, "
+                           f"it is ignored until find_near_duplicates.py rebuilds it")
+            return None
+        logger.info(f"No near duplicate index found at path: {dir_path}")
+        return None
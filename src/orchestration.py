@@ -0,0 +1,46 @@
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from loguru import logger
+
+from src.config import SOURCE_MAX_WORKERS, SOURCES_PER_QUERY
+
+
+def group_sources(dev_urls, sources_per_query=SOURCES_PER_QUERY):
+    """
+    Split `dev_urls` into lists of at most `sources_per_query` urls, each list is fetched with a single query
+    and routed back per domain. A single list of all urls if `sources_per_query` is 0.
+    """
+    if not sources_per_query:
+        return [list(dev_urls)]
+    return [list(dev_urls[start:start + sources_per_query]) for start in range(0, len(dev_urls), sources_per_query)]
+
+
+def run_sources_concurrently(dev_urls, pipeline, max_workers=SOURCE_MAX_WORKERS, **kwargs):
+    """
+    Run `pipeline(dev_url, **kwargs)` for every source, or group of sources, on a bounded thread pool.
+    A failing source is logged and doesn't stop the others. Requests to OpenAI and elasticsearch
+    go through the process-wide rate limiters, so they are shared by all sources.
+    :param dev_urls: list of source urls, or of lists of urls, see `group_sources`
+    :param pipeline: callable that processes a single source or group
+    :param max_workers: int, no. of sources processed concurrently
+    :return: dict of dev_url (a tuple for a group) -> result of the pipeline, or the exception it raised
+    """
+    start_time = time.time()
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="source") as executor:
+        futures = {executor.submit(pipeline, dev_url, **kwargs): dev_url for dev_url in dev_urls}
+        for future in as_completed(futures):
+            dev_url = tuple(futures[future]) if isinstance(futures[future], list) else futures[future]
+            try:
+                results[dev_url] = future.result()
+                logger.success(f"Source completed: {dev_url}")
+            except Exception as ex:
+                results[dev_url] = ex
+                logger.error(f"Source failed: {dev_url} | {ex}\n"
+                             f"{''.join(traceback.format_exception(type(ex), ex, ex.__traceback__))}")
+
+    failed = [dev_url for dev_url, result in results.items() if isinstance(result, Exception)]
+    logger.info(f"{len(dev_urls) - len(failed)}/{len(dev_urls)} sources completed in "
+                f"{time.time() - start_time:.2f} seconds. Failed: {failed}")
+    return results
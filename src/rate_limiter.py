@@ -0,0 +1,62 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """Thread-safe token bucket that refills continuously at `capacity` tokens per minute."""
+
+    def __init__(self, capacity):
+        self._capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._refill_rate = self._capacity / 60.0
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self._capacity, self._tokens + (now - self._last_refill) * self._refill_rate)
+        self._last_refill = now
+
+    def try_acquire(self, amount):
+        """Take `amount` tokens if available, otherwise return the seconds to wait before they are."""
+        # a single request larger than the bucket would never fit, let it through once the bucket is full
+        amount = min(float(amount), self._capacity)
+        with self._lock:
+            self._refill()
+            if self._tokens >= amount:
+                self._tokens -= amount
+                return 0.0
+            return (amount - self._tokens) / self._refill_rate
+
+    def release(self, amount):
+        """Give back tokens that were reserved but not used."""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._capacity, self._tokens + float(amount))
+
+
+class RateLimiter:
+    """
+    Blocks callers so that requests stay within a requests-per-minute and a tokens-per-minute budget.
+    Either budget can be disabled by passing None.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self._request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self._token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    def acquire(self, tokens=0):
+        while True:
+            wait = self._request_bucket.try_acquire(1) if self._request_bucket else 0.0
+            if wait:
+                time.sleep(wait)
+                continue
+
+            wait = self._token_bucket.try_acquire(tokens) if self._token_bucket and tokens else 0.0
+            if wait:
+                # hand the request slot back so other callers are not starved while we wait for tokens
+                if self._request_bucket:
+                    self._request_bucket.release(1)
+                time.sleep(wait)
+                continue
+            return
@@ -0,0 +1,76 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from loguru import logger
+
+
+class TopicCache:
+    """
+    Persistent SQLite cache of topic modeling responses keyed by a content hash.
+    The cache holds at most `max_entries` rows, the least recently used ones are evicted first.
+    It is safe to share between threads.
+    """
+
+    def __init__(self, db_path, max_entries=100000):
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._db_path = db_path
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS topic_cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON topic_cache (last_access)")
+        self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(*parts):
+        digest = hashlib.sha256()
+        for part in parts:
+            digest.update(str(part).encode("utf-8"))
+            digest.update(b"\x00")
+        return digest.hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM topic_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE topic_cache SET last_access = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+            self.hits += 1
+            return row[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO topic_cache (key, value, last_access) VALUES (?, ?, ?)",
+                (key, value, time.time())
+            )
+            count = self._conn.execute("SELECT COUNT(*) FROM topic_cache").fetchone()[0]
+            if count > self._max_entries:
+                self._conn.execute(
+                    "DELETE FROM topic_cache WHERE key IN "
+                    "(SELECT key FROM topic_cache ORDER BY last_access ASC LIMIT ?)",
+                    (count - self._max_entries,)
+                )
+            self._conn.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total if total else 0.0
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": hit_rate}
+
+    def log_stats(self):
+        stats = self.stats()
+        logger.info(f"Topic cache ({self._db_path}): hits: {stats['hits']}, misses: {stats['misses']}, "
+                    f"hit rate: {stats['hit_rate']:.2%}")
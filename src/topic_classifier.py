@@ -0,0 +1,171 @@
+import ast
+import glob
+import json
+import os
+import numpy as np
+import pandas as pd
+from loguru import logger
+
+from src.config import EMBEDDING_BATCH_SIZE, EMBEDDING_MODEL_NAME
+from src.embedding_utils import encode_texts
+from src.topic_storage import read_topics_df, topic_dataset_dir
+
+
+class LocalTopicClassifier:
+    """
+    Zero-shot topic classifier that assigns `primary_topics` from the cosine similarity between a doc vector
+    and the topic embedding matrix. Every topic has its own threshold, calibrated on the topics GPT assigned
+    before, and at most `max_topics` topics are assigned per doc.
+    """
+
+    def __init__(self, topic_embeddings, thresholds, max_topics=5):
+        self._topic_embeddings = topic_embeddings
+        self._thresholds = np.asarray(thresholds, dtype=np.float32)
+        self._max_topics = max_topics
+
+    @classmethod
+    def calibrate(cls, topic_embeddings, doc_vectors, doc_topics, min_support=5, max_topics=5):
+        """
+        Pick the threshold of every topic that maximizes its F1 score on the labeled docs.
+        Topics with less than `min_support` labeled docs get the threshold that maximizes the F1 score of all topics.
+        :param doc_vectors: array-like of shape (docs, dim)
+        :param doc_topics: list with the topics assigned to every doc
+        """
+        scores = topic_embeddings.similarities(doc_vectors)
+        labels = label_matrix(topic_embeddings.topics, doc_topics)
+        thresholds, support = calibrate_thresholds(scores, labels)
+        global_threshold = calibrate_global_threshold(scores, labels)
+        thresholds[support < min_support] = global_threshold
+        logger.info(f"Calibrated thresholds on {len(doc_topics)} docs, {int((support >= min_support).sum())} topics "
+                    f"have their own threshold, global threshold: {global_threshold:.4f}")
+        return cls(topic_embeddings, thresholds, max_topics=max_topics)
+
+    def predict(self, doc_vectors):
+        """List of topics assigned to every doc vector, most similar first."""
+        scores = self._topic_embeddings.similarities(doc_vectors)
+        topics = self._topic_embeddings.topics
+        predictions = []
+        for row in scores:
+            matched = np.flatnonzero(row >= self._thresholds)
+            matched = matched[np.argsort(-row[matched])][:self._max_topics]
+            predictions.append([topics[idx] for idx in matched])
+        return predictions
+
+    def evaluate(self, doc_vectors, doc_topics):
+        """Micro precision, recall and F1 score of the predictions against the given topics."""
+        true_positives = predicted = actual = 0
+        for predicted_topics, topics in zip(self.predict(doc_vectors), doc_topics):
+            true_positives += len(set(predicted_topics) & set(topics))
+            predicted += len(predicted_topics)
+            actual += len(topics)
+        precision = true_positives / max(predicted, 1)
+        recall = true_positives / max(actual, 1)
+        f1 = 2 * precision * recall / max(precision + recall, 1e-12)
+        return {"precision": precision, "recall": recall, "f1": f1}
+
+    def classify(self, items, model, batch_size=512):
+        """
+        Assign topics to a stream of (key, text, vector) items in batches, `vector` is the stored embedding
+        of the doc or None, in which case `text` is encoded.
+        :return: generator of (key, primary_topics, secondary_topics, error), the same as
+            `apply_topic_modeling_concurrently`. Secondary topics are always empty.
+        """
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                yield from self._classify_batch(batch, model)
+                batch = []
+        if batch:
+            yield from self._classify_batch(batch, model)
+
+    def _classify_batch(self, batch, model):
+        missing = [idx for idx, (_, _, vector) in enumerate(batch) if not vector]
+        vectors = [vector for _, _, vector in batch]
+        if missing:
+            encoded = encode_texts(model, [batch[idx][1] for idx in missing], batch_size=EMBEDDING_BATCH_SIZE)
+            for idx, vector in zip(missing, encoded):
+                vectors[idx] = vector
+        for (key, _, _), topics in zip(batch, self.predict(vectors)):
+            yield key, topics, [], None
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({
+                "model_name": EMBEDDING_MODEL_NAME,
+                "max_topics": self._max_topics,
+                "thresholds": dict(zip(self._topic_embeddings.topics, self._thresholds.tolist()))
+            }, f, indent=2)
+        logger.success(f"Topic classifier saved at path: {path}")
+
+    @classmethod
+    def load(cls, path, topic_embeddings):
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        if data["model_name"] != EMBEDDING_MODEL_NAME:
+            raise ValueError(f"Topic classifier was calibrated with {data['model_name']}, "
+                             f"recalibrate it for {EMBEDDING_MODEL_NAME}")
+        missing = [topic for topic in topic_embeddings.topics if topic not in data["thresholds"]]
+        if missing:
+            raise ValueError(f"Topic classifier has no thresholds for: {missing}, recalibrate it")
+        thresholds = [data["thresholds"][topic] for topic in topic_embeddings.topics]
+        return cls(topic_embeddings, thresholds, max_topics=data["max_topics"])
+
+
+def label_matrix(topics, doc_topics):
+    """Boolean matrix of shape (docs, topics), topics unknown to `topics` are ignored."""
+    topic_index = {topic: idx for idx, topic in enumerate(topics)}
+    labels = np.zeros((len(doc_topics), len(topics)), dtype=bool)
+    for row, topics_of_doc in enumerate(doc_topics):
+        for topic in topics_of_doc:
+            if topic in topic_index:
+                labels[row, topic_index[topic]] = True
+    return labels
+
+
+def calibrate_thresholds(scores, labels):
+    """
+    Threshold of every topic (column) that maximizes its F1 score.
+    F1 = 2TP / (predicted + actual), with the docs sorted by score the no. of predicted docs of every
+    candidate threshold is its rank, so all thresholds are evaluated with one cumulative sum.
+    :return: (thresholds, support) arrays with one entry per topic
+    """
+    order = np.argsort(-scores, axis=0)
+    sorted_scores = np.take_along_axis(scores, order, axis=0)
+    true_positives = np.cumsum(np.take_along_axis(labels, order, axis=0), axis=0)
+    predicted = np.arange(1, scores.shape[0] + 1)[:, None]
+    support = labels.sum(axis=0)
+    f1 = 2 * true_positives / (predicted + support[None, :])
+    best = f1.argmax(axis=0)
+    return sorted_scores[best, np.arange(scores.shape[1])], support
+
+
+def calibrate_global_threshold(scores, labels):
+    """Single threshold for all topics that maximizes the micro F1 score."""
+    flat_scores, flat_labels = scores.ravel(), labels.ravel()
+    order = np.argsort(-flat_scores)
+    true_positives = np.cumsum(flat_labels[order])
+    f1 = 2 * true_positives / (np.arange(1, len(order) + 1) + flat_labels.sum())
+    return float(flat_scores[order[f1.argmax()]])
+
+
+def load_gpt_output_labels(output_dir="gpt_output"):
+    """dict of source_id -> primary topics stored in the topic modeling parquet dataset and csv files."""
+    labels = {}
+    parquet_df = read_topics_df(topic_dataset_dir(output_dir), columns=["primary_topics", "source_id", "source"])
+    for primary_topics, source_id in zip(parquet_df["primary_topics"], parquet_df["source_id"]):
+        if primary_topics:
+            labels[source_id] = primary_topics
+
+    parquet_sources = set(parquet_df["source"])
+    for csv_file_path in glob.glob(os.path.join(output_dir, "topic_modeling_*.csv")):
+        if os.path.basename(csv_file_path)[len("topic_modeling_"):-len(".csv")] in parquet_sources:
+            continue
+        stored_df = pd.read_csv(csv_file_path, usecols=["primary_topics", "source_id"]).dropna()
+        for primary_topics, source_id in zip(stored_df["primary_topics"], stored_df["source_id"]):
+            primary_topics = ast.literal_eval(primary_topics)
+            if primary_topics:
+                labels[source_id] = primary_topics
+    logger.info(f"labeled docs in {output_dir}: {len(labels)}")
+    return labels
@@ -0,0 +1,102 @@
+import os
+import time
+import numpy as np
+from loguru import logger
+
+from src.config import EMBEDDING_BATCH_SIZE, EMBEDDING_MODEL_NAME
+from src.embedding_utils import encode_texts
+
+
+class TopicEmbeddings:
+    """
+    Normalized embedding matrix of the topic list, persisted to disk so it is encoded once only.
+    Documents are matched against all topics with a single matrix multiplication.
+    """
+
+    def __init__(self, topics, matrix, model_name=EMBEDDING_MODEL_NAME):
+        self.topics = list(topics)
+        self.matrix = np.asarray(matrix, dtype=np.float32)
+        self.model_name = model_name
+
+    def __len__(self):
+        return len(self.topics)
+
+    @classmethod
+    def build(cls, model, topic_list):
+        start_time = time.time()
+        vectors = encode_texts(model, list(topic_list), batch_size=EMBEDDING_BATCH_SIZE)
+        topic_embeddings = cls(topic_list, normalize(np.asarray(vectors, dtype=np.float32)))
+        logger.info(f"Encoded {len(topic_embeddings)} topics in {time.time() - start_time:.2f} seconds.")
+        return topic_embeddings
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        np.savez(path, topics=np.asarray(self.topics, dtype=object), matrix=self.matrix,
+                 model_name=self.model_name)
+        logger.success(f"Topic embeddings saved at path: {path}")
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=True) as data:
+            return cls(data["topics"].tolist(), data["matrix"], model_name=str(data["model_name"]))
+
+    @classmethod
+    def load_or_build(cls, path, topic_list, model):
+        """Load the matrix from `path`, it is rebuilt if the topic list or the embedding model changed."""
+        if os.path.exists(path):
+            topic_embeddings = cls.load(path)
+            if topic_embeddings.topics == list(topic_list) and topic_embeddings.model_name == EMBEDDING_MODEL_NAME:
+                return topic_embeddings
+            logger.info(f"Topic list or embedding model changed, rebuilding: {path}")
+        topic_embeddings = cls.build(model, topic_list)
+        topic_embeddings.save(path)
+        return topic_embeddings
+
+    def similarities(self, doc_vectors):
+        """Cosine similarity of every doc vector with every topic, shape (docs, topics)."""
+        return normalize(np.asarray(doc_vectors, dtype=np.float32)) @ self.matrix.T
+
+    def top_k(self, doc_vectors, k):
+        """Indices of the `k` most similar topics of every doc vector, most similar first."""
+        scores = self.similarities(doc_vectors)
+        k = min(k, len(self))
+        candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        order = np.argsort(-np.take_along_axis(scores, candidates, axis=1), axis=1)
+        return np.take_along_axis(candidates, order, axis=1)
+
+
+class TopicPrefilter:
+    """Narrows the topic list sent to GPT down to the `top_k` topics closest to each document."""
+
+    def __init__(self, topic_embeddings, model, top_k=40, batch_size=EMBEDDING_BATCH_SIZE):
+        self._topic_embeddings = topic_embeddings
+        self._model = model
+        self._top_k = top_k
+        self._batch_size = batch_size
+
+    def select(self, texts):
+        """List of candidate topics for every text."""
+        doc_vectors = encode_texts(self._model, texts, batch_size=self._batch_size)
+        topics = self._topic_embeddings.topics
+        return [[topics[idx] for idx in row] for row in self._topic_embeddings.top_k(doc_vectors, self._top_k)]
+
+    def iter_with_candidate_topics(self, items):
+        """Turn a stream of (key, text) into (key, text, candidate_topics), encoding the texts in batches."""
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= self._batch_size:
+                yield from self._with_candidate_topics(batch)
+                batch = []
+        if batch:
+            yield from self._with_candidate_topics(batch)
+
+    def _with_candidate_topics(self, batch):
+        candidate_topics = self.select([text for _, text in batch])
+        for (key, text), candidates in zip(batch, candidate_topics):
+            yield key, text, candidates
+
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
@@ -0,0 +1,84 @@
+import ast
+import pandas as pd
+from loguru import logger
+
+from src.topic_storage import TOPIC_COLUMNS, column_to_pylist, read_topic_table
+
+
+class TopicLookup:
+    """
+    Read-only index of stored topics keyed by `source_id`, parsed once when it is loaded so a lookup is
+    a single dict access. Topic lists repeat a lot across docs, each distinct list string is parsed only once.
+    Duplicated `source_id`s are reported up front and the first row is kept, the same as `compact` does.
+    """
+
+    def __init__(self, topics, duplicates=None):
+        self._topics = topics
+        self.duplicates = duplicates or []
+
+    def __contains__(self, source_id):
+        return source_id in self._topics
+
+    def __len__(self):
+        return len(self._topics)
+
+    def __iter__(self):
+        return iter(self._topics)
+
+    def get(self, source_id):
+        """(primary_topics, secondary_topics) of `source_id`, None if it isn't stored."""
+        topics = self._topics.get(source_id)
+        if topics is None:
+            return None
+        return list(topics[0]), list(topics[1])
+
+    @classmethod
+    def from_csv(cls, csv_path):
+        stored_df = pd.read_csv(csv_path, usecols=['primary_topics', 'secondary_topics', 'source_id'],
+                                dtype=str, keep_default_na=False)
+        is_duplicate = stored_df.duplicated('source_id', keep='first').to_numpy()
+        duplicates = stored_df.loc[is_duplicate, 'source_id'].unique().tolist()
+        if duplicates:
+            logger.warning(f"{len(duplicates)} duplicated source_ids in {csv_path}, keeping the first row of each: "
+                           f"{duplicates[:10]}")
+
+        parsed = {}
+
+        def parse(topics_str):
+            topics = parsed.get(topics_str)
+            if topics is None:
+                try:
+                    topics = tuple(ast.literal_eval(topics_str)) if topics_str else ()
+                except (ValueError, SyntaxError):
+                    logger.warning(f"Unparsable topics: {topics_str}")
+                    topics = ()
+                parsed[topics_str] = topics
+            return topics
+
+        topics = {}
+        for source_id, primary_topics, secondary_topics, duplicate in zip(
+                stored_df['source_id'], stored_df['primary_topics'], stored_df['secondary_topics'], is_duplicate):
+            if source_id and not duplicate:
+                topics[source_id] = (parse(primary_topics), parse(secondary_topics))
+        logger.info(f"Loaded topics of {len(topics)} docs from {csv_path} ({len(parsed)} distinct topic lists)")
+        return cls(topics, duplicates=duplicates)
+
+    @classmethod
+    def from_parquet(cls, dataset_dir, source, months=None):
+        """Topics of `source` stored in the parquet dataset, they are native lists so nothing is parsed."""
+        table = read_topic_table(dataset_dir, sources=[source], months=months, columns=TOPIC_COLUMNS)
+        topics, duplicates = {}, set()
+        if table is not None:
+            for primary_topics, secondary_topics, source_id in zip(*(column_to_pylist(table, name)
+                                                                    for name in TOPIC_COLUMNS)):
+                if not source_id:
+                    continue
+                if source_id in topics:
+                    duplicates.add(source_id)
+                    continue
+                topics[source_id] = (tuple(primary_topics or ()), tuple(secondary_topics or ()))
+        if duplicates:
+            logger.warning(f"{len(duplicates)} duplicated source_ids in {dataset_dir}/source={source}, "
+                           f"keeping the first row of each: {list(duplicates)[:10]}")
+        logger.info(f"Loaded topics of {len(topics)} docs from {dataset_dir}/source={source}")
+        return cls(topics, duplicates=list(duplicates))
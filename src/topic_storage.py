@@ -0,0 +1,169 @@
+import calendar
+import glob
+import os
+import re
+import uuid
+from datetime import datetime, timezone
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from loguru import logger
+
+TOPIC_DATASET_NAME = "topic_modeling"
+TOPIC_COLUMNS = ['primary_topics', 'secondary_topics', 'source_id']
+TOPIC_SCHEMA = pa.schema([
+    ('primary_topics', pa.list_(pa.string())),
+    ('secondary_topics', pa.list_(pa.string())),
+    ('source_id', pa.string()),
+    ('month', pa.string()),
+])
+TOPIC_PARTITIONING = ds.partitioning(pa.schema([('source', pa.string())]), flavor="hive")
+# rows are sorted by month inside a file, a month filter only reads the row groups whose statistics cover it
+ROW_GROUP_SIZE = 1000
+# docs whose month isn't known, e.g. rows converted from a csv whose source_id doesn't contain a date
+UNKNOWN_MONTH = "unknown"
+
+regex_month = re.compile(r"^(\d{4})-(\d{2})")
+regex_source_id_month = re.compile(r"-(\d{4})-(\d{2}|" + "|".join(calendar.month_name[1:]) + r")-")
+month_numbers = {name: f"{number:02d}" for number, name in enumerate(calendar.month_name) if name}
+
+
+def topic_dataset_dir(output_dir="gpt_output"):
+    """
+    Parquet dataset of generated topics, hive partitioned by source and sorted by month of the doc inside
+    every file: `<output_dir>/topic_modeling/source=<dev_name>/part-<timestamp>-<id>.parquet`
+    Every write adds a new file, so stored topics are only rewritten when `compact_topic_files` merges the files
+    of a source. Topics are native list<string> columns.
+    Most months only have a few dozen docs, a directory per month would mostly hold tiny files that are slower
+    to open than to read.
+    """
+    return os.path.join(output_dir, TOPIC_DATASET_NAME)
+
+
+def month_of(created_at):
+    """'YYYY-MM' of an elasticsearch date string, UNKNOWN_MONTH if it can't be read."""
+    match = regex_month.match(created_at or "")
+    return f"{match.group(1)}-{match.group(2)}" if match else UNKNOWN_MONTH
+
+
+def month_from_source_id(source_id):
+    """
+    'YYYY-MM' of the mailing list source_ids that contain it, e.g. mailing-list-bitcoin-2023-January-021368
+    or mailing-list-2024-02-m90a75..., UNKNOWN_MONTH otherwise.
+    """
+    match = regex_source_id_month.search(source_id or "")
+    if not match:
+        return UNKNOWN_MONTH
+    return f"{match.group(1)}-{month_numbers.get(match.group(2), match.group(2))}"
+
+
+def list_topic_files(dataset_dir, sources=None):
+    """Parquet files of the given sources (all if None), oldest first. Other sources' files aren't opened."""
+    files = []
+    for source in sources or ["*"]:
+        files.extend(glob.glob(os.path.join(dataset_dir, f"source={source}", "*.parquet")))
+    # file names start with the time they were written at
+    return sorted(set(files), key=os.path.basename)
+
+
+def has_topics(dataset_dir, source):
+    return os.path.isdir(os.path.join(dataset_dir, f"source={source}"))
+
+
+def read_topic_table(dataset_dir, sources=None, months=None, columns=None):
+    """
+    pyarrow Table of the stored topics of the given sources and months, with the `source` partition column.
+    Files are read in the order they were written in.
+    """
+    files = list_topic_files(dataset_dir, sources=sources)
+    if not files:
+        return None
+    dataset = ds.dataset(files, schema=TOPIC_SCHEMA.append(pa.field('source', pa.string())), format="parquet",
+                         partitioning=TOPIC_PARTITIONING, partition_base_dir=dataset_dir)
+    return dataset.to_table(columns=columns, filter=ds.field('month').isin(months) if months else None)
+
+
+def column_to_pylist(table, name):
+    """Python list of a table column, list columns go through numpy as `to_pylist` converts them item by item."""
+    column = table.column(name)
+    if not pa.types.is_list(column.type):
+        return column.to_pylist()
+    return [[] if values is None else values.tolist() for values in column.to_pandas()]
+
+
+def read_topics_df(dataset_dir, sources=None, months=None, columns=None, drop_duplicates=True):
+    """
+    DataFrame of the stored topics, topic columns hold python lists. Only the first row of a source_id
+    is kept, the same as compacting a csv does.
+    """
+    table = read_topic_table(dataset_dir, sources=sources, months=months, columns=columns)
+    if table is None:
+        return pd.DataFrame(columns=columns or TOPIC_COLUMNS + ['month', 'source'])
+    df = pd.DataFrame({name: column_to_pylist(table, name) for name in table.column_names})
+    if drop_duplicates and 'source_id' in df.columns:
+        df.drop_duplicates(subset='source_id', keep='first', inplace=True)
+    return df
+
+
+def write_topic_rows(dataset_dir, source, rows):
+    """
+    Write rows of a source as a new parquet file.
+    :param rows: dicts with TOPIC_COLUMNS and an optional 'month', rows without one get UNKNOWN_MONTH
+    :return: path of the written file
+    """
+    rows = sorted(({
+        'primary_topics': list(row.get('primary_topics') or []),
+        'secondary_topics': list(row.get('secondary_topics') or []),
+        'source_id': row.get('source_id'),
+        'month': row.get('month') or UNKNOWN_MONTH,
+    } for row in rows), key=lambda row: row['month'])
+
+    partition_dir = os.path.join(dataset_dir, f"source={source}")
+    os.makedirs(partition_dir, exist_ok=True)
+    written_at = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+    path = os.path.join(partition_dir, f"part-{written_at}-{uuid.uuid4().hex[:8]}.parquet")
+    # the file only appears under its final name once it is complete
+    pq.write_table(pa.Table.from_pylist(rows, schema=TOPIC_SCHEMA), f"{path}.tmp", compression="zstd",
+                   row_group_size=ROW_GROUP_SIZE)
+    os.replace(f"{path}.tmp", path)
+    return path
+
+
+def compact_topic_files(dataset_dir, source, max_files):
+    """
+    Rewrite the files of a source as a single file once it has more than `max_files`, only the first row of
+    a source_id is kept. The old files are removed once the new one is complete, if that is interrupted the
+    rows left in them are duplicates that readers drop.
+    :return: no. of files removed
+    """
+    files = list_topic_files(dataset_dir, sources=[source])
+    if len(files) <= max_files:
+        return 0
+    df = read_topics_df(dataset_dir, sources=[source], columns=TOPIC_COLUMNS + ['month'])
+    path = write_topic_rows(dataset_dir, source, df.to_dict("records"))
+    for file in files:
+        os.remove(file)
+    logger.success(f"{len(files)} parquet files of source={source} compacted into: {path}")
+    return len(files)
+
+
+def convert_csv_to_parquet(csv_path, dataset_dir, source):
+    """
+    Write the rows of a topic modeling csv to the parquet dataset of `source`, the month of a row is taken
+    from its source_id when it contains one. List columns stored as python repr strings are parsed once here.
+    :return: no. of rows written
+    """
+    # imported here as topic_lookup reads the dataset with this module
+    from src.topic_lookup import TopicLookup
+
+    topic_lookup = TopicLookup.from_csv(csv_path)
+    rows = []
+    for source_id in topic_lookup:
+        primary_topics, secondary_topics = topic_lookup.get(source_id)
+        rows.append({'primary_topics': primary_topics, 'secondary_topics': secondary_topics,
+                     'source_id': source_id, 'month': month_from_source_id(source_id)})
+    if rows:
+        write_topic_rows(dataset_dir, source, rows)
+    logger.success(f"{len(rows)} rows of {csv_path} converted to parquet: {dataset_dir}/source={source}")
+    return len(rows)
@@ -2,6 +2,10 @@ import os
 import re
 import shutil
 import traceback
+from ast import literal_eval
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import numpy as np
 import pandas as pd
 from dotenv import load_dotenv
 from dateutil.parser import parse
@@ -21,6 +25,8 @@ month_dict = {
 regex_url = re.compile(r'http\S+|www\S+|https\S+')
 regex_non_alpha = re.compile(r'[^A-Za-z0-9 ]+')
 regex_spaces = re.compile(r'\s+')
+dev_tech_base_url = "https://btctranscripts.com/bitcoin-core-dev-tech/"
+regex_dev_tech_dated_url = re.compile("^https://btctranscripts.com/bitcoin-core-dev-tech/[0-9]{4}-[0-9]{2}/.*")
 
 
 def clean_text(text):
@@ -67,9 +73,12 @@ def is_date(string, fuzzy=False):
         return False
 
 
+regex_dot_comma = re.compile(r". ,")
+
+
 def normalize_text(s, sep_token=" \n "):
-    s = re.sub(r'\s+', ' ', s).strip()
-    s = re.sub(r". ,", "", s)
+    s = regex_spaces.sub(' ', s).strip()
+    s = regex_dot_comma.sub("", s)
     s = s.replace("..", ".")
     s = s.replace(". .", ".")
     s = s.replace("\n", "")
@@ -78,34 +87,57 @@ def normalize_text(s, sep_token=" \n "):
     return s
 
 
+# lines dropped from email bodies: quoted replies, reply headers, signatures, footers and link references
+regex_skip_line = re.compile(
+    r'^(?:>|Le |From:|Sent with Proton Mail|-- |\[|_____|\d{4}-\d{2}-\d{2})'
+    r'|^\s*(?:To|permalink)'
+    r'|(?:> wrote:|\?crit :)\Z'
+)
+regex_digit = re.compile(r'\d')
+regex_alpha_token = re.compile(r'[^\W\d_]+')
+
+# the only tokens dateutil can turn into a date once digits are removed: month and weekday names,
+# plus the words float() accepts as numbers
+DATE_TOKENS = {
+    'jan', 'january', 'feb', 'february', 'mar', 'march', 'apr', 'april', 'may', 'jun', 'june', 'jul', 'july',
+    'aug', 'august', 'sep', 'sept', 'september', 'oct', 'october', 'nov', 'november', 'dec', 'december',
+    'mon', 'monday', 'tue', 'tuesday', 'wed', 'wednesday', 'thu', 'thursday', 'fri', 'friday', 'sat', 'saturday',
+    'sun', 'sunday', 'nan', 'inf', 'infinity'
+}
+
+
+def is_date_attribution(line):
+    """
+    Return whether an "On ..." line is a reply attribution like "On Mon, Jan 1, 2024 at 10:00 AM X wrote:".
+    Same result as `is_date` on the line with its digits removed, but dateutil is only called when the
+    line contains a token it could parse, and only once per distinct line.
+    """
+    line = regex_digit.sub(' ', line)
+    if not any(token.lower() in DATE_TOKENS for token in regex_alpha_token.findall(line)):
+        return False
+    return _is_fuzzy_date(line)
+
+
+@lru_cache(maxsize=65536)
+def _is_fuzzy_date(string):
+    # attributions repeat a lot once digits are removed (same sender, same mail client format)
+    return is_date(string, fuzzy=True)
+
+
 def preprocess_email(email_body):
     email_body = email_body.split("-------------- next part --------------")[0]
     email_lines = email_body.split('\n')
     temp_ = []
     for line in email_lines:
+        if not line:
+            continue
         if line.startswith("On"):
             line = line.replace("-", " ")
-            x = re.sub('\d', ' ', line)
-            if is_date(x, fuzzy=True):
+            if is_date_attribution(line):
                 continue
-            if line.endswith("> wrote:"):
-                continue
-        if line.endswith("> wrote:"):
-            continue
-        if line.startswith("Le "):
-            continue
-        if line.endswith("?crit :"):
-            continue
-        if re.match(r'\d{4}-\d{2}-\d{2}', line):
+        if regex_skip_line.search(line):
             continue
-        if line.startswith("From:") or line.strip().startswith("To") or line.strip().startswith("permalink"):
-            continue
-        if line.startswith("Sent with Proton Mail"):
-            continue
-        if line and not line.startswith('>'):
-            if line.startswith('-- ') or line.startswith('[') or line.startswith('_____'):
-                continue
-            temp_.append(line)
+        temp_.append(line)
     email_string = "\n".join(temp_)
     normalized_email_string = normalize_text(email_string)
     if len(normalized_email_string) == 0:
@@ -114,25 +146,62 @@ def preprocess_email(email_body):
         return normalized_email_string
 
 
+def preprocess_emails(email_bodies, max_workers=None, min_bodies_per_worker=2000):
+    """
+    Preprocess a list of email bodies, results are in the same order as `email_bodies`.
+    Starting a process pool costs more than it saves on small batches and on runners with few CPUs, so one is
+    only used if every worker gets at least `min_bodies_per_worker` bodies and there are 2 or more workers.
+    :param max_workers: int, max. no. of processes, defaults to the no. of CPUs
+    """
+    email_bodies = list(email_bodies)
+    workers = min(max_workers or os.cpu_count() or 1, len(email_bodies) // min_bodies_per_worker)
+    if workers < 2:
+        return [preprocess_email(email_body) for email_body in email_bodies]
+    # a few chunks per worker balance the load without paying for a round trip per body
+    chunksize = -(-len(email_bodies) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(preprocess_email, email_bodies, chunksize=chunksize))
+
+
 def merge_multiple_csv_from_dir(dir_path, csv_save_path):
+    """
+    Merge the topic modeling csv files of `dir_path` and the parquet topic dataset in it, if there is one,
+    into a single file. Sources stored in parquet are read from there and their csv files are skipped.
+    The merged file is written as parquet if `csv_save_path` ends with '.parquet', with list columns stored
+    as python repr strings otherwise, the same as the csv files.
+    """
+    # imported here so the other helpers don't need pyarrow
+    from src.topic_storage import TOPIC_DATASET_NAME, read_topics_df
+
+    dataset_dir = os.path.join(dir_path, TOPIC_DATASET_NAME)
+    parquet_df = read_topics_df(dataset_dir)
+    parquet_sources = set(parquet_df['source'])
+    logger.info(f"Sources found in parquet: {len(parquet_sources)}, shape: {parquet_df.shape}")
+
     # get a list of all the csv files
-    csv_files = [f for f in os.listdir(dir_path) if f.endswith('.csv')]
+    csv_files = [f for f in os.listdir(dir_path) if f.endswith('.csv')
+                 and f[:-len('.csv')].replace('topic_modeling_', '', 1) not in parquet_sources]
     logger.info(f"Total csv files found: {len(csv_files)}")
 
     # initialize a list to store dataframes
-    dfs = []
+    dfs = [parquet_df.drop(columns=['source', 'month'])] if len(parquet_df) else []
 
     # loop through the list of csv files
     for file in csv_files:
         try:
             # read the csv file
-            curr_df = pd.read_csv(dir_path + file)
+            curr_df = pd.read_csv(os.path.join(dir_path, file))
             logger.info(f"individual file shape bfr:{curr_df.shape}")
 
             # drop duplicate rows based on the 'source_id' column
             curr_df.drop_duplicates(subset='source_id', keep='first', inplace=True)
             logger.info(f"individual file shape aft:{curr_df.shape}")
 
+            # topics are parsed into lists, the same as the parquet rows
+            for col in ['primary_topics', 'secondary_topics']:
+                if col in curr_df.columns:
+                    curr_df[col] = curr_df[col].map(lambda kw: literal_eval(kw) if isinstance(kw, str) else [])
+
             # append the current df to the list
             dfs.append(curr_df)
         except Exception as ex:
@@ -147,8 +216,11 @@ def merge_multiple_csv_from_dir(dir_path, csv_save_path):
     df.drop_duplicates(subset='source_id', keep='first', inplace=True)
     logger.info(f"main file shape aft:{df.shape}")
 
-    # write the final dataframe to a csv file
-    df.to_csv(f"{csv_save_path}", index=False)
+    if csv_save_path.endswith('.parquet'):
+        df.to_parquet(csv_save_path, index=False)
+    else:
+        # write the final dataframe to a csv file
+        df.to_csv(f"{csv_save_path}", index=False)
     logger.success(f"file saved at path: {csv_save_path}")
 
 
@@ -175,61 +247,40 @@ def convert_to_dataframe(docs_list, save_csv=False):
 
 
 def get_duplicated_docs_ids(df):
+    """
+    Ids of the docs to drop from a dataframe built with `convert_to_dataframe`.
+    Docs that share index, title, transcript_by, created_at, domain and body_type are duplicates:
+    - if they all have the same url, the last one is kept
+    - if their urls differ only before the last route, the first doc of each url is kept, except for
+      bitcoin-core-dev-tech urls without a 'YYYY-MM' route
+    - otherwise, the first doc of each url is kept
+    Docs that are kept but share their url with another kept doc are dropped as well.
+    Every rule is evaluated on whole columns at once, the groups are never iterated in Python.
+    """
     logger.info(f"Shape: {df.shape}")
     cols = ['index', 'title', 'transcript_by', 'created_at', 'domain', 'body_type']
-    df_grouped = df.groupby(cols)
-
-    ids_to_keep = []
-    for _, dfx in df_grouped:
-
-        # if only one instance keep it
-        if dfx.shape[0] == 1:
-            this_id = dfx['_id'].values[0]
-            ids_to_keep.append(this_id)
-
-        else:
-            urls_ = list(set(dfx['url'].to_list()))
-
-            # check if all urls are same, if yes then keep the last one
-            if len(urls_) == 1:
-                this_id = dfx['_id'].values[-1]
-                ids_to_keep.append(this_id)
-
-            # if all urls are different
-            else:
-                # check if last route of each urls are same, if yes move forward with this operation
-                last_route_urls = list(set([i.split("/")[-1] for i in urls_]))
-
-                if len(last_route_urls) == 1:
-                    base_url = "https://btctranscripts.com/bitcoin-core-dev-tech/"
-                    pattern = re.compile("^https://btctranscripts.com/bitcoin-core-dev-tech/[0-9]{4}-[0-9]{2}/.*")
-
-                    temp_urls = []
-                    for _, r in dfx.iterrows():
-                        this_id = r['_id']
-                        this_url = r['url']
-
-                        if this_url not in temp_urls:
-                            if base_url in this_url:
-                                if pattern.match(this_url):
-                                    ids_to_keep.append(this_id)
-                            else:
-                                ids_to_keep.append(this_id)
-
-                            temp_urls.append(this_url)
-
-                # if last route of each urls are different, take all of them
-                else:
-                    temp_urls = []
-                    for _, r in dfx.iterrows():
-                        this_id = r['_id']
-                        this_url = r['url']
-                        if this_url not in temp_urls:
-                            ids_to_keep.append(this_id)
-                            temp_urls.append(this_url)
+
+    # rows with a missing key don't belong to any group and are never kept, the same as in `df.groupby`
+    grouped_df = df.loc[df[cols].notna().all(axis=1), ['_id', 'url']]
+    group = df.loc[grouped_df.index].groupby(cols, sort=False).ngroup().to_numpy()
+    urls = grouped_df['url']
+    last_routes = urls.str.rsplit("/", n=1).str[-1]
+
+    urls_per_group = urls.groupby(group).transform('nunique').to_numpy()
+    last_routes_per_group = last_routes.groupby(group).transform('nunique').to_numpy()
+    is_last_of_group = ~pd.Series(group).duplicated(keep='last').to_numpy()
+    is_first_of_url = ~pd.DataFrame({'group': group, 'url': urls.to_numpy()}).duplicated().to_numpy()
+    is_dev_tech_url = urls.str.contains(dev_tech_base_url, regex=False).to_numpy()
+    is_dev_tech_dated_url = urls.str.match(regex_dev_tech_dated_url).to_numpy()
+
+    keep = np.where(
+        urls_per_group == 1,
+        is_last_of_group,
+        is_first_of_url & ((last_routes_per_group > 1) | ~is_dev_tech_url | is_dev_tech_dated_url)
+    )
 
     total_ids = set(df['_id'])
-    ids_to_keep_set = set(ids_to_keep)
+    ids_to_keep_set = set(grouped_df['_id'].to_numpy()[keep])
     ids_to_drop = list(total_ids - ids_to_keep_set)
 
     df_to_keep = df[df['_id'].isin(ids_to_keep_set)]
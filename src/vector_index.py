@@ -0,0 +1,95 @@
+import json
+import os
+import time
+import numpy as np
+from loguru import logger
+
+
+class LocalVectorIndex:
+    """
+    HNSW index over vectors exported from elasticsearch, persisted to disk so queries don't scan the cluster.
+    Distances are cosine, the returned scores are `cosine + 1.0` to match `compute_similar_docs_with_cosine_similarity`.
+    Only the `_id` and title of each doc are kept, the text of the top-k hits is fetched from elasticsearch.
+    """
+    INDEX_FILE = "index.bin"
+    METADATA_FILE = "metadata.json"
+
+    def __init__(self, es_index, dim=1024, ef_search=100):
+        import hnswlib
+        self._es_index = es_index
+        self._dim = dim
+        self._ef_search = ef_search
+        self._index = hnswlib.Index(space="cosine", dim=dim)
+        self._docs = []
+
+    def __len__(self):
+        return len(self._docs)
+
+    @classmethod
+    def build_from_es(cls, elastic_search, es_index, field_name, url=None, dim=1024, ef_construction=200, m=16,
+                      batch_size=10000):
+        """Export `field_name` vectors of all docs that have one and build an index over them."""
+        start_time = time.time()
+        vector_index = cls(es_index, dim=dim)
+        vector_index._index.init_index(max_elements=batch_size, ef_construction=ef_construction, M=m)
+
+        query = elastic_search.build_query(url=url, must=[{"exists": {"field": field_name}}])
+        docs = elastic_search.iter_hits(es_index=es_index, query=query,
+                                        source_includes=[field_name, "title"])
+
+        vectors, labels = [], []
+        for doc in docs:
+            labels.append(len(vector_index._docs))
+            vectors.append(doc['_source'][field_name])
+            vector_index._docs.append({"_id": doc['_id'], "title": doc['_source'].get('title')})
+            if len(vectors) >= batch_size:
+                vector_index._add_items(vectors, labels)
+                vectors, labels = [], []
+        if vectors:
+            vector_index._add_items(vectors, labels)
+
+        vector_index._index.set_ef(vector_index._ef_search)
+        logger.info(f"Built local vector index of {len(vector_index)} docs in {time.time() - start_time:.2f} seconds.")
+        return vector_index
+
+    def _add_items(self, vectors, labels):
+        required = labels[-1] + 1
+        if required > self._index.get_max_elements():
+            self._index.resize_index(max(required, 2 * self._index.get_max_elements()))
+        self._index.add_items(np.asarray(vectors, dtype=np.float32), np.asarray(labels))
+
+    def save(self, dir_path):
+        os.makedirs(dir_path, exist_ok=True)
+        self._index.save_index(os.path.join(dir_path, self.INDEX_FILE))
+        with open(os.path.join(dir_path, self.METADATA_FILE), "w", encoding="utf-8") as f:
+            json.dump({"es_index": self._es_index, "dim": self._dim, "docs": self._docs}, f)
+        logger.success(f"Local vector index saved at path: {dir_path}")
+
+    @classmethod
+    def load(cls, dir_path, ef_search=100):
+        with open(os.path.join(dir_path, cls.METADATA_FILE), encoding="utf-8") as f:
+            metadata = json.load(f)
+        vector_index = cls(metadata["es_index"], dim=metadata["dim"], ef_search=ef_search)
+        vector_index._docs = metadata["docs"]
+        vector_index._index.load_index(os.path.join(dir_path, cls.INDEX_FILE), max_elements=len(vector_index._docs))
+        vector_index._index.set_ef(ef_search)
+        return vector_index
+
+    def compute_similar_docs(self, elastic_search, model, question: str, top_k: int = 3):
+        """Same contract as `ElasticSearchClient.compute_similar_docs_with_cosine_similarity`."""
+        question_embedding = model.encode(question, normalize_embeddings=True)
+        labels, distances = self._index.knn_query(np.asarray([question_embedding], dtype=np.float32),
+                                                  k=min(top_k, len(self)))
+        hits = [self._docs[label] for label in labels[0]]
+        sources = elastic_search.fetch_docs_by_ids(self._es_index, [hit['_id'] for hit in hits],
+                                                   source_includes=["summary", "body"])
+        return {
+            "question": question,
+            "matches": [
+                {
+                    **hit,
+                    "summary": sources.get(hit['_id'], {}).get('summary') or sources.get(hit['_id'], {}).get('body'),
+                    "score": float(2.0 - distance)
+                } for hit, distance in zip(hits, distances[0])
+            ]
+        }
@@ -0,0 +1,124 @@
+import json
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+from dateutil.parser import isoparse
+from loguru import logger
+
+from src.config import WATERMARK_PATH, WATERMARK_FIELD, WATERMARK_LOOKBACK_HOURS, FULL_SWEEP_INTERVAL_DAYS
+
+# sources of a job may run concurrently, they update the same file
+WATERMARK_LOCK = threading.Lock()
+# docs that failed are refetched by id next run, with more than this a full sweep is cheaper than the ids query
+MAX_FAILED_IDS = 1000
+
+
+class WatermarkStore:
+    """
+    Persisted per-source high-water mark of `field` for a cron job, so a run only fetches the docs added since
+    the previous successful one. The watermark is the start time of the last successful run, it is moved back
+    by `lookback_hours` when querying to catch docs that arrive late, and a full sweep is run every
+    `full_sweep_days` to catch any stragglers.
+    The watermark of a source only advances when `commit` is called after the run. Docs the run failed on are
+    reported with `fail`, they are stored with the watermark and fetched by id next run, whatever their `field`.
+    """
+
+    def __init__(self, job, path=WATERMARK_PATH, field=WATERMARK_FIELD, lookback_hours=WATERMARK_LOOKBACK_HOURS,
+                 full_sweep_days=FULL_SWEEP_INTERVAL_DAYS):
+        self.job = job
+        self.field = field
+        self._path = path
+        self._lookback = timedelta(hours=lookback_hours)
+        self._full_sweep_interval = timedelta(days=full_sweep_days) if full_sweep_days else None
+        self._failed = {}
+        self._run_started = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+    def _read(self):
+        if not os.path.exists(self._path):
+            return {}
+        with open(self._path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def _write(self, watermarks):
+        os.makedirs(os.path.dirname(self._path) or ".", exist_ok=True)
+        tmp_path = f"{self._path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(watermarks, f, indent=2)
+        os.replace(tmp_path, self._path)
+
+    def get(self, dev_url):
+        with WATERMARK_LOCK:
+            return self._read().get(self.job, {}).get(dev_url)
+
+    def is_full_sweep(self, dev_url):
+        """A source without a watermark, or whose last full sweep is too old, is fetched in full."""
+        watermark = self.get(dev_url)
+        if not watermark or not watermark.get("value"):
+            return True
+        if self._full_sweep_interval is None:
+            return False
+        last_full_sweep = watermark.get("last_full_sweep")
+        return not last_full_sweep or \
+            isoparse(last_full_sweep) + self._full_sweep_interval <= datetime.now(timezone.utc)
+
+    def failed_ids(self, dev_urls):
+        """`_id`s of the docs of `dev_urls` that the previous run failed on, to be fetched again."""
+        dev_urls = dev_urls if isinstance(dev_urls, list) else [dev_urls]
+        failed_ids = set()
+        for dev_url in dev_urls:
+            failed_ids.update((self.get(dev_url) or {}).get("failed_ids", []))
+        return sorted(failed_ids)
+
+    def since(self, dev_urls):
+        """
+        Lower bound of `field` for the query of `dev_urls`, None if any of them needs a full sweep.
+        Sources fetched with a single query share the oldest watermark among them. Docs that failed in the
+        previous run are older than that, fetch them with `failed_ids` too.
+        """
+        dev_urls = dev_urls if isinstance(dev_urls, list) else [dev_urls]
+        if any(self.is_full_sweep(dev_url) for dev_url in dev_urls):
+            logger.info(f"{self.job}: full sweep for {dev_urls}")
+            return None
+        if len(self.failed_ids(dev_urls)) > MAX_FAILED_IDS:
+            logger.info(f"{self.job}: full sweep for {dev_urls}, more than {MAX_FAILED_IDS} docs failed last run")
+            return None
+        oldest = min(isoparse(self.get(dev_url)["value"]) for dev_url in dev_urls)
+        since = (oldest - self._lookback).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+        logger.info(f"{self.job}: fetching docs with '{self.field}' since {since} for {dev_urls}")
+        return since
+
+    def fail(self, dev_urls, doc_ids):
+        """
+        Record docs this run failed on, `commit` stores them so the next run fetches them again.
+        Failures of a single query over several sources may be recorded for all of them.
+        """
+        dev_urls = dev_urls if isinstance(dev_urls, list) else [dev_urls]
+        with WATERMARK_LOCK:
+            for dev_url in dev_urls:
+                self._failed.setdefault(dev_url, set()).update(doc_id for doc_id in doc_ids if doc_id)
+
+    def commit(self, dev_urls, full_sweep=False):
+        """
+        Persist the watermarks of `dev_urls` once their run is done. Docs that failed in this run replace the
+        stored ones, so docs of the previous run that were fetched again and succeeded are dropped.
+        """
+        dev_urls = dev_urls if isinstance(dev_urls, list) else [dev_urls]
+        now = datetime.now(timezone.utc).isoformat()
+        with WATERMARK_LOCK:
+            watermarks = self._read()
+            job_watermarks = watermarks.setdefault(self.job, {})
+            for dev_url in dev_urls:
+                watermark = job_watermarks.setdefault(dev_url, {})
+                # every doc that existed when the run started has been processed, or is in failed_ids
+                watermark["value"] = self._run_started
+                watermark["failed_ids"] = sorted(self._failed.pop(dev_url, set()))
+                if watermark["failed_ids"]:
+                    logger.warning(f"{self.job}: {len(watermark['failed_ids'])} failed docs of {dev_url} "
+                                   f"are fetched again next run")
+                # the newest doc seen used to be stored as well, nothing reads it
+                watermark.pop("cursor", None)
+                watermark["last_run"] = now
+                if full_sweep:
+                    watermark["last_full_sweep"] = now
+            self._write(watermarks)
+        logger.info(f"{self.job}: watermarks saved for {dev_urls}")
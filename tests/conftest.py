@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the tests compare the code in src/ with the previous implementations kept in the benchmark scripts
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(REPO_ROOT)
+sys.path.append(os.path.join(REPO_ROOT, "benchmarks"))
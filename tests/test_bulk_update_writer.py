@@ -0,0 +1,70 @@
+import pytest
+from elastic_transport import ApiResponseMeta, ConnectionError, HttpHeaders, NodeConfig
+from elasticsearch import ApiError, Elasticsearch
+
+from src.elasticsearch_utils import BulkUpdateWriter
+
+
+class FakeClient:
+    """Answers `_bulk` requests with `respond(no. of actions)`, items name the concrete index like a real cluster."""
+
+    def __init__(self, respond):
+        self._respond = respond
+        self.requests = []
+        # streaming_bulk serializes the actions with the transport of the client
+        self.transport = Elasticsearch("http://localhost:9200").transport
+
+    def options(self, **kwargs):
+        return self
+
+    def bulk(self, operations, **kwargs):
+        actions = [operation for operation in operations[::2]]
+        self.requests.append(len(actions))
+        return self._respond(actions)
+
+
+def ok(actions):
+    class Response:
+        body = {"errors": False, "items": [
+            {"update": {"_index": "index-000001", "_id": "x", "status": 200}} for _ in actions
+        ]}
+    return Response()
+
+
+def raise_connection_error(actions):
+    raise ConnectionError("connection refused")
+
+
+def raise_unavailable(actions):
+    meta = ApiResponseMeta(status=503, http_version="1.1", headers=HttpHeaders(), duration=0.0,
+                           node=NodeConfig("http", "localhost", 9200))
+    raise ApiError("unavailable", meta=meta, body={})
+
+
+def write(client, docs=5, **kwargs):
+    writer = BulkUpdateWriter(client, retry_delay=0, **kwargs)
+    with writer:
+        for i in range(docs):
+            writer.update("index-alias", f"doc-{i}", {"text": "x" * 50})
+    return writer
+
+
+def test_matches_results_by_position():
+    client = FakeClient(ok)
+    writer = write(client)
+    assert writer.success_count == 5 and writer.failed == [] and client.requests == [5]
+
+
+@pytest.mark.parametrize("respond", [raise_connection_error, raise_unavailable])
+def test_failed_request_keeps_every_action(respond):
+    client = FakeClient(respond)
+    writer = write(client, max_retries=1)
+    assert sorted(writer.failed_ids) == [f"doc-{i}" for i in range(5)]
+    assert client.requests == [5, 5]
+
+
+def test_counts_every_request_sent():
+    client = FakeClient(ok)
+    writer = write(client, max_bytes=400)
+    assert client.requests == [2, 2, 1]
+    assert writer.request_count == 3 and writer.success_count == 5
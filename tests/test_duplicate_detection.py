@@ -0,0 +1,10 @@
+import pytest
+
+from benchmark_duplicate_detection import legacy_get_duplicated_docs_ids, synthetic_corpus
+from src.utils import get_duplicated_docs_ids
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_same_ids_as_legacy(seed):
+    df = synthetic_corpus(2000, seed)
+    assert get_duplicated_docs_ids(df.copy()) == legacy_get_duplicated_docs_ids(df.copy())
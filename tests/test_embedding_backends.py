@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("optimum.onnxruntime")
+
+from benchmark_embedding_backends import MIN_COSINE_SIMILARITY  # noqa: E402
+from src.config import EMBEDDING_BATCH_SIZE, get_embedding_model  # noqa: E402
+from src.embedding_utils import encode_texts  # noqa: E402
+
+TEXTS = [
+    "Package relay and fee bumping \n A proposal to relay packages of transactions together.",
+    "Taproot activation \n Discussion of speedy trial and the activation parameters.",
+    "Lightning channel jamming \n Upfront fees and reputation as mitigations.",
+    "Thanks!",
+]
+
+
+@pytest.mark.parametrize("backend", ["onnx", "onnx-int8"])
+def test_vectors_close_to_torch(backend):
+    reference = np.asarray(encode_texts(get_embedding_model("torch"), TEXTS, batch_size=EMBEDDING_BATCH_SIZE))
+    vectors = np.asarray(encode_texts(get_embedding_model(backend), TEXTS, batch_size=EMBEDDING_BATCH_SIZE))
+    # all vectors are normalized, so the dot product is the cosine similarity
+    assert np.sum(vectors * reference, axis=1).min() > MIN_COSINE_SIMILARITY
@@ -0,0 +1,15 @@
+from benchmark_preprocess_email import legacy_preprocess_email, synthetic_corpus
+from src.utils import preprocess_email, preprocess_emails
+
+
+def test_same_output_as_legacy():
+    corpus = synthetic_corpus(1000)
+    assert [preprocess_email(body) for body in corpus] == [legacy_preprocess_email(body) for body in corpus]
+
+
+def test_batch_keeps_order():
+    corpus = synthetic_corpus(300, seed=1)
+    expected = [preprocess_email(body) for body in corpus]
+    assert preprocess_emails(corpus) == expected
+    # the process pool, whatever the no. of CPUs
+    assert preprocess_emails(corpus, max_workers=2, min_bodies_per_worker=1) == expected
@@ -0,0 +1,22 @@
+import pandas as pd
+
+from benchmark_topic_lookup import legacy_lookup, indexed_lookup
+
+
+def test_same_topics_as_legacy(tmp_path):
+    csv_path = tmp_path / "topic_modeling_test.csv"
+    pd.DataFrame({
+        'primary_topics': ["['Taproot', 'Fees']", "[]", "['Mempool']", "['Lightning']", "['Mempool']"],
+        'secondary_topics': ["['Schnorr']", "['Soft fork']", "[]", "[]", "['Relay']"],
+        'source_id': ["a", "b", "c", "dup", "dup"],
+    }).to_csv(csv_path, index=False)
+    source_ids = ["a", "b", "c", "dup", "missing"]
+
+    legacy_results = legacy_lookup(csv_path, source_ids)
+    results = indexed_lookup(csv_path, source_ids)
+    for source_id in ["a", "b", "c"]:
+        assert results[source_id] == legacy_results[source_id]
+    # the old path failed on duplicated source_ids, the first row is kept now
+    assert legacy_results["dup"] is None
+    assert results["dup"] == (['Lightning'], [])
+    assert results["missing"] is None
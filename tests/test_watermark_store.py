@@ -0,0 +1,25 @@
+from test_bulk_update_writer import FakeClient, ok, raise_connection_error, write
+
+from src.watermark_store import WatermarkStore
+
+DEV_URLS = ["https://delvingbitcoin.org/", "https://gnusha.org/pi/bitcoindev/"]
+
+
+def run(path, respond):
+    """A run of a cron job that writes 5 docs of both sources with one bulk writer and commits the watermark."""
+    watermark = WatermarkStore("test", path=str(path), full_sweep_days=0)
+    writer = write(FakeClient(respond), max_retries=0)
+    watermark.fail(DEV_URLS, writer.failed_ids)
+    watermark.commit(DEV_URLS, full_sweep=True)
+    return WatermarkStore("test", path=str(path), full_sweep_days=0)
+
+
+def test_failed_flush_is_fetched_again(tmp_path):
+    path = tmp_path / "watermarks.json"
+    watermark = run(path, raise_connection_error)
+    assert watermark.since(DEV_URLS) is not None
+    assert watermark.failed_ids(DEV_URLS) == [f"doc-{i}" for i in range(5)]
+
+    # once they are written, they are dropped
+    watermark = run(path, ok)
+    assert watermark.failed_ids(DEV_URLS) == []
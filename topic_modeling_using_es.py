@@ -14,6 +14,9 @@ from src.utils import clean_title
 warnings.filterwarnings("ignore")
 load_dotenv()
 
+# only these fields are fetched from elasticsearch
+SOURCE_FIELDS = ["id", "url", "primary_topics"]
+
 
 if __name__ == "__main__":
 
@@ -38,6 +41,8 @@ if __name__ == "__main__":
         logger.info(f"dev_url: {dev_url}")
         logger.info(f"dev_name: {dev_name}")
 
+        bulk_writer = elastic_search.bulk_writer()
+        doc_topics = {}
         for topic in btc_topics_list:
 
             SAVE_CSV = True
@@ -48,7 +53,7 @@ if __name__ == "__main__":
             # fetch all docs that matches the provided topic
             logger.info(f"Fetching docs for topic: {topic}")
             docs_list = elastic_search.fetch_docs_with_keywords(
-                es_index=ES_INDEX, url=dev_url, keyword=topic
+                es_index=ES_INDEX, url=dev_url, keyword=topic, source_includes=SOURCE_FIELDS
             )
             logger.success(f"TOTAL THREADS RECEIVED WITH A TOPIC: {str(topic)} = {len(docs_list)}")
 
@@ -73,21 +78,16 @@ if __name__ == "__main__":
                         doc_index = doc['_index']
                         logger.info(f"Doc Id: {doc_id}, Source Id: {doc_source_id}")
 
-                        # update primary keyword
-                        primary_kw = doc['_source'].get('primary_topics', [])
-                        primary_kw.append(topic)
-                        primary_kw = list(set(primary_kw))
-
-                        # update topics to elasticsearch
-                        elastic_search.es_client.update(
-                            index=doc_index,
-                            id=doc_id,
-                            body={
-                                'doc': {
-                                    "primary_topics": primary_kw if primary_kw else []
-                                }
-                            }
-                        )
+                        # update primary keyword, starting from the topics already buffered for this doc since
+                        # the fetched doc does not reflect updates that have not been flushed yet
+                        primary_kw = doc_topics.get(doc_id) or doc['_source'].get('primary_topics', [])
+                        primary_kw = list(set(primary_kw + [topic]))
+                        doc_topics[doc_id] = primary_kw
+
+                        # buffer topics for elasticsearch, updates of the same doc across topics are merged
+                        bulk_writer.update(doc_index, doc_id, {
+                            "primary_topics": primary_kw if primary_kw else []
+                        })
 
                         # save csv for each topic with top 5 docs and their topics
                         if idx <= 5 and SAVE_CSV:
@@ -109,3 +109,5 @@ if __name__ == "__main__":
                 logger.info(f"NO THREADS FOUND FOR A TOPIC: {str(topic).upper()}")
 
             logger.info(f"Process completed for dev_url: {dev_url}")
+
+        bulk_writer.close()
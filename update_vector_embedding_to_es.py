@@ -6,24 +6,159 @@ import traceback
 from loguru import logger
 from datetime import datetime, timedelta
 
-from src.config import ES_INDEX, EMBEDDING_MODEL
-from src.elasticsearch_utils import ElasticSearchClient
+from src.config import ES_INDEX, EMBEDDING_BATCH_SIZE, NEAR_DUPLICATE_INDEX_DIR, VECTOR_MIGRATION_FIELD, \
+    get_embedding_model, get_embedding_cache
+from src.elasticsearch_utils import ElasticSearchClient, DomainRouter
+from src.embedding_utils import get_embedding_text, encode_texts
+from src.near_duplicates import NearDuplicateIndex
+from src.orchestration import run_sources_concurrently, group_sources
+from src.watermark_store import WatermarkStore
 
 warnings.filterwarnings("ignore")
 load_dotenv()
 
+# only these fields are fetched from elasticsearch
+SOURCE_FIELDS = ["id", "title", "summary", "body", "created_at", "domain"]
+
+
+def get_representative_vectors(elastic_search, docs, near_duplicates):
+    """
+    dict of `_id` -> vector of the near-duplicate representative, for the docs whose representative has the
+    same title and a vector.
+    """
+    representatives = {}
+    for doc in docs:
+        representative = near_duplicates.reusable_representative(doc['_source'].get('id'), doc['_source'].get('title'))
+        if representative:
+            representatives[doc['_id']] = near_duplicates.metadata(representative)['_id']
+
+    representative_docs = elastic_search.fetch_docs_by_ids(ES_INDEX, set(representatives.values()),
+                                                           source_includes=["summary_vector_embeddings"])
+    return {
+        doc_id: representative_docs[representative_id]['summary_vector_embeddings']
+        for doc_id, representative_id in representatives.items()
+        if representative_docs.get(representative_id, {}).get('summary_vector_embeddings')
+    }
+
+
+def update_embeddings(elastic_search, docs, near_duplicates=None):
+    """
+    Encode a batch of docs together and write the vectors back with one bulk request.
+    Docs whose near-duplicate representative already has a vector reuse it instead of being encoded.
+    :return: list, `_id`s of the docs whose vector couldn't be written
+    """
+    try:
+        vectors = get_representative_vectors(elastic_search, docs, near_duplicates) if near_duplicates else {}
+        if vectors:
+            logger.info(f"Reusing the vectors of near duplicates for {len(vectors)} docs")
+
+        docs_to_encode = [doc for doc in docs if doc['_id'] not in vectors]
+        if docs_to_encode:
+            doc_texts = [get_embedding_text(doc) for doc in docs_to_encode]
+            # texts encoded before, e.g. of re-indexed or mirrored docs, are read from the embedding cache
+            text_vectors = encode_texts(get_embedding_model(), doc_texts, batch_size=EMBEDDING_BATCH_SIZE,
+                                        cache=get_embedding_cache())
+            vectors.update(zip([doc['_id'] for doc in docs_to_encode], text_vectors))
+
+        updates = []
+        for doc in docs:
+            text_vector = vectors[doc['_id']]
+            if text_vector:
+                update = {"summary_vector_embeddings": text_vector}
+                # written to the indexed field too, so docs added during and after its migration have it
+                if VECTOR_MIGRATION_FIELD:
+                    update[VECTOR_MIGRATION_FIELD] = text_vector
+                updates.append((doc['_index'], doc['_id'], update))
+            else:
+                logger.info(f"Nothing to update! Vector length: {len(text_vector)}, '_id': {doc['_id']}")
+
+        # insert the document if it does not already exist
+        success, errors = elastic_search.bulk_update_docs(updates, doc_as_upsert=True)
+        logger.info(f"Updated embeddings of {success} docs, failed: {len(errors)}")
+        return [error.get("update", {}).get("_id") for error in errors]
+    except Exception as ex:
+        logger.error(f"Error updating ES index: {ex} \n{traceback.format_exc()}")
+        return [doc['_id'] for doc in docs]
+
+
+def update_embeddings_for_source(dev_url, elastic_search, apply_date_range=False, watermark=None,
+                                 near_duplicates=None):
+    """
+    :param dev_url: str, or a list of urls that are fetched with a single query and routed back per domain
+    :param watermark: WatermarkStore, only docs added since the previous successful run are fetched if given
+    :param near_duplicates: NearDuplicateIndex, docs reuse the vector of their near-duplicate representative
+    """
+    logger.info(f"dev_url: {dev_url}")
+    router = DomainRouter(dev_url if isinstance(dev_url, list) else [dev_url])
+
+    # if apply_date_range is set to False, elasticsearch will fetch from all the docs in the index
+    if apply_date_range:
+        current_date_str = None
+        if not current_date_str:
+            current_date_str = datetime.now().strftime("%Y-%m-%d")
+        start_date = datetime.now() - timedelta(days=7)
+        start_date_str = start_date.strftime("%Y-%m-%d")
+        logger.info(f"start_date: {start_date_str}")
+        logger.info(f"current_date_str: {current_date_str}")
+    else:
+        start_date_str = None
+        current_date_str = None
+
+    # with a watermark, only the docs added since the previous run and the docs it failed on are fetched
+    since = watermark.since(dev_url) if watermark and not apply_date_range else None
+    since_ids = watermark.failed_ids(dev_url) if since else None
+
+    # docs are streamed page by page, so processing starts as soon as the first page arrives
+    docs_iter = elastic_search.iter_data_for_empty_field(
+        es_index=ES_INDEX, url=dev_url, field_name="summary_vector_embeddings",
+        start_date_str=start_date_str, current_date_str=current_date_str,
+        source_includes=SOURCE_FIELDS, keep_alive='30m', page_size=1000,
+        since=since, since_field=watermark.field if watermark else "created_at", since_ids=since_ids
+    )
+
+    docs_count = 0
+    pending_docs = []
+    failed_ids = []
+    for domain, doc in tqdm.tqdm(router.route(docs_iter), desc=str(dev_url)):
+        docs_count += 1
+        doc_summary = doc['_source'].get('summary')
+
+        if not doc['_source'].get('summary_vector_embeddings') and doc_summary:
+            pending_docs.append(doc)
+        else:
+            if not doc_summary:
+                logger.info(f"'summary' doesn't exist for '_id': {doc['_id']} | {doc['_source']['created_at']}")
+
+        if len(pending_docs) >= EMBEDDING_BATCH_SIZE:
+            failed_ids.extend(update_embeddings(elastic_search, pending_docs, near_duplicates=near_duplicates))
+            pending_docs = []
+
+    if pending_docs:
+        failed_ids.extend(update_embeddings(elastic_search, pending_docs, near_duplicates=near_duplicates))
+
+    router.log_counts("Threads received with an empty 'summary_vector_embeddings'")
+    if watermark:
+        # a batch holds docs of all the sources of the query, its failures are fetched again with all of them
+        watermark.fail(dev_url, failed_ids)
+        watermark.commit(dev_url, full_sweep=since is None)
+    logger.success(f"TOTAL THREADS RECEIVED WITH AN EMPTY 'summary_vector_embeddings': {docs_count} | {dev_url}")
+    logger.success(f"Process complete for dev_url: {dev_url}")
+    return docs_count
+
+
 if __name__ == "__main__":
 
     # logs automatically rotate log file
     os.makedirs("logs", exist_ok=True)
     logger.add(f"logs/update_vector_embedding_to_es.log", rotation="23:59")
 
-    delay = 3
     elastic_search = ElasticSearchClient()
 
     '''
     # to add the new field to the index - run once only
     elastic_search.add_vector_field(ES_INDEX, "summary_vector_embeddings")
+    # or, for an indexed field with int8 quantized HNSW, see migrate_vector_field.py to move existing vectors into it
+    elastic_search.add_vector_field(ES_INDEX, VECTOR_MIGRATION_FIELD, similarity="dot_product", index_type="int8_hnsw")
     '''
 
     dev_urls = [
@@ -33,65 +168,29 @@ if __name__ == "__main__":
         "https://gnusha.org/pi/bitcoindev/",
     ]
 
-    for dev_url in dev_urls:
-        logger.info(f"dev_url: {dev_url}")
-        dev_name = dev_url.split("/")[-2]
-
-        # if APPLY_DATE_RANGE is set to False, elasticsearch will fetch from all the docs in the index
-        APPLY_DATE_RANGE = False
-
-        if APPLY_DATE_RANGE:
-            current_date_str = None
-            if not current_date_str:
-                current_date_str = datetime.now().strftime("%Y-%m-%d")
-            start_date = datetime.now() - timedelta(days=7)
-            start_date_str = start_date.strftime("%Y-%m-%d")
-            logger.info(f"start_date: {start_date_str}")
-            logger.info(f"current_date_str: {current_date_str}")
-        else:
-            start_date_str = None
-            current_date_str = None
-
-        docs_list = elastic_search.fetch_data_for_empty_field(
-            es_index=ES_INDEX, url=dev_url, field_name="summary_vector_embeddings",
-            start_date_str=start_date_str, current_date_str=current_date_str
-        )
-        logger.success(f"TOTAL THREADS RECEIVED WITH AN EMPTY 'summary_vector_embeddings': {len(docs_list)}")
-
-        if docs_list:
-            for idx, doc in enumerate(tqdm.tqdm(docs_list)):
-                doc_id = doc['_id']
-                doc_index = doc['_index']
-
-                doc_text = doc['_source'].get('title')
-                doc_summary = doc['_source'].get('summary')
-                if not doc_summary:
-                    doc_text += f" \n{doc['_source'].get('body')}"
-                else:
-                    doc_text += f" \n{doc_summary}"
-
-                if not doc['_source'].get('summary_vector_embeddings') and doc_summary:
-                    try:
-                        text_vector = EMBEDDING_MODEL.encode(doc_text, normalize_embeddings=True).tolist()
-
-                        if text_vector:
-                            res = elastic_search.es_client.update(
-                                index=doc_index,
-                                id=doc_id,
-                                body={
-                                    "doc": {
-                                        "summary_vector_embeddings": text_vector
-                                    },
-                                    "doc_as_upsert": True  # insert the document if it does not already exist
-                                }
-                            )
-                        else:
-                            logger.info(
-                                f"Nothing to update! Vector length: {len(text_vector)}, '_id': {doc_id}")
-                    except Exception as ex:
-                        logger.error(f"Error updating ES index: {ex} \n{traceback.format_exc()}")
-                else:
-                    if not doc_summary:
-                        logger.info(f"'summary' doesn't exist for '_id': {doc_id} | {doc['_source']['created_at']}")
-
-        logger.success(f"Process complete for dev_url: {dev_url}")
+    # if APPLY_DATE_RANGE is set to False, elasticsearch will fetch from all the docs in the index
+    APPLY_DATE_RANGE = False
+
+    # if USE_WATERMARK is set to True, only docs added since the previous successful run are fetched,
+    # with a full sweep every FULL_SWEEP_INTERVAL_DAYS. It is ignored if APPLY_DATE_RANGE is set
+    USE_WATERMARK = True
+    watermark = WatermarkStore("update_vector_embedding_to_es") if USE_WATERMARK else None
+
+    # if REUSE_NEAR_DUPLICATES is set to True, docs reuse the vector of their near-duplicate representative,
+    # see find_near_duplicates.py
+    REUSE_NEAR_DUPLICATES = True
+    near_duplicates = NearDuplicateIndex.load_if_exists(NEAR_DUPLICATE_INDEX_DIR) if REUSE_NEAR_DUPLICATES else None
+
+    # load the model once up front, the sources share it
+    get_embedding_model()
+
+    # sources in a group are fetched with a single query and routed back per domain, see SOURCES_PER_QUERY.
+    # Groups are processed concurrently and share the rate limiters, a failing group doesn't stop the others
+    run_sources_concurrently(group_sources(dev_urls), update_embeddings_for_source,
+                             elastic_search=elastic_search, apply_date_range=APPLY_DATE_RANGE, watermark=watermark,
+                             near_duplicates=near_duplicates)
+
+    embedding_cache = get_embedding_cache()
+    if embedding_cache is not None:
+        embedding_cache.log_stats()
+        embedding_cache.compact()